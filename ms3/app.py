@@ -2,23 +2,35 @@
     The Tornado application
 """
 import os
-import errno
-import shutil
-import socket
+import json
+import time
+import base64
 import hashlib
+import email.utils
 import logging
 import urlparse
+import functools
+import lxml.etree
 import tornado.web
 import tornado.ioloop
-import tornado.httpserver
+import tornado.netutil
+import tornado.process
+from tornado import gen, stack_context
 from tornado.options import options, define
 
 import ms3.general_options as general_options
+from ms3 import compression, durability, metrics, profiling
+from ms3.executor import Blocking, Inline
+from ms3.storage import create_storage
+from ms3.streaming import (
+    FileSender, InvalidRange, MS3HTTPServer, parse_range)
 
 from ms3.commands import (
-    Bucket, ListAllMyBucketsResponse, xml_string,
+    InvalidPart, ListAllMyBucketsResponse,
     ListBucketResponse, ListBucketVersionsResponse,
-    VersioningConfigurationResponse, CopyObjectResponse)
+    VersioningConfigurationResponse, CopyObjectResponse,
+    InitiateMultipartUploadResponse, CompleteMultipartUploadResponse,
+    ListPartsResponse, DeleteResultResponse, is_valid_key, is_version_id)
 
 define("port", default=9009, type=int, metavar="PORT",
        help="Port on which we run this server (usually https port)")
@@ -30,20 +42,135 @@ define("certfile", default="certs/cert.pem", type=str,
        help="Certificate File", metavar="PATH")
 define("cafile", default="certs/ca.pem", type=str,
        help="CA Certificate File", metavar="PATH")
+define("rescan_listings", default=False, type=bool, metavar="True|False",
+       help="Rescan the bucket directory on every listing (use when files "
+            "are changed in the data directory while ms3 is running)")
+define("pretty_xml", default=True, type=bool, metavar="True|False",
+       help="Pretty print the XML responses")
+define("processes", default=1, type=int, metavar="N",
+       help="Number of server processes sharing the port and the data "
+            "directory (0 for one per CPU)")
 
 
 _logger = logging.getLogger(__name__)
 
+MAX_KEYS = 1000
+MAX_PARTS = 1000
+MAX_PART_NUMBER = 10000
+MAX_DELETE_KEYS = 1000
+
+
+class Found(gen.YieldPoint):
+    """
+        Yield point wrapping a storage task (see BaseHandler.storage_task),
+        which sends 404 back if the task finds nothing
+    """
+    def __init__(self, handler, task):
+        self.handler = handler
+        self.task = task
+
+    def start(self, runner):
+        self.task.start(runner)
+
+    def is_ready(self):
+        return self.task.is_ready()
+
+    def get_result(self):
+        result = self.task.get_result()
+        if not result:
+            self.handler.send_error(404)
+        return result
+
 
 class BaseHandler(tornado.web.RequestHandler):
     """ Common functionality for all handlers """
+    # bytes of the response body, see write and ms3.streaming.FileSender
+    bytes_out = 0
+    _in_flight = False
+    # whether the response is compressed, see allow_compression
+    compressing = False
+    # capture of a request profiled with the x-ms3-profile header
+    _profile = None
+    _stop_profile = None
+
+    def _execute(self, transforms, *args, **kwargs):
+        if (self.application.profiling and
+                profiling.REQUEST_HEADER in self.request.headers):
+            capture = self.application.profiler.start_request(
+                "%s %s" % (self.request.method, self.request.uri))
+            if capture is not None:
+                self._profile = capture
+                self.set_header(profiling.RESPONSE_HEADER, capture.id)
+                # the profile is enabled in all the callbacks of the request
+                context = functools.partial(profiling.RequestProfile,
+                                            capture.new_profile())
+                with stack_context.StackContext(context) as stop:
+                    self._stop_profile = stop
+                    return super(BaseHandler, self)._execute(
+                        transforms, *args, **kwargs)
+        return super(BaseHandler, self)._execute(transforms, *args, **kwargs)
+
+    def prepare(self):
+        self._in_flight = True
+        metrics.in_flight.inc()
+
+    def _end_request(self):
+        if self._in_flight:
+            self._in_flight = False
+            metrics.in_flight.dec()
+
+    def write(self, chunk):
+        if isinstance(chunk, str):
+            self.bytes_out += len(chunk)
+        super(BaseHandler, self).write(chunk)
+
+    def on_connection_close(self):
+        self._end_request()
+
+    def on_finish(self):
+        self._end_request()
+        if self._profile is not None:
+            self._stop_profile()
+            self._profile.stop()
+        if self.upload:
+            self.upload.discard()
+        labels = (type(self).__name__, self.request.method)
+        metrics.requests.inc(labels + (self.get_status(),))
+        metrics.request_duration.observe(self.request.request_time(), labels)
+        metrics.request_bytes.inc(labels, self.upload.size if self.upload
+                                  else len(self.request.body))
+        metrics.response_bytes.inc(labels, self.bytes_out)
+
     @property
     def datadir(self):
         return self.application.datadir
 
+    @property
+    def storage(self):
+        return self.application.storage
+
+    def storage_task(self, func, *args, **kwargs):
+        """
+            Yield point running a storage operation, on the I/O threads if
+            the storage engine blocks
+        """
+        if metrics.enabled:
+            func = metrics.timed_call(func)
+        if self.storage.blocking:
+            capture = None
+            if self.application.profiling:
+                capture = self.application.profiler.task_capture(
+                    self._profile)
+            if capture is not None:
+                func = functools.partial(capture.runcall, func)
+            return Blocking(func, *args, **kwargs)
+        return Inline(func, *args, **kwargs)
+
     def echo(self):
         """ Debug function for a request """
         self.set_header('Content-Type', 'text/plain')
+        if not _logger.isEnabledFor(logging.DEBUG):
+            return
         request = self.request
         _logger.debug("Request headers")
         for key, value in request.headers.iteritems():
@@ -72,21 +199,71 @@ class BaseHandler(tornado.web.RequestHandler):
         """ Get the value of the specified header """
         return self.request.headers[header]
 
+    def decode_argument(self, value, name=None):
+        """ Keys and arguments are kept as UTF-8 byte strings, like the
+            file names on disk """
+        return value
+
     def get_bucket(self, name):
         """
-            Helper for getting a bucket.
-            Sends 404 back if the bucket is not found
+            Yield point getting a bucket, on the I/O threads (loading a
+            bucket may migrate its versions). Sends 404 back if the bucket
+            is not found:
+
+                bucket = yield self.get_bucket(name)
         """
-        try:
-            return Bucket(name, self.datadir)
-        except OSError as exception:
-            _logger.warn(exception)
-            self.send_error(404)
+        return Found(self, self.storage_task(self.storage.get_bucket, name))
+
+    def compute_etag(self):
+        """ ETags are set from the object metadata, never by hashing the
+            response body """
+        return None
+
+    @property
+    def upload(self):
+        """ The streamed request body (see ms3.streaming), if any """
+        return getattr(self.request, "upload", None)
+
+    def allow_compression(self):
+        """
+            Let the response be compressed (see ms3.compression), returns
+            False if the client does not accept a compressed response
+        """
+        for transform in self._transforms or []:
+            if (isinstance(transform, compression.CompressionTransform) and
+                    transform.encoding):
+                transform.allowed = True
+                self.compressing = True
+        return self.compressing
 
     def render_xml(self, result):
-        """ Helper for rendering the response """
-        self.write(xml_string(result.xml()))
-        self.finish()
+        """
+            Helper for rendering the response. Asynchronous handlers stream
+            the response, each chunk being produced once the previous one
+            was sent.
+        """
+        self.set_header("Content-Type", "application/xml")
+        self.allow_compression()
+        chunks = result.iter_xml(pretty_print=options.pretty_xml,
+                                 chunk_size=options.chunk_size)
+        if self._auto_finish:
+            for chunk in chunks:
+                self.write(chunk)
+            self.finish()
+        else:
+            self._write_chunks(chunks, next(chunks))
+
+    def write_json(self, value):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(value))
+
+    def _write_chunks(self, chunks, chunk):
+        following = next(chunks, None)
+        self.write(chunk)
+        if following is None:
+            self.finish()
+        else:
+            self.flush(callback=lambda: self._write_chunks(chunks, following))
 
 
 class CatchAllHandler(BaseHandler):
@@ -98,176 +275,613 @@ class CatchAllHandler(BaseHandler):
         self.echo()
 
 
+class MetricsHandler(BaseHandler):
+    """ The metrics of this process (see ms3.metrics) """
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render())
+
+
+class ProfileHandler(BaseHandler):
+    """ Profiling of this process (see ms3.profiling) """
+    def prepare(self):
+        super(ProfileHandler, self).prepare()
+        if not self.application.profiling:
+            raise tornado.web.HTTPError(404)
+
+    @property
+    def profiler(self):
+        return self.application.profiler
+
+    def get(self, capture_id=None):
+        if capture_id is None:
+            self.write_json({"window": self.profiler.window and
+                             self.profiler.window.id,
+                             "captures": [capture.info() for capture in
+                                          self.profiler.captures.values()]})
+            return
+        capture = self.profiler.get(capture_id)
+        if capture is None:
+            raise tornado.web.HTTPError(404)
+        format = self.get_argument("format",
+                                   profiling.FORMATS[capture.mode][0])
+        try:
+            data = capture.dump(format)
+        except profiling.NotAvailable as exception:
+            _logger.info("Profile %s not available: %s", capture_id,
+                         exception)
+            raise tornado.web.HTTPError(409)
+        if format == "pstats":
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Disposition",
+                            "attachment; filename=%s.pstats" % capture.id)
+        else:
+            self.set_header("Content-Type", "text/plain")
+        self.write(data)
+
+    def post(self, capture_id=None):
+        """ Start a time window, stopped after `duration` seconds if set """
+        try:
+            duration = float(self.get_argument("duration", 0))
+            capture = self.profiler.start_window(
+                self.get_argument("mode", "cprofile"))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if capture is None:
+            raise tornado.web.HTTPError(409)
+        if duration > 0:
+            io_loop = self.request.connection.stream.io_loop
+            self.profiler.window_timeout = io_loop.add_timeout(
+                time.time() + duration, self.profiler.stop_window)
+        self.write_json(capture.info())
+
+    def delete(self, capture_id=None):
+        """ Stop the current time window """
+        timeout = self.profiler.window_timeout
+        capture = self.profiler.stop_window()
+        if capture is None:
+            raise tornado.web.HTTPError(404)
+        if timeout is not None:
+            self.request.connection.stream.io_loop.remove_timeout(timeout)
+        self.write_json(capture.info())
+
+
+class SnapshotHandler(BaseHandler):
+    """
+        Snapshots of all the buckets (see ms3.storage.Storage.snapshot):
+
+            GET /_ms3/snapshots             list the snapshots
+            PUT /_ms3/snapshots/<name>      snapshot the buckets
+            POST /_ms3/snapshots/<name>     restore the buckets of a snapshot
+            DELETE /_ms3/snapshots/<name>   remove a snapshot
+    """
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, name=None):
+        if name is not None:
+            self.send_error(405)
+            return
+        snapshots = yield self.storage_task(self.storage.get_snapshots)
+        self.write_json({"snapshots": snapshots})
+        self.finish()
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def put(self, name=None):
+        try:
+            info = yield self.storage_task(self.storage.snapshot, name)
+        except ValueError as exception:
+            _logger.warn("Could not snapshot: %s", exception)
+            self.send_error(400)
+            return
+        self.write_json(info)
+        self.finish()
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def post(self, name=None):
+        try:
+            restored = yield self.storage_task(self.storage.restore_snapshot,
+                                               name)
+        except ValueError:
+            restored = False
+        if not restored:
+            self.send_error(404)
+            return
+        self.set_status(204)
+        self.finish()
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def delete(self, name=None):
+        try:
+            deleted = yield self.storage_task(self.storage.delete_snapshot,
+                                              name)
+        except ValueError:
+            deleted = False
+        if not deleted:
+            self.send_error(404)
+            return
+        self.set_status(204)
+        self.finish()
+
+
 class BucketHandler(BaseHandler):
     """ Handle for GET/PUT/DELETE operations on buckets """
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, name):
-        bucket = self.get_bucket(name)
+        bucket = yield self.get_bucket(name)
         if not bucket:
             return
         result = None
         prefix = self.get_argument("prefix", None)
+        delimiter = self.get_argument("delimiter", None)
+        try:
+            max_keys = min(int(self.get_argument("max-keys", MAX_KEYS)),
+                           MAX_KEYS)
+        except ValueError:
+            max_keys = -1
+        if max_keys < 0:
+            self.send_error(400)
+            return
         if self.has_section("versioning"):
             result = VersioningConfigurationResponse(bucket)
         elif self.has_section("versions"):
-            result = ListBucketVersionsResponse(
-                bucket, bucket.list_versions(prefix=prefix))
+            listing = yield self.storage_task(
+                bucket.list_versions_page, prefix=prefix,
+                key_marker=self.get_argument("key-marker", None),
+                version_id_marker=self.get_argument(
+                    "version-id-marker", None),
+                delimiter=delimiter, max_keys=max_keys,
+                rescan=options.rescan_listings)
+            result = ListBucketVersionsResponse(bucket, listing)
         else:
-            result = ListBucketResponse(
-                bucket, bucket.list(prefix=prefix))
+            listing = yield self.storage_task(
+                bucket.list_page, prefix=prefix,
+                marker=self.get_argument("marker", None),
+                delimiter=delimiter, max_keys=max_keys,
+                rescan=options.rescan_listings)
+            result = ListBucketResponse(bucket, listing)
         self.render_xml(result)
 
+    @tornado.web.asynchronous
+    @gen.engine
     def head(self, name):
-        self.set_status(200)
+        bucket = yield self.get_bucket(name)
+        if bucket:
+            self.finish()
 
+    @tornado.web.asynchronous
+    @gen.engine
     def put(self, name):
         if self.has_section("versioning"):
-            bucket = self.get_bucket(name)
+            bucket = yield self.get_bucket(name)
             if not bucket:
                 return
             if '<Status>Enabled</Status>' in self.request.body:
-                bucket.enable_versioning()
+                yield self.storage_task(bucket.enable_versioning)
             else:
-                bucket.disable_versioning()
+                yield self.storage_task(bucket.disable_versioning)
         else:
-            bucket = Bucket.create(name, self.datadir)
+            bucket = yield self.storage_task(self.storage.create_bucket, name)
             if not bucket:
                 _logger.warn("Could not create bucket %s", name)
                 self.send_error(409)
                 return
         self.echo()
+        self.finish()
 
+    @tornado.web.asynchronous
+    @gen.engine
+    def post(self, name):
+        if not self.has_section("delete"):
+            self.send_error(400)
+            return
+        bucket = yield self.get_bucket(name)
+        if not bucket:
+            return
+        try:
+            quiet, objects = parse_delete_objects(self.request.body)
+        except (lxml.etree.XMLSyntaxError, ValueError) as exception:
+            _logger.warn("Invalid delete request for %s: %s", name, exception)
+            self.send_error(400)
+            return
+        results = yield self.storage_task(bucket.delete_entries, objects)
+        self.render_xml(DeleteResultResponse(results, quiet))
+
+    @tornado.web.asynchronous
+    @gen.engine
     def delete(self, name):
-        bucket = self.get_bucket(name)
+        bucket = yield self.get_bucket(name)
         if not bucket:
             return
-        bucket.delete()
+        yield self.storage_task(bucket.delete)
         self.set_status(204)
+        self.finish()
 
 
 class ListAllMyBucketsHandler(BaseHandler):
     """ Handler for listing all buckets """
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
-        result = ListAllMyBucketsResponse(Bucket.get_all_buckets(self.datadir))
-        self.render_xml(result)
+        buckets = yield self.storage_task(self.storage.get_all_buckets)
+        self.render_xml(ListAllMyBucketsResponse(buckets))
 
+    @tornado.web.asynchronous
+    @gen.engine
     def delete(self):
-        shutil.rmtree(options.datadir, ignore_errors=True)
-        try:
-            os.makedirs(options.datadir)
-        except (IOError, OSError):
-            pass
+        yield self.storage_task(self.storage.delete_all)
+        self.finish()
+
+
+def get_loaded_entry(bucket, key, version_id=None):
+    """
+        Bucket.get_entry, also reading the metadata of the entry (which
+        hashes files dropped in the data directory by hand), from the
+        object cache if the bucket has one. Meant to run on the I/O threads.
+    """
+    cache = getattr(bucket, "cache", None)
+    if cache is not None:
+        return cache.load(bucket, key, version_id)
+    entry = bucket.get_entry(key, version_id=version_id)
+    if entry:
+        entry.metadata
+    return entry
+
+
+def parse_http_date(value):
+    """ The timestamp of an HTTP date, None if missing or invalid """
+    parsed = email.utils.parsedate_tz(value or "")
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def etag_matches(header, etag):
+    """ Whether an If-Match or If-None-Match header lists the ETag """
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
+
+
+def evaluate_preconditions(headers, entry, prefix=""):
+    """
+        Evaluate the If-Match, If-Unmodified-Since, If-None-Match and
+        If-Modified-Since headers of a request (with prefix, the
+        x-amz-copy-source-if-* headers of a copy) against the stored ETag
+        and modification time of an entry, so the object data is never
+        read. Returns None if the request proceeds, 412 if a condition
+        fails and 304 if the entry was not modified.
+    """
+    # HTTP dates have a resolution of a second
+    modified_at = int(entry.modified_at)
+    if_match = headers.get(prefix + "If-Match")
+    if if_match is not None:
+        if not etag_matches(if_match, entry.etag):
+            return 412
+    else:
+        since = parse_http_date(headers.get(prefix + "If-Unmodified-Since"))
+        if since is not None and modified_at > since:
+            return 412
+    if_none_match = headers.get(prefix + "If-None-Match")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, entry.etag):
+            return 304
+    else:
+        since = parse_http_date(headers.get(prefix + "If-Modified-Since"))
+        if since is not None and modified_at <= since:
+            return 304
+    return None
 
 
 class ObjectHandler(BaseHandler):
-    """ Handle for GET/PUT/HEAD/DELETE on objects """
+    """
+        Handle for GET/PUT/POST/HEAD/DELETE on objects. The storage
+        operations run on the I/O threads (see ms3.executor).
+    """
+    sender = None
+
+    def get_upload(self, bucket):
+        """
+            Yield point getting the multipart upload of the request.
+            Sends 404 back if the upload is not found
+        """
+        return Found(self, self.storage_task(bucket.get_upload,
+                                             self.get_argument("uploadId")))
+
+    def check_key(self, key):
+        """
+            Helper for rejecting the keys which can't be stored (see
+            commands.is_valid_key). Sends 400 back for those
+        """
+        if not is_valid_key(key):
+            self.send_error(400)
+            return False
+        return True
+
+    def check_preconditions(self, entry):
+        """
+            Helper for conditional requests, returns whether the request
+            proceeds. Sends 304 or 412 back if not.
+        """
+        status = evaluate_preconditions(self.request.headers, entry)
+        if status == 304:
+            self.set_status(304)
+            self.finish()
+            return False
+        if status is not None:
+            self.send_error(status)
+            return False
+        return True
+
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, name, key):
         version_id = self.get_argument("versionId", None)
-        bucket = self.get_bucket(name)
+        if not self.check_key(key):
+            return
+        bucket = yield self.get_bucket(name)
         if not bucket:
             return
-        entry = bucket.get_entry(key, version_id=version_id)
+        if self.get_argument("uploadId", None):
+            self.list_parts(bucket)
+            return
+        entry = yield self.storage_task(get_loaded_entry, bucket, key,
+                                        version_id)
         if not entry:
             self.send_error(404)
-        else:
-            entry.set_headers(self)
-            self.write(entry.read())
+            return
+        entry.set_headers(self)
+        if not self.check_preconditions(entry):
+            return
+        self.set_header("Accept-Ranges", "bytes")
+        try:
+            byte_range = parse_range(self.request.headers.get("Range"),
+                                     entry.size)
+        except InvalidRange:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % entry.size)
+            self.finish()
+            return
+        offset, length = 0, entry.size
+        if byte_range:
+            offset, length = byte_range
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes %d-%d/%d" % (
+                offset, offset + length - 1, entry.size))
+        self.set_header("Content-Length", length)
+        if (not byte_range and length >= options.compression_min_size and
+                compression.compressible_type(entry.content_type)):
+            self.allow_compression()
+        self.sender = FileSender(self, entry.open(), offset, length)
+        self.sender.start()
+
+    @gen.engine
+    def list_parts(self, bucket):
+        upload = yield self.get_upload(bucket)
+        if not upload:
+            return
+        try:
+            marker = int(self.get_argument("part-number-marker", 0))
+            max_parts = min(int(self.get_argument("max-parts", MAX_PARTS)),
+                            MAX_PARTS)
+        except ValueError:
+            self.send_error(400)
+            return
+        # one more part than requested tells if the list is truncated
+        parts = yield self.storage_task(upload.parts, marker, max_parts + 1)
+        self.render_xml(ListPartsResponse(upload, parts, marker, max_parts))
+
+    def on_connection_close(self):
+        if self.sender:
+            self.sender.close()
 
+    @tornado.web.asynchronous
+    @gen.engine
     def put(self, name, key):
-        bucket = self.get_bucket(name)
+        if not self.check_key(key):
+            return
+        bucket = yield self.get_bucket(name)
         if not bucket:
             return
-        if not self.request.body:
-            if self.has_header("x-amz-copy-source"):
-                source_name, key_name = (self.get_header("x-amz-copy-source").
-                                         split("/", 1))
-                source = self.get_bucket(source_name)
-                if not source:
-                    return
-                version_id = None
-                if "?" in key_name:
-                    key_name, args = key_name.split("?", 1)
-                    args = urlparse.parse_qs(args)
-                    if "versionId" in args:
-                        version_id = args["versionId"][0]
-                entry = source.get_entry(
-                    key_name, version_id=version_id)
-                if not entry or entry.size == 0:
-                    _logger.warn("Could not find source entry or size is 0"
-                                 " for %s/%s", source_name, key_name)
-                    self.send_error(404)
+        content_type = self.request.headers.get("Content-Type")
+        if self.get_argument("uploadId", None):
+            self.put_part(bucket)
+            return
+        elif self.upload:
+            if self.has_header("Content-MD5"):
+                digest = base64.b64decode(self.get_header("Content-MD5"))
+                if digest != self.upload.md5.digest():
+                    _logger.warn("Content-MD5 mismatch for %s/%s", name, key)
+                    self.send_error(400)
                     return
-                entry = bucket.copy_entry(key, entry)
-                if entry:
-                    response = CopyObjectResponse(entry)
-                    self.render_xml(response)
-            else:
-                _logger.warn("Not accepting 0 bytes files")
-                self.set_header('ETag', '"%s"' % hashlib.md5("").hexdigest())
+            entry = yield self.storage_task(bucket.store_upload, key,
+                                            self.upload,
+                                            content_type=content_type)
+        elif not self.request.body:
+            if self.has_header("x-amz-copy-source"):
+                self.copy(bucket, key)
+                return
+            _logger.warn("Not accepting 0 bytes files")
+            self.set_header('ETag', '"%s"' % hashlib.md5("").hexdigest())
+            self.finish()
+            return
+        else:
+            entry = yield self.storage_task(bucket.set_entry, key,
+                                            self.request.body,
+                                            content_type=content_type)
+        self.set_header('ETag', '"%s"' % entry.etag)
+        if entry.version_id:
+            self.set_header('x-amz-version-id', entry.version_id)
+        self.finish()
+
+    @gen.engine
+    def copy(self, bucket, key):
+        source_name, key_name = (self.get_header("x-amz-copy-source").
+                                 split("/", 1))
+        source = yield self.get_bucket(source_name)
+        if not source:
+            return
+        version_id = None
+        if "?" in key_name:
+            key_name, args = key_name.split("?", 1)
+            args = urlparse.parse_qs(args)
+            if "versionId" in args:
+                version_id = args["versionId"][0]
+        if not self.check_key(key_name):
+            return
+        entry = yield self.storage_task(get_loaded_entry, source, key_name,
+                                        version_id)
+        if not entry or entry.size == 0:
+            _logger.warn("Could not find source entry or size is 0"
+                         " for %s/%s", source_name, key_name)
+            self.send_error(404)
+            return
+        if evaluate_preconditions(self.request.headers, entry,
+                                  "x-amz-copy-source-") is not None:
+            self.send_error(412)
+            return
+        entry = yield self.storage_task(bucket.copy_entry, key, entry)
+        self.render_xml(CopyObjectResponse(entry))
+
+    @gen.engine
+    def put_part(self, bucket):
+        upload = yield self.get_upload(bucket)
+        if not upload:
+            return
+        try:
+            number = int(self.get_argument("partNumber"))
+        except ValueError:
+            number = 0
+        if not 1 <= number <= MAX_PART_NUMBER:
+            self.send_error(400)
+            return
+        if self.upload:
+            etag = yield self.storage_task(upload.store_part, number,
+                                           self.upload)
         else:
-            entry = bucket.set_entry(key, self.request.body)
-            self.set_header('ETag', '"%s"' % entry.etag)
+            etag = yield self.storage_task(upload.set_part, number,
+                                           self.request.body)
+        self.set_header('ETag', '"%s"' % etag)
+        self.finish()
 
+    @tornado.web.asynchronous
+    @gen.engine
+    def post(self, name, key):
+        if not self.check_key(key):
+            return
+        bucket = yield self.get_bucket(name)
+        if not bucket:
+            return
+        if self.has_section("uploads"):
+            upload = yield self.storage_task(
+                bucket.initiate_upload, key,
+                content_type=self.request.headers.get("Content-Type"))
+            self.render_xml(InitiateMultipartUploadResponse(upload))
+        elif self.get_argument("uploadId", None):
+            upload = yield self.get_upload(bucket)
+            if not upload:
+                return
+            try:
+                parts = parse_completed_parts(self.request.body)
+                entry = yield self.storage_task(upload.complete, parts)
+            except (lxml.etree.XMLSyntaxError, ValueError, InvalidPart) as \
+                    exception:
+                _logger.warn("Could not complete upload %s: %s",
+                             upload.upload_id, exception)
+                self.send_error(400)
+                return
+            location = "%s://%s/%s/%s" % (self.request.protocol,
+                                          self.request.host, name, key)
+            self.render_xml(CompleteMultipartUploadResponse(
+                location, bucket, entry))
+        else:
+            self.send_error(400)
+
+    @tornado.web.asynchronous
+    @gen.engine
     def head(self, name, key):
         version_id = self.get_argument("versionId", None)
-        bucket = self.get_bucket(name)
+        if not self.check_key(key):
+            return
+        bucket = yield self.get_bucket(name)
         if not bucket:
             return
-        entry = bucket.get_entry(key, version_id=version_id)
+        entry = yield self.storage_task(get_loaded_entry, bucket, key,
+                                        version_id)
         if not entry:
             self.send_error(404)
-        else:
-            self.set_header('ETag', '"%s"' % entry.etag)
+            return
+        entry.set_headers(self)
+        if not self.check_preconditions(entry):
+            return
+        # from the metadata, the body is never sent
+        self.set_header("Content-Length", entry.size)
+        self.finish()
 
+    @tornado.web.asynchronous
+    @gen.engine
     def delete(self, name, key):
         version_id = self.get_argument("versionId", None)
-        bucket = self.get_bucket(name)
+        if not self.check_key(key):
+            return
+        bucket = yield self.get_bucket(name)
         if not bucket:
             return
-        bucket.delete_entry(key, version_id=version_id)
+        if self.get_argument("uploadId", None):
+            upload = yield self.get_upload(bucket)
+            if not upload:
+                return
+            yield self.storage_task(upload.abort)
+        elif version_id and not is_version_id(version_id):
+            self.send_error(404)
+            return
+        else:
+            marker_version_id = yield self.storage_task(
+                bucket.delete_entry, key, version_id=version_id)
+            if marker_version_id:
+                self.set_header("x-amz-delete-marker", "true")
+                self.set_header("x-amz-version-id", marker_version_id)
         self.set_status(204)
+        self.finish()
 
 
-def fix_TCPServer_handle_connection():
-    """ Monkey-patching tornado to increase the maxium file size to 1.5 GB """
-    import tornado.netutil
-    from tornado.iostream import SSLIOStream, IOStream
-    import ssl
-
-    max_buffer_size = 1536 * 1024 * 1024  # 1.5GB
-    read_chunk_size = 64 * 1024
-
-    def _handle_connection(self, connection, address):
-        if self.ssl_options is not None:
-            assert ssl, "Python 2.6+ and OpenSSL required for SSL"
-            try:
-                connection = ssl.wrap_socket(connection,
-                                             server_side=True,
-                                             do_handshake_on_connect=False,
-                                             **self.ssl_options)
-            except ssl.SSLError, err:
-                if err.args[0] == ssl.SSL_ERROR_EOF:
-                    return connection.close()
-                else:
-                    raise
-            except socket.error, err:
-                if err.args[0] == errno.ECONNABORTED:
-                    return connection.close()
-                else:
-                    raise
-        try:
-            if self.ssl_options is not None:
-                stream = SSLIOStream(connection, io_loop=self.io_loop,
-                                     max_buffer_size=max_buffer_size,
-                                     read_chunk_size=read_chunk_size)
-            else:
-                stream = IOStream(connection, io_loop=self.io_loop,
-                                  max_buffer_size=max_buffer_size,
-                                  read_chunk_size=read_chunk_size)
-            self.handle_stream(stream, address)
-        except Exception:
-            _logger.error("Error in connection callback", exc_info=True)
-
-    tornado.netutil.TCPServer._handle_connection = _handle_connection
+def parse_completed_parts(body):
+    """ The (part number, etag) list of a CompleteMultipartUpload body """
+    parts = []
+    # the elements may or may not be in the S3 namespace
+    for part in lxml.etree.fromstring(body).iter("{*}Part"):
+        parts.append((int(part.findtext("{*}PartNumber")),
+                      part.findtext("{*}ETag") or ""))
+    return parts
+
+
+def parse_delete_objects(body):
+    """
+        The quiet flag and the (key, version id) list of a DeleteObjects
+        body. Raises ValueError above MAX_DELETE_KEYS objects.
+    """
+    root = lxml.etree.fromstring(body)
+    quiet = (root.findtext("{*}Quiet") or "").strip().lower() == "true"
+    objects = []
+    for element in root.iter("{*}Object"):
+        key = element.findtext("{*}Key")
+        if not key:
+            raise ValueError("object without key")
+        if not is_valid_key(key):
+            raise ValueError("invalid key %r" % key)
+        objects.append((key, element.findtext("{*}VersionId") or None))
+    if not objects or len(objects) > MAX_DELETE_KEYS:
+        raise ValueError("%d objects to delete" % len(objects))
+    return quiet, objects
 
 
 class MS3App(tornado.web.Application):
@@ -278,12 +892,28 @@ class MS3App(tornado.web.Application):
 
         handlers = [
             (r"/", ListAllMyBucketsHandler),
+            (r"/_ms3/metrics", MetricsHandler),
+            (r"/_ms3/profile", ProfileHandler),
+            (r"/_ms3/profile/([^/]+)", ProfileHandler),
+            (r"/_ms3/snapshots", SnapshotHandler),
+            (r"/_ms3/snapshots/([^/]+)", SnapshotHandler),
             (r"/([^/]+)/", BucketHandler),
             (r"/([^/]+)/(.+)", ObjectHandler),
             (r"/.*", CatchAllHandler)
         ]
+        metrics.enabled = options.metrics
+        durability.configure(options.durability, options.group_commit_delay)
+        self.processes = options.processes
+        if options.storage != "fs" and self.processes != 1:
+            _logger.warn("The %s storage can only be used by one process",
+                         options.storage)
+            self.processes = 1
+        debug = debug or options.debug
+        if debug and self.processes != 1:
+            _logger.warn("Debug mode is disabled with multiple processes")
+            debug = False
         settings = {
-            'debug': debug or options.debug
+            'debug': debug
         }
         self.datadir = options.datadir
         if not os.path.isabs(self.datadir):
@@ -291,19 +921,27 @@ class MS3App(tornado.web.Application):
                 os.path.dirname(os.path.abspath(__file__)), "..",
                 self.datadir))
 
-        if not os.path.exists(self.datadir):
+        if options.cache_size and self.processes != 1:
+            # the other processes would not invalidate it
+            _logger.warn("The object cache is disabled with multiple "
+                         "processes")
+        self.storage = create_storage(datadir=self.datadir,
+                                      cache=self.processes == 1)
+        self.profiling = options.profiling
+        self.profiler = profiling.Profiler(options.profile_interval)
+        if options.storage == "fs" and not os.path.exists(self.datadir):
             try:
                 os.makedirs(self.datadir)
             except (OSError, IOError) as exception:
                 _logger.warn("Tried to create %s: %s", self.datadir, exception)
-        tornado.web.Application.__init__(self, handlers, **settings)
-        fix_TCPServer_handle_connection()
+        tornado.web.Application.__init__(
+            self, handlers, transforms=[compression.CompressionTransform,
+                                        tornado.web.ChunkedTransferEncoding],
+            **settings)
 
 
-def run(args=None):
-    """ Helper for running the app """
-    app = MS3App(args=args)
-
+def create_server(app, io_loop=None):
+    """ The HTTP server of the app, with SSL if enabled """
     ssl_options = None
     if options.internal_ssl:
         ssl_options = {
@@ -311,14 +949,31 @@ def run(args=None):
             'certfile': options.certfile,
             'ca_certs': options.cafile
         }
+    return MS3HTTPServer(app, xheaders=True, ssl_options=ssl_options,
+                         io_loop=io_loop)
+
+
+def run(args=None):
+    """ Helper for running the app """
+    app = MS3App(args=args)
 
-    http_server = tornado.httpserver.HTTPServer(app, xheaders=True,
-                                                ssl_options=ssl_options)
-    http_server.listen(options.port)
     _logger.info("Using configuration file %s", options.config)
-    _logger.info("Using data directory %s", app.datadir)
+    if options.storage == "fs":
+        _logger.info("Using data directory %s", app.datadir)
+    else:
+        _logger.info("Using the %s storage", options.storage)
     _logger.info("Starting up on port %s", options.port)
+    http_server = create_server(app)
+    if app.processes == 1:
+        http_server.listen(options.port)
+    else:
+        # bind before forking so all the processes accept on the socket
+        sockets = tornado.netutil.bind_sockets(options.port)
+        tornado.process.fork_processes(app.processes)
+        http_server.add_sockets(sockets)
     instance = tornado.ioloop.IOLoop().instance()
+    if metrics.enabled:
+        metrics.LagMonitor(instance).start()
     instance.start()
 
 
@@ -0,0 +1,405 @@
+"""
+    Load generation benchmark for ms3
+
+    Starts a server with `ms3.testing.MS3Server` on a temporary data
+    directory for each scenario (object size, bucket size, versioning) and
+    runs concurrent PUT/GET/HEAD/LIST/COPY/DELETE workloads against it with
+    boto. The results (throughput, latency percentiles and peak RSS of the
+    server) are written as JSON, so runs can be compared:
+
+        python -m ms3.benchmark --sizes=1K,1M --bucket_keys=10,10K \\
+            --versioned=both
+
+    The bucket is first filled with `keys` small objects, then each
+    operation runs on `samples` objects of the scenario size. All the
+    objects of a size have the same content.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import hashlib
+import logging
+import platform
+import tempfile
+import threading
+import Queue
+
+import tornado.options
+from tornado.options import options, define
+
+from ms3.testing import MS3Server, is_running, wait_until
+
+define("sizes", default="1K,64K,1M", type=str, metavar="SIZES",
+       help="Comma separated object sizes (K, M and G suffixes)")
+define("bucket_keys", default="10,1K", type=str, metavar="COUNTS",
+       help="Comma separated numbers of keys filling the bucket")
+define("versioned", default="no", type=str, metavar="no|yes|both",
+       help="Run the scenarios on unversioned and/or versioned buckets")
+define("samples", default=50, type=int, metavar="N",
+       help="Number of objects of each operation")
+define("concurrency", default=4, type=int, metavar="N",
+       help="Number of concurrent clients")
+define("operations", default="put,get,head,list,copy,delete", type=str,
+       metavar="OPERATIONS", help="Comma separated operations to run")
+define("server_port", default=9011, type=int, metavar="PORT",
+       help="Port of the benchmarked server")
+define("server_processes", default=1, type=int, metavar="N",
+       help="Number of server processes (see the --processes option)")
+define("server_storage", default="fs", type=str, metavar="fs|memory",
+       help="Storage engine of the server (see the --storage option)")
+define("server_config", default=None, type=str, metavar="PATH",
+       help="Configuration file of the server")
+define("output", default=None, type=str, metavar="PATH",
+       help="File receiving the JSON results (default: standard output)")
+
+
+_logger = logging.getLogger(__name__)
+
+OPERATIONS = ["put", "get", "head", "list", "copy", "delete"]
+CHUNK_SIZE = 64 * 1024
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_quantity(value):
+    """ 64K => 65536 """
+    value = value.strip().upper()
+    if value[-1:] in UNITS:
+        return int(value[:-1]) * UNITS[value[-1]]
+    return int(value)
+
+
+def parse_list(value):
+    return [parse_quantity(item) for item in value.split(",") if item.strip()]
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class PatternFile(object):
+    """
+        Read only file of `size` bytes of a repeated pattern, so objects of
+        any size are uploaded without holding them in memory
+    """
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+        self.block = "".join(chr(ord("a") + i % 26)
+                             for i in xrange(CHUNK_SIZE))
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        size = min(size, self.size - self.position)
+        if size <= 0:
+            return ""
+        offset = self.position % CHUNK_SIZE
+        data = (self.block[offset:] + self.block)[:min(size, CHUNK_SIZE)]
+        self.position += len(data)
+        return data
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.size
+        self.position = position
+
+    def tell(self):
+        return self.position
+
+    def md5(self):
+        """ The (hex, base64) MD5 of the content, as expected by boto """
+        md5 = hashlib.md5()
+        self.seek(0)
+        for chunk in iter(lambda: self.read(CHUNK_SIZE), ""):
+            md5.update(chunk)
+        self.seek(0)
+        return md5.hexdigest(), base64.b64encode(md5.digest())
+
+
+class NullFile(object):
+    """ Sink for the downloaded objects """
+    def write(self, data):
+        pass
+
+
+def connect(port):
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    return S3Connection("X", "Y", is_secure=False, host="localhost",
+                        port=port, calling_format=OrdinaryCallingFormat())
+
+
+def peak_rss(pid):
+    """
+        The sum of the peak resident set sizes (bytes) of the processes of
+        the server (its process group), None if not available
+    """
+    total = None
+    try:
+        pids = [name for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return None
+    for name in pids:
+        try:
+            with open("/proc/%s/stat" % name) as fp:
+                # the process group follows the (command) and the state
+                fields = fp.read().rsplit(")", 1)[1].split()
+            if int(fields[2]) != pid:
+                continue
+            with open("/proc/%s/status" % name) as fp:
+                for line in fp:
+                    if line.startswith("VmHWM:"):
+                        total = (total or 0) + int(line.split()[1]) * 1024
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+def run_phase(port, concurrency, items, func):
+    """
+        Run func(connection, item) for all the items on concurrent clients.
+        Returns the sorted latencies of the successful calls, the number of
+        errors and the elapsed time.
+    """
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        connection = connect(port)
+        try:
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    result = func(connection, item)
+                except Exception as exception:
+                    _logger.warn("Benchmark request failed: %s", exception)
+                    with lock:
+                        errors[0] += 1
+                    continue
+                elapsed = time.time() - start
+                with lock:
+                    # functions doing several requests return their latencies
+                    latencies.extend(result if isinstance(result, list)
+                                     else [elapsed])
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker)
+               for _ in xrange(max(min(concurrency, len(items)), 1))]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors[0], time.time() - start
+
+
+class Scenario(object):
+    """ The workloads on a bucket with `keys` keys and objects of `size` """
+    BUCKET = "benchmark"
+
+    def __init__(self, size, keys, versioned, samples, concurrency, port):
+        self.size = size
+        self.keys = keys
+        self.versioned = versioned
+        self.samples = samples
+        self.concurrency = concurrency
+        self.port = port
+        self.md5 = PatternFile(size).md5()
+
+    def names(self, prefix="object"):
+        return ["%s/%08d" % (prefix, i) for i in xrange(self.samples)]
+
+    def bucket(self, connection):
+        return connection.get_bucket(self.BUCKET, validate=False)
+
+    def fill(self, connection, name):
+        key = self.bucket(connection).new_key(name)
+        key.set_contents_from_string("x")
+
+    def put(self, connection, name):
+        key = self.bucket(connection).new_key(name)
+        key.set_contents_from_file(PatternFile(self.size), md5=self.md5)
+
+    def get(self, connection, name):
+        key = self.bucket(connection).new_key(name)
+        key.get_contents_to_file(NullFile())
+
+    def head(self, connection, name):
+        if self.bucket(connection).get_key(name) is None:
+            raise KeyError(name)
+
+    def list(self, connection, _):
+        """ A whole listing of the bucket, each page is a request """
+        bucket = self.bucket(connection)
+        latencies = []
+        marker = ""
+        while True:
+            start = time.time()
+            page = bucket.get_all_keys(marker=marker)
+            latencies.append(time.time() - start)
+            if not page.is_truncated:
+                return latencies
+            marker = page[-1].name
+
+    def copy(self, connection, name):
+        self.bucket(connection).copy_key(name.replace("object/", "copy/"),
+                                         self.BUCKET, name)
+
+    def delete(self, connection, name):
+        self.bucket(connection).delete_key(name)
+
+    def items(self, operation):
+        if operation == "list":
+            return range(self.concurrency)
+        if operation == "delete":
+            return self.names() + self.names("copy")
+        return self.names()
+
+    def run(self, operations):
+        """ The results of the operations, in order """
+        connection = connect(self.port)
+        bucket = connection.create_bucket(self.BUCKET)
+        if self.versioned:
+            bucket.configure_versioning(True)
+        connection.close()
+        results = []
+        fill_names = ["fill/%08d" % i for i in xrange(self.keys)]
+        for operation in ["fill"] + operations:
+            if operation == "fill":
+                items, func = fill_names, self.fill
+            else:
+                items, func = self.items(operation), getattr(self, operation)
+            _logger.info("%s: %d %s", self, len(items), operation)
+            latencies, errors, elapsed = run_phase(
+                self.port, self.concurrency, items, func)
+            results.append(self.result(operation, len(items), latencies,
+                                       errors, elapsed))
+        return results
+
+    def result(self, operation, count, latencies, errors, elapsed):
+        transferred = 0
+        if operation in ("put", "get"):
+            transferred = (count - errors) * self.size
+        return {
+            "operation": operation,
+            "count": count,
+            "requests": len(latencies),
+            "errors": errors,
+            "seconds": elapsed,
+            "ops_per_second": len(latencies) / elapsed if elapsed else None,
+            "bytes_per_second": transferred / elapsed if elapsed else None,
+            "latency": {
+                "mean": (sum(latencies) / len(latencies)
+                         if latencies else None),
+                "p50": percentile(latencies, 0.50),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+    def __str__(self):
+        return "%d bytes x %d keys%s" % (self.size, self.keys,
+                                         " (versioned)" if self.versioned
+                                         else "")
+
+
+def server_config(workdir):
+    """
+        The server configuration: the provided one, without debug mode and
+        by default without the access log (one line per request)
+    """
+    path = os.path.join(workdir, "ms3.conf")
+    with open(path, "w") as fp:
+        fp.write("logging = \"warning\"\n")
+        if options.server_config:
+            with open(options.server_config) as config:
+                fp.write(config.read())
+            fp.write("\n")
+        fp.write("debug = False\n")
+    return path
+
+
+def run_scenario(scenario, operations):
+    """ Run a scenario on a new server, returns its JSON report """
+    workdir = tempfile.mkdtemp(prefix="ms3-benchmark-")
+    datadir = os.path.join(workdir, "data")
+    try:
+        MS3Server.start(datadir=datadir, config=server_config(workdir),
+                        port=scenario.port,
+                        processes=options.server_processes,
+                        storage=options.server_storage)
+        try:
+            wait_until(is_running, scenario.port)
+            results = scenario.run(operations)
+            rss = peak_rss(MS3Server._pid)
+        finally:
+            MS3Server.stop()
+    finally:
+        shutil.rmtree(workdir, True)
+    return {"size": scenario.size, "keys": scenario.keys,
+            "versioned": scenario.versioned, "peak_rss": rss,
+            "results": results}
+
+
+def run_benchmark():
+    """ Run all the scenarios selected by the options """
+    operations = [operation.strip() for operation in
+                  options.operations.split(",") if operation.strip()]
+    for operation in operations:
+        if operation not in OPERATIONS:
+            raise ValueError("Unknown operation %r" % operation)
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    versioned = {"no": [False], "yes": [True],
+                 "both": [False, True]}[options.versioned]
+    scenarios = []
+    for size in parse_list(options.sizes):
+        for keys in parse_list(options.bucket_keys):
+            for is_versioned in versioned:
+                scenario = Scenario(size, keys, is_versioned, options.samples,
+                                    options.concurrency, options.server_port)
+                scenarios.append(run_scenario(scenario, operations))
+    return {
+        "started_at": started_at,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "samples": options.samples,
+            "concurrency": options.concurrency,
+            "processes": options.server_processes,
+            "storage": options.server_storage,
+            "server_config": options.server_config,
+        },
+        "scenarios": scenarios,
+    }
+
+
+def main(args=None):
+    tornado.options.parse_command_line(args=args)
+    report = run_benchmark()
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+    In-memory cache of small objects, for GET/HEAD of hot keys
+
+    Cached objects are served without touching the disk: no stat, no
+    metadata record, no open. The cache is bounded in bytes (--cache_size,
+    disabled by default) and only keeps objects up to
+    --cache_max_object_size, the least recently used are evicted first.
+
+    The fs storage invalidates the cached versions of a key when it is
+    written or deleted, and all the keys of a bucket when it is deleted or
+    restored from a snapshot. Changes made by other processes or by hand
+    are not seen, the cache is disabled with --processes.
+"""
+import os
+import threading
+import collections
+from StringIO import StringIO
+
+from tornado.options import define
+
+from ms3 import metrics
+from ms3.commands import BucketEntry
+
+define("cache_size", default=0, type=int, metavar="BYTES",
+       help="Size of the in-memory cache of small objects (0 disables it)")
+define("cache_max_object_size", default=64 * 1024, type=int,
+       metavar="BYTES", help="Larger objects are never cached")
+
+
+requests = metrics.Counter(
+    "ms3_cache_requests_total", "Lookups of the object cache", ("result",))
+evictions = metrics.Counter(
+    "ms3_cache_evictions_total",
+    "Objects evicted from the object cache to make room for others")
+cached_bytes = metrics.Gauge(
+    "ms3_cache_bytes", "Bytes of object data in the object cache")
+cached_objects = metrics.Gauge(
+    "ms3_cache_objects", "Objects in the object cache")
+
+HIT = ("hit",)
+MISS = ("miss",)
+
+
+class CachedEntry(BucketEntry):
+    """ A BucketEntry whose data and metadata are kept in memory """
+    def __init__(self, entry, data):
+        self.name = entry.name
+        self.base_path = entry.base_path
+        self.key = entry.key
+        self.versioned = False
+        self.created_at = entry.created_at
+        self.stat = entry.stat
+        self.size = entry.size
+        self._version_id = entry._version_id
+        self._metadata = entry.metadata
+        self.data = data
+
+    def open(self):
+        return StringIO(self.data)
+
+    def read(self):
+        return self.data
+
+
+class ObjectCache(object):
+    """
+        LRU cache of CachedEntry, by (bucket path, key, version id). Shared
+        by the I/O threads.
+
+        Loads racing with an invalidation are not cached: every
+        invalidation increments the epoch, an entry read from disk is only
+        added if the epoch did not change meanwhile.
+    """
+    def __init__(self, max_bytes, max_object_size):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.size = 0
+        self.epoch = 0
+        self.entries = collections.OrderedDict()
+        # (bucket path, key) => version ids (None for the current version)
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, bucket_path, key, version_id=None):
+        with self.lock:
+            entry = self.entries.pop((bucket_path, key, version_id), None)
+            if entry is not None:
+                # most recently used last
+                self.entries[(bucket_path, key, version_id)] = entry
+        requests.inc(MISS if entry is None else HIT)
+        return entry
+
+    def load(self, bucket, key, version_id=None):
+        """
+            The entry of a key from the cache, or read from the bucket and
+            cached if small enough. None if the key does not exist.
+        """
+        entry = self.get(bucket.complete_path, key, version_id)
+        if entry is not None:
+            return entry
+        epoch = self.epoch
+        entry = bucket.get_entry(key, version_id=version_id)
+        if entry is None:
+            return None
+        entry.metadata
+        if (entry.size > min(self.max_object_size, self.max_bytes) or
+                entry.is_delete_marker):
+            return entry
+        try:
+            with entry.open() as fp:
+                # the file may have been replaced since it was stat'ed
+                if os.fstat(fp.fileno()).st_ino != entry.stat.st_ino:
+                    return entry
+                data = fp.read()
+        except (IOError, OSError):
+            return entry
+        cached = CachedEntry(entry, data)
+        self._add((bucket.complete_path, key, version_id), cached, epoch)
+        return cached
+
+    def _add(self, cache_key, entry, epoch):
+        with self.lock:
+            if epoch != self.epoch or cache_key in self.entries:
+                return
+            self.entries[cache_key] = entry
+            self.versions.setdefault(cache_key[:2], set()).add(cache_key[2])
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                evictions.inc()
+            self._update_gauges()
+
+    def _remove(self, cache_key):
+        """ Drop an entry, with the lock held """
+        entry = self.entries.pop(cache_key)
+        self.size -= entry.size
+        version_ids = self.versions[cache_key[:2]]
+        version_ids.discard(cache_key[2])
+        if not version_ids:
+            del self.versions[cache_key[:2]]
+
+    def _update_gauges(self):
+        cached_bytes.set(self.size)
+        cached_objects.set(len(self.entries))
+
+    def invalidate(self, bucket_path, key):
+        """ Forget all the cached versions of a key """
+        with self.lock:
+            self.epoch += 1
+            for version_id in list(self.versions.get((bucket_path, key), ())):
+                self._remove((bucket_path, key, version_id))
+            self._update_gauges()
+
+    def invalidate_bucket(self, bucket_path):
+        """ Forget all the cached keys of a bucket """
+        with self.lock:
+            self.epoch += 1
+            for cache_key in list(self.entries):
+                if cache_key[0] == bucket_path:
+                    self._remove(cache_key)
+            self._update_gauges()
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.versions.clear()
+            self.size = 0
+            self._update_gauges()
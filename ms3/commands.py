@@ -1,14 +1,41 @@
 """ AWS Related models and responses """
 import re
 import os
+import ast
 import time
+import errno
+import copy
+import json
+import bisect
+import uuid
+import fcntl
 import shutil
 import hashlib
+import threading
 import datetime
 import lxml.etree
+from stat import S_ISREG
+
+from ms3 import durability, metrics
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = getattr(os, "sendfile", None)
 
 XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
 
+# Files and directories used internally by ms3 inside the data directory
+# start with this prefix and are never exposed as keys
+INTERNAL_PREFIX = ".ms3"
+
+DEFAULT_CONTENT_TYPE = "binary/octet-stream"
+HASH_CHUNK_SIZE = 64 * 1024
+
+# levels of directories of the sharded layout, named after 2 hexadecimal
+# digits of the MD5 of the keys each
+SHARD_LEVELS = 2
+
 
 def t(tag, text, **attrs):
     """ Shorthand for creating an XML element with the provided text """
@@ -46,7 +73,7 @@ def httpdate(timestamp):
         Return a string representation of a date according to RFC 1123
         (HTTP/1.1). The supplied date must be in UTC.
     """
-    dt = datetime.datetime.fromtimestamp(timestamp)
+    dt = datetime.datetime.utcfromtimestamp(timestamp)
     weekday = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"][dt.weekday()]
     month = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep",
              "Oct", "Nov", "Dec"][dt.month - 1]
@@ -54,12 +81,392 @@ def httpdate(timestamp):
         weekday, dt.day, month, dt.year, dt.hour, dt.minute, dt.second)
 
 
-def xml_string(obj):
-    return lxml.etree.tostring(obj, pretty_print=True,
+def xml_string(obj, pretty_print=True):
+    return lxml.etree.tostring(obj, pretty_print=pretty_print,
                                     encoding="utf-8",
                                     xml_declaration=True)
 
 
+class ChunkBuffer(object):
+    """ File-like object collecting the output of an incremental writer """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def drain(self):
+        data = "".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def file_md5(path):
+    """ MD5 hex digest of a file, read in chunks """
+    md5 = hashlib.md5()
+    with metrics.filesystem.time(metrics.HASH):
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), ""):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def copy_file(source, destination):
+    """
+        Copy a file without going through the interpreter. Files written by
+        ms3 are never modified in place (new content is renamed over the old
+        file), so a hard link is a safe copy. Across file systems the data is
+        copied by the kernel with sendfile, or in chunks if not available.
+    """
+    try:
+        os.link(source, destination)
+        return
+    except OSError as exception:
+        if exception.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    with open(destination, "wb") as dest:
+        append_file(source, dest)
+
+
+def replace_file(source, destination):
+    """
+        Atomically move source over destination. rename does nothing when
+        both are links to the same file (identical data in a BlobStore), the
+        source is then removed.
+    """
+    os.rename(source, destination)
+    if os.path.lexists(source):
+        os.unlink(source)
+
+
+def append_file(source, dest):
+    """ Copy the content of a file at the current position of dest """
+    with open(source, "rb") as src:
+        position = dest.tell()
+        if sendfile is not None and _kernel_copy(src, dest):
+            return
+        dest.seek(position)
+        dest.truncate()
+        shutil.copyfileobj(src, dest, HASH_CHUNK_SIZE)
+
+
+def _kernel_copy(src, dest):
+    """ Copy with sendfile, returns False if unsupported for these files """
+    offset = 0
+    size = os.fstat(src.fileno()).st_size
+    dest.flush()
+    while offset < size:
+        try:
+            sent = sendfile(dest.fileno(), src.fileno(), offset,
+                            min(size - offset, 16 * HASH_CHUNK_SIZE))
+        except (OSError, IOError) as exception:
+            if offset == 0 and exception.errno in (errno.EINVAL,
+                                                   errno.ENOSYS):
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+    # sendfile wrote at the file descriptor position
+    dest.seek(0, os.SEEK_END)
+    return True
+
+
+class MetadataStore(object):
+    """
+        Per-object metadata (ETag, size, mtime and content type) kept in small
+        JSON sidecar files under the `.ms3meta` directory of a bucket.
+
+        A record is only trusted if size and mtime still match the object on
+        disk, so files dropped into the data directory by hand get their
+        metadata rebuilt the first time it is needed.
+    """
+    DIRNAME = INTERNAL_PREFIX + "meta"
+
+    def __init__(self, bucket_path):
+        self.bucket_path = bucket_path
+
+    def _path(self, name):
+        return os.path.join(self.bucket_path, self.DIRNAME, name)
+
+    def get(self, name, stat):
+        record = self.read(name)
+        if record is None:
+            return None
+        if (record.get("size") != stat.st_size or
+                record.get("mtime") != stat.st_mtime):
+            return None
+        return record
+
+    def read(self, name):
+        """ The stored record, even if outdated (None if there is none) """
+        try:
+            with open(self._path(name), "r") as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, name, stat, etag, content_type=None, version_id=None,
+            modified=None):
+        """
+            Store the record of an object. modified is the time the object
+            was stored, which differs from the mtime of the file when it is
+            a hard link to existing data.
+        """
+        record = {"etag": etag, "size": stat.st_size, "mtime": stat.st_mtime,
+                  "content_type": content_type or DEFAULT_CONTENT_TYPE,
+                  "version_id": version_id,
+                  "modified": modified or stat.st_mtime}
+        path = self._path(name)
+        make_entry_dir(path)
+        # write and rename, for concurrent writers and readers
+        temp_path = "%s.%s" % (path, uuid.uuid4().hex)
+        with open(temp_path, "w") as fp:
+            json.dump(record, fp)
+        # objects store their records under the lock of the bucket
+        durability.flush(temp_path, batched=False)
+        os.rename(temp_path, path)
+        return record
+
+    def delete(self, name, dirs=None):
+        remove_entry_dir(self._path(name), dirs)
+
+
+class BlobStore(object):
+    """
+        Content addressed store of object data, under the `.ms3blobs`
+        directory of the data directory. Objects with the same MD5 (their
+        ETag, so nothing is hashed again) are hard links to a single blob:
+        storing known data only costs a link and a metadata write.
+
+        The link count of a blob is its reference count, a blob with a
+        single link is no longer used by any object and can be removed.
+    """
+    DIRNAME = INTERNAL_PREFIX + "blobs"
+    DIGEST_RE = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, datadir):
+        self.base_path = os.path.join(datadir, self.DIRNAME)
+
+    def accepts(self, digest):
+        """ Whether objects with this ETag can be stored as blobs
+            (multipart ETags are not digests of the data) """
+        return bool(digest and self.DIGEST_RE.match(digest))
+
+    def _path(self, digest):
+        return os.path.join(self.base_path, digest[:2], digest)
+
+    def link(self, digest, path):
+        """ Link the blob to path, returns False if it is not stored """
+        try:
+            os.link(self._path(digest), path)
+        except OSError:
+            return False
+        return True
+
+    def add(self, digest, path):
+        """ Store the file at path as the blob of digest """
+        blob_path = self._path(digest)
+        make_entry_dir(blob_path)
+        try:
+            os.link(path, blob_path)
+        except OSError as exception:
+            # already stored by a concurrent write, or links unsupported:
+            # the object keeps its own copy
+            if exception.errno not in (errno.EEXIST, errno.EXDEV,
+                                       errno.EPERM, errno.EMLINK):
+                raise
+
+    def release(self, digest):
+        """ Remove the blob of digest if no object links to it anymore """
+        if self.accepts(digest):
+            self._remove_unused(self._path(digest))
+
+    def _remove_unused(self, blob_path):
+        try:
+            if os.stat(blob_path).st_nlink == 1:
+                os.unlink(blob_path)
+        except OSError:
+            pass
+
+    def collect(self):
+        """ Remove all the unused blobs, returns how many were removed """
+        removed = 0
+        for directory, _, files in os.walk(self.base_path):
+            for name in files:
+                blob_path = os.path.join(directory, name)
+                self._remove_unused(blob_path)
+                if not os.path.exists(blob_path):
+                    removed += 1
+        return removed
+
+
+def link_tree(source, destination, skip=None):
+    """
+        Recreate the directory tree of source at destination, with hard
+        links to its files (see copy_file). Files and directories whose
+        name matches skip(name) are left out, as are files removed while
+        the tree is walked.
+    """
+    os.makedirs(destination)
+    for root, dirs, files in os.walk(source):
+        if skip:
+            dirs[:] = [d for d in dirs if not skip(d)]
+            files = [f for f in files if not skip(f)]
+        target = os.path.join(destination, os.path.relpath(root, source))
+        for d in dirs:
+            os.mkdir(os.path.join(target, d))
+        for f in files:
+            try:
+                copy_file(os.path.join(root, f), os.path.join(target, f))
+            except (IOError, OSError) as exception:
+                if exception.errno != errno.ENOENT:
+                    raise
+
+
+class SnapshotStore(object):
+    """
+        Named snapshots of a data directory, under its `.ms3snapshots`
+        directory. A snapshot is a tree of hard links to the files of the
+        buckets (and of the BlobStore): files are never modified in place,
+        so neither taking nor restoring a snapshot copies any object data.
+
+        A bucket is locked while it is linked, a snapshot is consistent per
+        bucket. Restoring is meant to happen between tests, while no request
+        is in progress.
+    """
+    DIRNAME = INTERNAL_PREFIX + "snapshots"
+    NAME_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.base_path = os.path.join(datadir, self.DIRNAME)
+
+    def _path(self, name):
+        if not self.NAME_RE.match(name or ""):
+            raise ValueError("Invalid snapshot name %r" % name)
+        return os.path.join(self.base_path, name)
+
+    @staticmethod
+    def _skip(name):
+        """ The lock (and generation) of the buckets and the temporary
+            files of the writes in progress are not part of a snapshot """
+        return (name == BucketLock.FILENAME or
+                name.startswith(INTERNAL_PREFIX + "-"))
+
+    def _entries(self, path):
+        """ The buckets (and internal directories) of a data directory """
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return []
+        return sorted(name for name in names
+                      if name != self.DIRNAME and not self._skip(name))
+
+    def _temp_path(self, directory, purpose):
+        return os.path.join(directory, "%s-%s-%s" % (
+            INTERNAL_PREFIX, purpose, uuid.uuid4().hex))
+
+    def _discard(self, path):
+        """ Move a tree out of the way, then remove it """
+        trash_path = self._temp_path(os.path.dirname(path), "trash")
+        try:
+            os.rename(path, trash_path)
+        except OSError:
+            return False
+        shutil.rmtree(trash_path, True)
+        return True
+
+    def info(self, name):
+        try:
+            created_at = os.stat(self._path(name)).st_mtime
+        except OSError:
+            return None
+        return {"name": name, "created_at": created_at}
+
+    def list(self):
+        """ The info of the snapshots, by name """
+        try:
+            names = sorted(os.listdir(self.base_path))
+        except OSError:
+            return []
+        return [info for info in (self.info(name) for name in names
+                                  if self.NAME_RE.match(name)) if info]
+
+    def take(self, name):
+        """ Snapshot the data directory, replacing a snapshot of that name """
+        path = self._path(name)
+        temp_path = self._temp_path(self.base_path, "tmp")
+        os.makedirs(temp_path)
+        try:
+            for entry in self._entries(self.datadir):
+                source = os.path.join(self.datadir, entry)
+                if not os.path.isdir(source):
+                    continue
+                if is_internal(entry):
+                    link_tree(source, os.path.join(temp_path, entry))
+                    continue
+                with BucketLock.for_bucket(source):
+                    link_tree(source, os.path.join(temp_path, entry),
+                              self._skip)
+            self._discard(path)
+            os.rename(temp_path, path)
+        except Exception:
+            shutil.rmtree(temp_path, True)
+            raise
+        return self.info(name)
+
+    def restore(self, name):
+        """
+            Replace the buckets of the data directory by those of a
+            snapshot, returns False if there is no such snapshot
+        """
+        path = self._path(name)
+        if not os.path.isdir(path):
+            return False
+        staged_path = self._temp_path(self.datadir, "restore")
+        os.makedirs(staged_path)
+        try:
+            for entry in self._entries(path):
+                link_tree(os.path.join(path, entry),
+                          os.path.join(staged_path, entry))
+            trash_path = self._temp_path(self.datadir, "trash")
+            os.mkdir(trash_path)
+            for entry in self._entries(self.datadir):
+                current = os.path.join(self.datadir, entry)
+                # the lock file keeps counting the generations of the bucket
+                lock_path = os.path.join(current, BucketLock.FILENAME)
+                if os.path.exists(os.path.join(staged_path, entry)):
+                    try:
+                        os.rename(lock_path, os.path.join(
+                            staged_path, entry, BucketLock.FILENAME))
+                    except OSError:
+                        pass
+                os.rename(current, os.path.join(trash_path, entry))
+            restored = self._entries(staged_path)
+            for entry in restored:
+                os.rename(os.path.join(staged_path, entry),
+                          os.path.join(self.datadir, entry))
+        finally:
+            shutil.rmtree(staged_path, True)
+        KeyIndex.drop(self.datadir)
+        # the other processes reload the indexes of the restored buckets
+        for entry in restored:
+            if not is_internal(entry):
+                with BucketLock.for_bucket(
+                        os.path.join(self.datadir, entry)) as lock:
+                    lock.bump()
+        shutil.rmtree(trash_path, True)
+        return True
+
+    def delete(self, name):
+        """ Remove a snapshot, returns False if there is none of that name """
+        return self._discard(self._path(name))
+
+
 class AWSObject(object):
     pass
 
@@ -68,21 +475,41 @@ def compare_entries(entryA, entryB):
     return cmp(entryA.version_id, entryB.version_id)
 
 
+_last_version_id = [0.0]
+_version_id_lock = threading.Lock()
+
+
+def new_version_id(previous=None):
+    """
+        A version id (timestamp) greater than all the previous ones of this
+        process and than `previous` (the latest version id of the key, as
+        other processes may share the data directory)
+    """
+    with _version_id_lock:
+        version = max(time.time(), _last_version_id[0] + 0.000001)
+        if previous is not None:
+            version = max(version, float(previous) + 0.000001)
+        _last_version_id[0] = version
+    return "%.6f" % version
+
+
+def is_version_id(version_id):
+    """
+        Whether version_id may be one of new_version_id. The version ids of
+        the requests are checked before they are joined into paths.
+    """
+    return bool(Bucket.VERSION_ID_RE.match(version_id or ""))
+
+
 class Entry(AWSObject):
     """ Base class for an AWS S3 Object """
     @property
     def complete_path(self):
         return os.path.join(self.base_path, self.name)
 
-    def __init__(self, name, base_path, versioned=False):
+    def __init__(self, name, base_path):
         self.versioned = False
         self.name = name
-        self.key = name
-        self.version_id = None
-        if versioned:
-            self.key = re.sub("\.\d+\.\d+$", "", self.key)
-            self.version_id = float(re.search(".(\d+.\d+)$", name).group(1))
-            self.is_latest = False
         self.base_path = base_path
         self.created_at = None
         if base_path:
@@ -90,7 +517,8 @@ class Entry(AWSObject):
 
     def _complete_metadata(self):
         entry_path = os.path.join(self.base_path, self.name)
-        stat = os.stat(entry_path)
+        with metrics.filesystem.time(metrics.STAT):
+            stat = os.stat(entry_path)
         self.created_at = stat.st_ctime
         return stat
 
@@ -99,34 +527,78 @@ class Entry(AWSObject):
 
 
 class BucketEntry(Entry):
-    """ Represents an object (key) in AWS terminology """
+    """
+        Represents an object (key) in AWS terminology. The name is the path
+        of the file relative to the bucket directory, which is the key itself
+        unless the entry is a stored version of the key.
+    """
+    _metadata = None
+
+    def __init__(self, name, base_path, key=None, version_id=None):
+        self.key = key or name
+        self._version_id = version_id
+        super(BucketEntry, self).__init__(name, base_path)
+
+    @property
+    def version_id(self):
+        if self._version_id is None:
+            # the current version of a versioned key records it's version
+            return self.metadata.get("version_id")
+        return self._version_id
+
+    @property
+    def is_delete_marker(self):
+        return self.size == 0 and self._version_id is not None
+
+    @property
+    def metadata(self):
+        """ The stored metadata record, rebuilt if missing or outdated """
+        if self._metadata is None:
+            store = MetadataStore(self.base_path)
+            self._metadata = store.get(self.name, self.stat)
+            if self._metadata is None:
+                self._metadata = store.put(self.name, self.stat,
+                                           file_md5(self.complete_path),
+                                           version_id=self._version_id)
+        return self._metadata
+
     @property
     def etag(self):
-        with open(self.complete_path, "r") as fp:
-            return hashlib.md5(fp.read()).hexdigest()
+        return self.metadata["etag"]
+
+    @property
+    def modified_at(self):
+        return self.metadata.get("modified") or self.stat.st_mtime
+
+    @property
+    def content_type(self):
+        return self.metadata["content_type"]
 
     def _complete_metadata(self):
         stat = super(BucketEntry, self)._complete_metadata()
+        self.stat = stat
         self.size = stat.st_size
-        self.modified_at = stat.st_mtime
         return stat
 
+    def open(self):
+        return open(self.complete_path, "rb")
+
     def read(self):
-        with open(os.path.join(self.base_path, self.name), "rb") as fp:
+        with self.open() as fp:
             return fp.read()
 
-    def xml(self, versions=False):
+    def xml(self, versions=False, is_latest=False):
         result = None
         if not versions:
             result = e("Contents")
         else:
-            if self.size > 0:
-                tag = "Version"
-            else:
+            if self.is_delete_marker:
                 tag = "DeleteMarker"
+            else:
+                tag = "Version"
             result = e(tag,
-                       t("VersionId", "%.6f" % self.version_id),
-                       t("IsLatest", self.is_latest))
+                       t("VersionId", self.version_id),
+                       t("IsLatest", "true" if is_latest else "false"))
         ea(result,
            t("Key", self.key),
            t("LastModified", as_date(self.modified_at)),
@@ -137,17 +609,34 @@ class BucketEntry(Entry):
         return result
 
     def set_headers(self, handler):
-        handler.set_header('Last-Modified', httpdate(self.created_at))
+        handler.set_header('Content-Type', self.content_type)
+        handler.set_header('ETag', '"%s"' % self.etag)
+        handler.set_header('Last-Modified', httpdate(self.modified_at))
         handler.set_header('Access-Control-Allow-Origin', '*')
         handler.set_header('Access-Control-Allow-Headers', '*')
+        if self.version_id:
+            handler.set_header('x-amz-version-id', self.version_id)
 
 
-def is_more_recent(entryA, entryB):
-    if entryA is None:
-        return True
-    v1 = int(entryA.name.split(".")[-1])
-    v2 = int(entryB.name.split(".")[-1])
-    return v2 > v1
+def shard_path(key):
+    """ The shard directories of a key in a sharded bucket, "ab/cd" """
+    digest = hashlib.md5(key).hexdigest()
+    return os.path.join(*[digest[2 * i:2 * i + 2]
+                          for i in xrange(SHARD_LEVELS)])
+
+
+def is_internal(path):
+    """ Check if a path relative to a bucket is used internally by ms3 """
+    return path.split("/", 1)[0].startswith(INTERNAL_PREFIX)
+
+
+def is_valid_key(key):
+    """
+        Whether a key can be stored: the keys naming the internal files of
+        ms3 or leaving the directory of the bucket would overwrite them
+    """
+    return not (is_internal(key) or
+                any(part in (".", "..") for part in key.split("/")))
 
 
 def make_entry_dir(entry_path):
@@ -158,33 +647,532 @@ def make_entry_dir(entry_path):
         pass
 
 
-def remove_entry_dir(entry_path):
+def remove_entry_dir(entry_path, dirs=None):
+    """
+        Remove a file and its directory if empty. With dirs, the directory
+        is only added to it, for a single prune_dirs pass after a batch.
+    """
     try:
         os.unlink(entry_path)
     except OSError:
         pass
     dirname = os.path.dirname(entry_path)
+    if dirs is not None:
+        dirs.add(dirname)
+        return
     try:
         os.rmdir(dirname)
     except OSError:
         pass
 
 
-class Bucket(Entry):
+def prune_dirs(dirs, root):
+    """
+        Remove the empty directories of dirs and their empty parents, up to
+        root (excluded). Level by level from the deepest, so each directory
+        is tried once, after all its children.
+    """
+    pending = set(d for d in dirs if d.startswith(root + os.sep))
+    while pending:
+        depth = max(d.count(os.sep) for d in pending)
+        for dirname in [d for d in pending if d.count(os.sep) == depth]:
+            pending.discard(dirname)
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                continue
+            parent = os.path.dirname(dirname)
+            if parent.startswith(root + os.sep):
+                pending.add(parent)
+
+
+class BucketLock(object):
+    """
+        Lock serializing the updates of a bucket between the I/O threads
+        (see ms3.executor) and between the processes sharing the data
+        directory (with --processes).
 
-    METADATA = "metadata"
-    METADATA_PROPS = ["versioned"]
+        The lock is re-entrant. The lock file also holds the generation of
+        the bucket, a counter incremented by every update, which tells the
+        processes when their in-memory key indexes are stale.
+    """
+    FILENAME = INTERNAL_PREFIX + "lock"
+    GENERATION_FORMAT = "%020d"
 
-    def __init__(self, name, base_path):
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, bucket_path):
+        self.path = os.path.join(bucket_path, self.FILENAME)
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.fp = None
+
+    @classmethod
+    def for_bucket(cls, bucket_path):
+        with cls._locks_lock:
+            lock = cls._locks.get(bucket_path)
+            if lock is None:
+                lock = cls._locks[bucket_path] = cls(bucket_path)
+        return lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                self.fp = open(self.path, "a+")
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+            except Exception:
+                if self.fp is not None:
+                    self.fp.close()
+                    self.fp = None
+                self.lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            # closing the file releases the flock
+            self.fp.close()
+            self.fp = None
+        self.lock.release()
+
+    def generation(self):
+        """ The current generation of the bucket (0 if never updated) """
+        try:
+            with open(self.path, "r") as fp:
+                return int(fp.read(len(self.GENERATION_FORMAT % 0)) or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def bump(self):
+        """ Increment the generation, must be called with the lock held """
+        generation = self.generation() + 1
+        os.ftruncate(self.fp.fileno(), 0)
+        os.write(self.fp.fileno(), self.GENERATION_FORMAT % generation)
+        return generation
+
+
+class KeyIndex(object):
+    """
+        Sorted in-memory index of the object files of a bucket (paths
+        relative to the bucket directory).
+
+        Indexes are built lazily on first access with a walk of the bucket
+        directory and are kept up to date by the `Bucket` write operations.
+        Prefix queries are a bisect followed by a range scan. Use `rescan` to
+        pick up files that were changed outside ms3.
+
+        Indexes are shared by the I/O threads (see ms3.executor), all the
+        accesses to the names hold the index lock.
+
+        With the BucketLock of the bucket, the names are loaded with the
+        generation of the bucket, the updates made by this process then
+        keep them (see updated) and those of other processes drop them (see
+        sync).
+
+        The index of a sharded bucket indexes its shards directory, the
+        names are the paths below the shard directories.
+    """
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, bucket_path, ignore=(), sharded=False,
+                 bucket_lock=None):
+        self.bucket_path = bucket_path
+        self.ignore = set(ignore)
+        self.sharded = sharded
+        self.bucket_lock = bucket_lock
+        self.names = None
+        self.generation = None
+        self.lock = threading.RLock()
+
+    @classmethod
+    def for_bucket(cls, bucket_path, ignore=(), sharded=False,
+                   bucket_lock=None):
+        with cls._indexes_lock:
+            index = cls._indexes.get(bucket_path)
+            if index is None:
+                index = cls._indexes[bucket_path] = cls(
+                    bucket_path, ignore, sharded, bucket_lock)
+        return index
+
+    @classmethod
+    def drop(cls, path):
+        """ Forget the indexes of a bucket or of all buckets below a path """
+        prefix = path.rstrip("/") + "/"
+        with cls._indexes_lock:
+            for bucket_path in cls._indexes.keys():
+                if bucket_path == path or bucket_path.startswith(prefix):
+                    del cls._indexes[bucket_path]
+
+    def rescan(self):
+        with self.lock, metrics.filesystem.time(metrics.WALK):
+            if self.bucket_lock is not None:
+                # read first, the names are at least that recent
+                self.generation = self.bucket_lock.generation()
+            self.names = self._scan()
+
+    def sync(self, generation):
+        """
+            Forget the names if the bucket was updated (possibly by another
+            process) since they were loaded
+        """
+        with self.lock:
+            if self.generation != generation:
+                self.names = None
+                self.generation = generation
+
+    def updated(self, generation):
+        """
+            Record an update of the bucket made by this process, which was
+            already applied to the names
+        """
+        with self.lock:
+            if self.generation == generation - 1:
+                self.generation = generation
+            else:
+                self.names = None
+                self.generation = None
+
+    def _scan(self):
+        names = []
+        for root, dirs, files in os.walk(self.bucket_path):
+            if root == self.bucket_path:
+                dirs[:] = [d for d in dirs if not is_internal(d)]
+                files = [f for f in files
+                         if f not in self.ignore and not is_internal(f)]
+            relative_root = os.path.relpath(root, self.bucket_path)
+            for f in files:
+                if relative_root != ".":
+                    f = os.path.join(relative_root, f)
+                f = self._key_name(f)
+                if f is not None:
+                    names.append(f)
+        names.sort()
+        return names
+
+    def _key_name(self, relative_path):
+        """ The key of a path relative to the indexed directory """
+        if not self.sharded:
+            return relative_path
+        parts = relative_path.split(os.sep, SHARD_LEVELS)
+        if len(parts) <= SHARD_LEVELS:
+            return None
+        return parts[SHARD_LEVELS]
+
+    def _loaded_names(self):
+        if self.names is None:
+            self.rescan()
+        return self.names
+
+    def add(self, name):
+        with self.lock:
+            names = self._loaded_names()
+            position = bisect.bisect_left(names, name)
+            if position == len(names) or names[position] != name:
+                names.insert(position, name)
+
+    def remove(self, name):
+        with self.lock:
+            names = self._loaded_names()
+            position = bisect.bisect_left(names, name)
+            if position < len(names) and names[position] == name:
+                del names[position]
+
+    def __contains__(self, name):
+        with self.lock:
+            names = self._loaded_names()
+            position = bisect.bisect_left(names, name)
+            return position < len(names) and names[position] == name
+
+    def names_after(self, after=None, prefix=None, limit=None):
+        """
+            Up to limit names starting with prefix that sort after `after`,
+            in lexicographic order
+        """
+        with self.lock:
+            names = self._loaded_names()
+            start = bisect.bisect_left(names, prefix or "")
+            if after is not None:
+                start = max(start, bisect.bisect_right(names, after))
+            end = len(names) if limit is None else start + limit
+            results = names[start:end]
+        if prefix and results and not results[-1].startswith(prefix):
+            results = [name for name in results if name.startswith(prefix)]
+        return results
+
+
+class VersionIndex(KeyIndex):
+    """
+        Sorted index of the keys that have stored versions, i.e. of the
+        directories below the versions directory of a bucket which hold
+        version files.
+    """
+    def _scan(self):
+        keys = []
+        for root, dirs, files in os.walk(self.bucket_path):
+            if any(Bucket.VERSION_ID_RE.match(f) for f in files):
+                key = self._key_name(os.path.relpath(root, self.bucket_path))
+                if key is not None:
+                    keys.append(key)
+        keys.sort()
+        return keys
+
+
+class Listing(AWSObject):
+    """ One page of a bucket listing """
+    def __init__(self, prefix=None, marker=None, delimiter=None,
+                 max_keys=None, version_id_marker=None):
+        self.prefix = prefix
+        self.marker = marker
+        self.version_id_marker = version_id_marker
+        self.delimiter = delimiter
+        self.max_keys = max_keys
+        self.entries = []
+        self.common_prefixes = []
+        self.is_truncated = False
+        self.next_marker = None
+        self.next_version_id_marker = None
+        # (key, version id) of the listed versions which are the latest
+        self.latest = set()
+
+    def is_full(self):
+        return (self.max_keys is not None and
+                len(self.entries) + len(self.common_prefixes) >= self.max_keys)
+
+    def truncate(self):
+        self.is_truncated = True
+        if self.entries and (not self.common_prefixes or
+                             self.entries[-1].key > self.common_prefixes[-1]):
+            last = self.entries[-1]
+            self.next_marker = last.key
+            if last.version_id is not None:
+                self.next_version_id_marker = last.version_id
+        elif self.common_prefixes:
+            self.next_marker = self.common_prefixes[-1]
+
+
+class BucketListing(object):
+    """
+        Paginated listings of a bucket, shared by the storage engines.
+
+        Buckets provide `index` (the keys with a current version) and
+        `version_index` (the keys with stored versions) as KeyIndex,
+        `get_entry(key, version_id=None)` and `_version_ids(key)`, newest
+        first.
+    """
+    def rescan(self):
+        """ Rebuild the key indexes from the stored data """
+        pass
+
+    def _sync_indexes(self):
+        pass
+
+    LIST_BATCH = 256
+
+    def _keys(self, index, prefix=None, after=None, inclusive=False):
+        """
+            Yield the keys of an index sorting after `after` (or equal to it
+            if inclusive). The index is read in batches so the cost is
+            proportional to what is consumed.
+        """
+        position = after
+        if (inclusive and after is not None and
+                after.startswith(prefix or "") and after in index):
+            yield after
+        while True:
+            batch = index.names_after(position, prefix, self.LIST_BATCH)
+            if not batch:
+                break
+            for key in batch:
+                yield key
+            position = batch[-1]
+
+    def _paginate(self, listing, index, add_key, inclusive=False,
+                  rescan=False):
+        """
+            Walk the keys after the listing marker, rolling them up into
+            common prefixes if a delimiter is given. add_key(key) adds the
+            entries of a key to the listing and returns False if the page
+            is full.
+        """
+        if listing.max_keys == 0:
+            # an empty page, not truncated (as S3 does)
+            return listing
+        if rescan:
+            self.rescan()
+        else:
+            self._sync_indexes()
+        prefix = listing.prefix or ""
+        after = listing.marker or None
+        keys = self._keys(index, prefix, after, inclusive)
+        while keys is not None:
+            restart = None
+            for key in keys:
+                position = -1
+                if listing.delimiter:
+                    position = key.find(listing.delimiter, len(prefix))
+                if position == -1:
+                    if not add_key(key):
+                        listing.truncate()
+                        return listing
+                    continue
+                common_prefix = key[:position + len(listing.delimiter)]
+                if after is None or common_prefix > after:
+                    if listing.is_full():
+                        listing.truncate()
+                        return listing
+                    listing.common_prefixes.append(common_prefix)
+                # skip all the other keys sharing this common prefix
+                restart = common_prefix + "\xff"
+                break
+            keys = None
+            if restart is not None:
+                keys = self._keys(index, prefix, restart)
+        return listing
+
+    def list_page(self, prefix=None, marker=None, delimiter=None,
+                  max_keys=None, rescan=False):
+        """ A page of the current version of each key (ListObjects) """
+        listing = Listing(prefix, marker, delimiter, max_keys)
+        index = self.index
+
+        def add_key(key):
+            entry = self.get_entry(key)
+            if entry is None:
+                # removed behind our back
+                index.remove(key)
+                return True
+            if listing.is_full():
+                return False
+            # load the metadata now rather than while rendering
+            entry.metadata
+            listing.entries.append(entry)
+            return True
+
+        return self._paginate(listing, index, add_key, rescan=rescan)
+
+    def list_versions_page(self, prefix=None, key_marker=None,
+                           version_id_marker=None, delimiter=None,
+                           max_keys=None, rescan=False):
+        """ A page of all the versions of each key (ListObjectVersions) """
+        listing = Listing(prefix, key_marker, delimiter, max_keys,
+                          version_id_marker)
+        # with a version id marker, listing continues inside key_marker
+        inclusive = bool(key_marker and version_id_marker)
+
+        def add_key(key):
+            version_ids = self._version_ids(key)
+            if not version_ids:
+                self.version_index.remove(key)
+            is_latest = True
+            for version_id in version_ids:
+                if (inclusive and key == key_marker and
+                        version_id >= version_id_marker):
+                    is_latest = False
+                    continue
+                if listing.is_full():
+                    return False
+                entry = self.get_entry(key, version_id)
+                if entry is None:
+                    continue
+                if is_latest:
+                    listing.latest.add((key, version_id))
+                is_latest = False
+                entry.metadata
+                listing.entries.append(entry)
+            return True
+
+        return self._paginate(listing, self.version_index, add_key,
+                              inclusive, rescan)
+
+    def list(self, prefix=None, rescan=False):
+        return self.list_page(prefix=prefix, rescan=rescan).entries
+
+    def list_versions(self, prefix=None, rescan=False):
+        return self.list_versions_page(prefix=prefix, rescan=rescan).entries
+
+    def xml(self):
+        return e("Bucket",
+                 t("Name", self.name),
+                 t("CreationDate", as_date(self.created_at)))
+
+
+class Bucket(BucketListing, Entry):
+    """
+        A bucket is a directory below the data directory. Objects are stored
+        as files at the path of their key.
+
+        Versions of the keys of versioned buckets are stored in a directory
+        per key below VERSIONS (<bucket>/.ms3versions/<key>/<version id>),
+        delete markers being empty version files. The current version is
+        hard linked at the path of the key, so reading the latest version
+        costs the same as in an unversioned bucket.
+
+        In a sharded bucket, the objects are stored below SHARDS in
+        directories named after the MD5 of their key
+        (<bucket>/.ms3shards/ab/cd/<key>), as are the version directories
+        (<bucket>/.ms3versions/ab/cd/<key>/<version id>). A bucket of
+        millions of keys without "/" does not end up as a single huge
+        directory. The key indexes are still sorted by key.
+
+        With a cache (see ms3.cache.ObjectCache), the writes and deletions
+        invalidate the cached versions of their key.
+    """
+
+    # bucket settings, as JSON (METADATA is the legacy "name=value" file)
+    SETTINGS = INTERNAL_PREFIX + "bucket"
+    METADATA = "metadata"
+    METADATA_PROPS = ["versioned", "layout", "sharded"]
+    VERSIONS = INTERNAL_PREFIX + "versions"
+    SHARDS = INTERNAL_PREFIX + "shards"
+    VERSION_ID_RE = re.compile(r"^\d+\.\d+$")
+
+    # layout of the versions on disk: 1 stored them next to the keys as
+    # "<key>.<version id>", 2 uses a directory per key
+    LAYOUT = 2
+    layout = LAYOUT
+    sharded = False
+
+    def __init__(self, name, base_path, blob_store=None, cache=None):
+        self.blob_store = blob_store
+        self.cache = cache
         super(Bucket, self).__init__(name, base_path)
 
     def _complete_metadata(self):
         stat = super(Bucket, self)._complete_metadata()
-        metadata_path = os.path.join(self.complete_path, self.METADATA)
-        self._parse_metadata(metadata_path)
+        self._read_settings()
+        if self.layout < self.LAYOUT:
+            with self.lock:
+                # another process may have migrated the bucket meanwhile
+                self._read_settings()
+                if self.layout < self.LAYOUT:
+                    self.migrate_versions()
         return stat
 
+    def _read_settings(self):
+        try:
+            with open(os.path.join(self.complete_path, self.SETTINGS),
+                      "r") as fp:
+                settings = json.load(fp)
+        except (IOError, OSError, ValueError):
+            self._parse_metadata(os.path.join(self.complete_path,
+                                              self.METADATA))
+            return
+        for key in self.METADATA_PROPS:
+            if key in settings:
+                setattr(self, key, settings[key])
+
     def _parse_metadata(self, path):
+        """
+            Read the legacy metadata file (of buckets written by older
+            versions), its values are Python literals. Only versioned
+            buckets have versions to migrate: in the others, "app.1.0" is
+            a key, not a version of "app".
+        """
         if not os.path.exists(path):
             return
         with open(path, "r") as fp:
@@ -194,7 +1182,11 @@ class Bucket(Entry):
                     continue
                 key, value = args
                 if key in self.METADATA_PROPS:
-                    setattr(self, key, eval(value))
+                    try:
+                        setattr(self, key, ast.literal_eval(value.strip()))
+                    except (SyntaxError, ValueError):
+                        pass
+        self.layout = 1 if self.versioned else self.LAYOUT
 
     def enable_versioning(self):
         self.versioned = True
@@ -205,108 +1197,707 @@ class Bucket(Entry):
         self._write_metadata()
 
     def _write_metadata(self):
-        metadata_path = os.path.join(self.complete_path, self.METADATA)
-        with open(metadata_path, "w") as fp:
-            for key in self.METADATA_PROPS:
-                fp.write("%s=%s\n" % (key, repr(getattr(self, key))))
+        temp_path = self._temp_path()
+        with open(temp_path, "w") as fp:
+            json.dump(dict((key, getattr(self, key))
+                           for key in self.METADATA_PROPS), fp)
+        durability.flush(temp_path)
+        os.rename(temp_path, os.path.join(self.complete_path, self.SETTINGS))
+        durability.commit([self.complete_path])
+        # the settings now replace the legacy file
+        try:
+            os.unlink(os.path.join(self.complete_path, self.METADATA))
+        except OSError:
+            pass
+
+    def migrate_versions(self):
+        """
+            Move versions stored with the old "<key>.<version id>" naming
+            into the per-key version directories
+        """
+        legacy_re = re.compile(r"^(.*)\.(\d+\.\d+)$")
+        migrated = set()
+        for name in KeyIndex(self.complete_path,
+                             [self.METADATA]).names_after():
+            match = legacy_re.match(name)
+            if not match:
+                continue
+            key, version_id = match.groups()
+            version_path = self._version_path(key, version_id)
+            make_entry_dir(version_path)
+            os.rename(os.path.join(self.complete_path, name), version_path)
+            remove_entry_dir(os.path.join(self.complete_path, name))
+            self.metadata_store.delete(name)
+            migrated.add(key)
+        for key in migrated:
+            self._update_latest(key)
+        self.layout = self.LAYOUT
+        self._write_metadata()
+        self._updated()
+
+    def set_sharded(self, sharded):
+        """
+            Move the objects and their versions to the sharded layout, or
+            back to paths of their keys. Meant to run offline (see
+            ms3.sharding): the files are renamed one by one, readers see a
+            partially converted bucket meanwhile. Returns the number of
+            keys moved, None if the bucket already has this layout.
+
+            If a rename fails, the files already moved are moved back. The
+            settings are only written once all the files are moved, so a
+            conversion interrupted otherwise is completed by running it
+            again (the files already moved are left in place).
+        """
+        with self.lock:
+            if self.sharded == sharded:
+                return None
+            self.rescan()
+            keys = self.index.names_after()
+            version_keys = self.version_index.names_after()
+            if not sharded:
+                self._check_unsharded_keys(keys)
+            dirs = set()
+            moved = []
+            try:
+                for key in keys:
+                    self._move(self._object_name(key), self._object_name(
+                        key, sharded), dirs, moved)
+                for key in version_keys:
+                    source = self._versions_name(key)
+                    destination = self._versions_name(key, sharded)
+                    # the versions of "x/y" may be below those of "x"
+                    for version_id in self._version_ids(key):
+                        self._move(os.path.join(source, version_id),
+                                   os.path.join(destination, version_id),
+                                   dirs, moved)
+            except (IOError, OSError):
+                self._move_back(moved, dirs)
+                raise
+            finally:
+                prune_dirs(dirs, self.complete_path)
+                KeyIndex.drop(self.complete_path)
+            self.sharded = sharded
+            self._write_metadata()
+            self._updated()
+            self._invalidate()
+        return len(keys)
+
+    @staticmethod
+    def _check_unsharded_keys(keys):
+        """
+            Raise ValueError if keys can't all be files at their paths, as
+            "x" and "x/y" (keys is sorted, "x/y" may not follow "x")
+        """
+        for key in keys:
+            position = bisect.bisect_left(keys, key + "/")
+            if position < len(keys) and keys[position].startswith(key + "/"):
+                raise ValueError("Keys %r and %r conflict without sharding" %
+                                 (key, keys[position]))
+
+    def _move(self, name, new_name, dirs, moved):
+        """ Rename an object file and its metadata record, the renames are
+            added to moved """
+        metadata_store = self.metadata_store
+        for source, destination in [
+                (os.path.join(self.complete_path, name),
+                 os.path.join(self.complete_path, new_name)),
+                (metadata_store._path(name), metadata_store._path(new_name))]:
+            if not os.path.lexists(source):
+                continue
+            make_entry_dir(destination)
+            os.rename(source, destination)
+            moved.append((source, destination))
+            dirs.add(os.path.dirname(source))
+
+    def _move_back(self, moved, dirs):
+        """ Undo the renames of a failed conversion, as far as possible """
+        for source, destination in reversed(moved):
+            try:
+                make_entry_dir(source)
+                os.rename(destination, source)
+            except OSError:
+                continue
+            dirs.add(os.path.dirname(destination))
+
+    def _invalidate(self, key=None):
+        """ Drop a key (or all the keys) of the bucket from the cache """
+        if self.cache is None:
+            return
+        if key is None:
+            self.cache.invalidate_bucket(self.complete_path)
+        else:
+            self.cache.invalidate(self.complete_path, key)
 
     def delete(self):
         shutil.rmtree(self.complete_path, False)
+        KeyIndex.drop(self.complete_path)
+        self._invalidate()
+        if self.blob_store:
+            self.blob_store.collect()
 
     @classmethod
-    def create(cls, name, datadir):
+    def create(cls, name, datadir, blob_store=None, sharded=False,
+               cache=None):
         try:
             os.makedirs(os.path.join(datadir, name))
         except (OSError, IOError):
             return None
-        return Bucket(name, datadir)
+        KeyIndex.drop(os.path.join(datadir, name))
+        bucket = Bucket(name, datadir, blob_store, cache)
+        if sharded:
+            bucket.sharded = True
+            bucket._write_metadata()
+        return bucket
 
     @classmethod
-    def get_all_buckets(cls, base_path):
+    def get_all_buckets(cls, base_path, blob_store=None):
         results = []
         for entry in os.listdir(base_path):
-            results.append(cls(entry, base_path=base_path))
+            if not is_internal(entry):
+                results.append(cls(entry, base_path, blob_store))
         return results
 
+    def _object_name(self, key, sharded=None):
+        """ The path of the object of a key, relative to the bucket """
+        if self.sharded if sharded is None else sharded:
+            return os.path.join(self.SHARDS, shard_path(key), key)
+        return key
+
+    def _versions_name(self, key, sharded=None):
+        """ The directory of the versions of a key, relative to the bucket """
+        if self.sharded if sharded is None else sharded:
+            return os.path.join(self.VERSIONS, shard_path(key), key)
+        return os.path.join(self.VERSIONS, key)
+
+    def _key_path(self, key):
+        return os.path.join(self.complete_path, self._object_name(key))
+
+    def _version_name(self, key, version_id):
+        return os.path.join(self._versions_name(key), version_id)
+
+    def _version_path(self, key, version_id):
+        return os.path.join(self.complete_path,
+                            self._version_name(key, version_id))
+
+    def _version_ids(self, key):
+        """ The ids of the stored versions of a key, newest first """
+        directory = os.path.join(self.complete_path, self._versions_name(key))
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        # the versions of "x/1.5" are in a directory below those of "x"
+        return sorted([name for name in names
+                       if self.VERSION_ID_RE.match(name) and os.path.isfile(
+                           os.path.join(directory, name))], reverse=True)
+
+    def _latest_version_id(self, key):
+        version_ids = self._version_ids(key)
+        if version_ids:
+            return version_ids[0]
+        return None
+
     def get_entry(self, key, version_id=None):
-        if self.versioned:
+        if version_id and not is_version_id(version_id):
+            return None
+        try:
             if version_id:
-                key = "%s.%s" % (key, version_id)
+                entry = BucketEntry(self._version_name(key, version_id),
+                                    self.complete_path, key=key,
+                                    version_id=version_id)
             else:
-                versions = self.list_versions(prefix=key)
-                if not versions:
-                    return None
-                return versions[0]
-        try:
-            return BucketEntry(key, self.complete_path,
-                               versioned=self.versioned)
+                entry = BucketEntry(self._object_name(key),
+                                    self.complete_path, key=key)
         except (IOError, OSError):
             return None
+        # the directory of "x/y" is not the object "x" (nor the versions
+        # of "x/1.5" a version of "x")
+        if not S_ISREG(entry.stat.st_mode):
+            return None
+        return entry
+
+    @property
+    def metadata_store(self):
+        return MetadataStore(self.complete_path)
+
+    @property
+    def index(self):
+        if self.sharded:
+            return KeyIndex.for_bucket(
+                os.path.join(self.complete_path, self.SHARDS), sharded=True,
+                bucket_lock=self.lock)
+        return KeyIndex.for_bucket(self.complete_path, ignore=[self.METADATA],
+                                   bucket_lock=self.lock)
+
+    @property
+    def version_index(self):
+        return VersionIndex.for_bucket(
+            os.path.join(self.complete_path, self.VERSIONS),
+            sharded=self.sharded, bucket_lock=self.lock)
 
-    def set_entry(self, key, value):
+    @property
+    def lock(self):
+        return BucketLock.for_bucket(self.complete_path)
+
+    def _updated(self):
+        """ Record an update of the bucket, with the lock held """
+        generation = self.lock.bump()
+        self.index.updated(generation)
+        self.version_index.updated(generation)
+
+    def _sync_indexes(self):
+        """ Drop the indexes if another process updated the bucket """
+        generation = self.lock.generation()
+        self.index.sync(generation)
+        self.version_index.sync(generation)
+
+    def rescan(self):
+        """ Rebuild the key indexes from the files on disk """
+        self._sync_indexes()
+        self.index.rescan()
+        self.version_index.rescan()
+
+    def _temp_path(self):
+        return os.path.join(self.complete_path, "%s-tmp-%s" % (
+            INTERNAL_PREFIX, uuid.uuid4().hex))
+
+    def _place(self, key, write, etag, content_type):
+        """
+            Store a new object (or a new version of it if the bucket is
+            versioned). write(path) creates the file at the provided path.
+
+            The data is written to a temporary file first, only moving it
+            into place is serialized between the I/O threads. The syncs of
+            the --durability option happen outside of the bucket lock.
+        """
+        temp_path = self._temp_path()
+        blob_store = self.blob_store
+        if blob_store and not blob_store.accepts(etag):
+            blob_store = None
+        # with a blob store, known data is only linked
+        if not (blob_store and blob_store.link(etag, temp_path)):
+            try:
+                write(temp_path)
+            except Exception:
+                remove_entry_dir(temp_path)
+                raise
+            if blob_store:
+                blob_store.add(etag, temp_path)
+        durability.flush(temp_path)
+        with self.lock:
+            version_id = None
+            previous = None
+            if self.versioned:
+                self._preserve_unversioned(key)
+                version_id = new_version_id(self._latest_version_id(key))
+                name = self._version_name(key, version_id)
+            else:
+                name = self._object_name(key)
+                previous = self._blob_record(name)
+            path = os.path.join(self.complete_path, name)
+            make_entry_dir(path)
+            replace_file(temp_path, path)
+            entry = BucketEntry(name, self.complete_path, key=key,
+                                version_id=version_id)
+            entry._metadata = self.metadata_store.put(
+                name, entry.stat, etag, content_type, version_id,
+                modified=time.time())
+            if self.versioned:
+                self.version_index.add(key)
+                self._link_latest(key, entry)
+            self.index.add(key)
+            self._updated()
+            self._invalidate(key)
+        synced = self._durable_paths(name)
         if self.versioned:
-            key = "%s.%.6f" % (key, time.time())
-        entry_path = os.path.join(self.complete_path, key)
-        make_entry_dir(entry_path)
-        with open(entry_path, "w") as fp:
-            fp.write(value)
-        return BucketEntry(key, self.complete_path)
+            synced.extend(self._durable_paths(self._object_name(key)))
+        durability.commit(synced)
+        self._release(previous)
+        return entry
+
+    def _durable_paths(self, name):
+        """
+            What durability.commit syncs for an object placed at name: the
+            directories of the object and of its metadata record, up to the
+            bucket (they may have been created by the write). Both files were
+            flushed before their rename. Syncing a directory which did not
+            change costs next to nothing.
+        """
+        metadata_path = self.metadata_store._path(name)
+        paths = [self.complete_path]
+        for path in (os.path.join(self.complete_path, name), metadata_path):
+            path = os.path.dirname(path)
+            while path.startswith(self.complete_path + os.sep):
+                paths.append(path)
+                path = os.path.dirname(path)
+        return paths
+
+    def _blob_record(self, name):
+        """ The metadata of an object about to be replaced or deleted, for
+            releasing its blob afterwards (see _release) """
+        if self.blob_store:
+            return self.metadata_store.read(name)
+        return None
+
+    def _release(self, record):
+        """ Remove the blob of a replaced or deleted object if unused """
+        if record and self.blob_store:
+            self.blob_store.release(record.get("etag"))
+
+    def _preserve_unversioned(self, key):
+        """
+            Keep an object written before versioning was enabled as a
+            version (with its modification time as id) before overwriting it
+        """
+        if self._version_ids(key):
+            return
+        entry = self.get_entry(key)
+        if entry is None:
+            return
+        version_id = "%.6f" % entry.modified_at
+        path = self._version_path(key, version_id)
+        make_entry_dir(path)
+        os.link(entry.complete_path, path)
+        self.metadata_store.put(self._version_name(key, version_id),
+                                entry.stat, entry.etag, entry.content_type,
+                                version_id, entry.modified_at)
+        self.version_index.add(key)
+
+    def _link_latest(self, key, entry):
+        """ Make a version the current content of its key """
+        temp_path = self._temp_path()
+        os.link(entry.complete_path, temp_path)
+        key_path = self._key_path(key)
+        make_entry_dir(key_path)
+        replace_file(temp_path, key_path)
+        self.metadata_store.put(self._object_name(key), entry.stat, entry.etag,
+                                entry.content_type, entry.version_id,
+                                entry.modified_at)
+        self.index.add(key)
+
+    def _update_latest(self, key, dirs=None):
+        """ Point the key to its newest version, or remove it if deleted """
+        for version_id in self._version_ids(key):
+            entry = self.get_entry(key, version_id)
+            if entry and not entry.is_delete_marker:
+                self._link_latest(key, entry)
+                return
+            break
+        remove_entry_dir(self._key_path(key), dirs)
+        self.metadata_store.delete(self._object_name(key), dirs)
+        self.index.remove(key)
+
+    def set_entry(self, key, value, content_type=None):
+        def write(path):
+            with open(path, "w") as fp:
+                fp.write(value)
+
+        return self._place(key, write, hashlib.md5(value).hexdigest(),
+                           content_type)
+
+    def store_upload(self, key, upload, content_type=None):
+        """ Move a streamed request body (see ms3.streaming) into place """
+        return self._place(key, upload.commit, upload.etag, content_type)
 
     def copy_entry(self, key, src_entry):
-        # print "Copy at %.6f" % time.time(), "=>", key
-        return self.set_entry(key, src_entry.read())
+        """ Copy an object, keeping its ETag instead of hashing it again """
+        def write(path):
+            copy_file(src_entry.complete_path, path)
+
+        return self._place(key, write, src_entry.etag, src_entry.content_type)
+
+    def initiate_upload(self, key, content_type=None):
+        return MultipartUpload.create(self, key, content_type)
+
+    def get_upload(self, upload_id):
+        return MultipartUpload.get(self, upload_id)
 
     def delete_entry(self, key, version_id=None):
+        """
+            Delete an object, or a version of it. Returns the version id of
+            the delete marker added in a versioned bucket, else None.
+        """
+        with self.lock:
+            dirs = set()
+            marker_version_id = self._delete_entry(key, version_id, dirs)
+            self._invalidate(key)
+            prune_dirs(dirs, self.complete_path)
+            self._updated()
+        return marker_version_id
+
+    def delete_entries(self, objects):
+        """
+            Delete a batch of (key, version_id) objects in a single pass: the
+            lock is taken once and the directories left empty are pruned
+            once at the end. Returns a (key, version_id, marker_version_id,
+            error) tuple per object, error being None if it was deleted.
+        """
+        results = []
+        with self.lock:
+            dirs = set()
+            for key, version_id in objects:
+                try:
+                    marker_version_id = self._delete_entry(key, version_id,
+                                                           dirs)
+                except (IOError, OSError) as exception:
+                    results.append((key, version_id, None, str(exception)))
+                else:
+                    results.append((key, version_id, marker_version_id,
+                                    None))
+                self._invalidate(key)
+            prune_dirs(dirs, self.complete_path)
+            self._updated()
+        return results
+
+    def _delete_entry(self, key, version_id=None, dirs=None):
+        if version_id:
+            if not is_version_id(version_id):
+                # no such version
+                return None
+            name = self._version_name(key, version_id)
+            record = self._blob_record(name)
+            remove_entry_dir(os.path.join(self.complete_path, name), dirs)
+            self.metadata_store.delete(name, dirs)
+            if not self._version_ids(key):
+                self.version_index.remove(key)
+            self._update_latest(key, dirs)
+            self._release(record)
+            return None
+        marker_version_id = None
         if self.versioned:
-            if not version_id:
-                key = "%s.%.6f" % (key, time.time())
-                with open(os.path.join(self.complete_path, key), "w"):
-                    pass
-                return  # add a 0 bytes file for deleted marker
+            # add a 0 bytes version as delete marker
+            self._preserve_unversioned(key)
+            version_id = new_version_id(self._latest_version_id(key))
+            path = self._version_path(key, version_id)
+            make_entry_dir(path)
+            with open(path, "w"):
+                pass
+            self.version_index.add(key)
+            marker_version_id = version_id
+        record = self._blob_record(self._object_name(key))
+        remove_entry_dir(self._key_path(key), dirs)
+        self.metadata_store.delete(self._object_name(key), dirs)
+        self.index.remove(key)
+        self._release(record)
+        return marker_version_id
+
+
+class BucketRegistry(object):
+    """
+        The Bucket instances of a data directory, reused by the requests
+        instead of reading the settings of the bucket every time.
+
+        A cached bucket is checked with a stat of its directory and of its
+        settings file: the settings are renamed into place when they change
+        (in any process), a new inode. The modification time of the
+        directory is not used, every write of an object renames a temporary
+        file in it. Buckets are only read again after their settings
+        changed, or after they were recreated.
+    """
+    def __init__(self, datadir, blob_store=None, cache=None):
+        self.datadir = datadir
+        self.blob_store = blob_store
+        self.cache = cache
+        # name => ((inode of the directory, (inode, mtime) of the settings
+        #          or None), bucket)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """ The bucket with the provided name, None if it does not exist """
+        path = os.path.join(self.datadir, name)
+        try:
+            with metrics.filesystem.time(metrics.STAT):
+                stat = os.stat(path)
+        except OSError:
+            self.forget(name)
+            return None
+        try:
+            with metrics.filesystem.time(metrics.STAT):
+                settings = os.stat(os.path.join(path, Bucket.SETTINGS))
+            settings = (settings.st_ino, settings.st_mtime)
+        except OSError:
+            # default or legacy settings
+            settings = None
+        # taken before reading the settings, a concurrent change of the
+        # settings is picked up by the next call
+        signature = (stat.st_ino, settings)
+        with self.lock:
+            cached = self.buckets.get(name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        bucket = Bucket(name, self.datadir, self.blob_store, self.cache)
+        with self.lock:
+            self.buckets[name] = (signature, bucket)
+        return bucket
+
+    def get_all(self):
+        buckets = []
+        for name in os.listdir(self.datadir):
+            if is_internal(name):
+                continue
+            try:
+                bucket = self.get(name)
+            except (IOError, OSError):
+                continue
+            if bucket is not None:
+                buckets.append(bucket)
+        return buckets
+
+    def forget(self, name=None):
+        """ Drop a bucket (or all of them) from the registry """
+        with self.lock:
+            if name is None:
+                self.buckets.clear()
             else:
-                key = "%s.%s" % (key, version_id)
+                self.buckets.pop(name, None)
 
-        entry_path = os.path.join(self.complete_path, key)
-        remove_entry_dir(entry_path)
 
-    def list(self, prefix=None):
-        results = {}
-        bucket_path = os.path.join(self.base_path, self.name)
-        for root, dirs, files in os.walk(bucket_path):
-            for f in files:
-                f = os.path.join(root, f).replace(bucket_path + "/", "")
-                if prefix and not f.startswith(prefix):
-                    continue
-                if f != self.METADATA:
-                    entry = BucketEntry(f, bucket_path, self.versioned)
-                    if is_more_recent(results.get(entry.key), entry):
-                        results[entry.key] = entry
+class InvalidPart(Exception):
+    """ Raised when completing an upload with missing or unordered parts """
+    pass
 
-        return [e for e in results.values() if e.size > 0]
 
-    def list_versions(self, prefix=None):
-        results = {}
-        bucket_path = os.path.join(self.base_path, self.name)
-        for root, dirs, files in os.walk(bucket_path):
-            for f in files:
-                f = os.path.join(root, f).replace(bucket_path + "/", "")
-                if prefix and not f.startswith(prefix):
-                    continue
-                if f != self.METADATA:
-                    entry = BucketEntry(f, bucket_path, self.versioned)
-                    if not results.get(entry.key):
-                        results[entry.key] = []
-                    results[entry.key].append(entry)
-        final = []
-        for key in sorted(results.keys()):
-            final.extend(sorted(results[key], cmp=compare_entries,
-                                reverse=True))
-        return final
+def select_parts(parts, get_part):
+    """
+        The stored parts (see MultipartUpload.parts) for the (number, etag)
+        list of a completion request, get_part(number) returning a stored
+        part or None. Parts must exist, match their ETag and be in order.
+    """
+    if not parts:
+        raise InvalidPart("no parts")
+    results = []
+    previous = 0
+    for number, etag in parts:
+        part = get_part(number)
+        if number <= previous or part is None or part[1] != etag.strip('"'):
+            raise InvalidPart(number)
+        previous = number
+        results.append(part)
+    return results
+
+
+def multipart_etag(etags):
+    """
+        The ETag of an object assembled from parts: the MD5 of the part
+        digests followed by the number of parts, like S3 does
+    """
+    digests = "".join(etag.strip('"').decode("hex") for etag in etags)
+    return "%s-%d" % (hashlib.md5(digests).hexdigest(), len(etags))
 
-    def xml(self):
-        return e("Bucket",
-                 t("Name", self.name),
-                 t("CreationDate", as_date(self.created_at)))
+
+class MultipartUpload(AWSObject):
+    """
+        An upload in progress, stored in <bucket>/.ms3uploads/<upload id>.
+
+        Each part is a file named after its number, with its ETag in a
+        metadata sidecar. Parts are received independently (and possibly
+        concurrently) and concatenated once the upload is completed.
+    """
+    DIRNAME = INTERNAL_PREFIX + "uploads"
+    INFO = "upload"
+
+    def __init__(self, bucket, upload_id):
+        self.bucket = bucket
+        self.upload_id = upload_id
+        self.path = os.path.join(bucket.complete_path, self.DIRNAME,
+                                 upload_id)
+        with open(os.path.join(self.path, self.INFO), "r") as fp:
+            info = json.load(fp)
+        self.key = info["key"].encode("utf-8")
+        self.content_type = info.get("content_type")
+        self.initiated = info["initiated"]
+
+    @classmethod
+    def create(cls, bucket, key, content_type=None):
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(bucket.complete_path, cls.DIRNAME, upload_id)
+        os.makedirs(path)
+        with open(os.path.join(path, cls.INFO), "w") as fp:
+            json.dump({"key": key, "content_type": content_type,
+                       "initiated": time.time()}, fp)
+        return cls(bucket, upload_id)
+
+    @classmethod
+    def get(cls, bucket, upload_id):
+        if not re.match(r"^[0-9a-f]+$", upload_id or ""):
+            return None
+        try:
+            return cls(bucket, upload_id)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    @property
+    def metadata_store(self):
+        return MetadataStore(self.path)
+
+    def set_part(self, number, value):
+        def write(path):
+            with open(path, "w") as fp:
+                fp.write(value)
+
+        return self._store_part(number, write, hashlib.md5(value).hexdigest())
+
+    def store_part(self, number, upload):
+        """ Move a streamed request body (see ms3.streaming) into place """
+        return self._store_part(number, upload.commit, upload.etag)
+
+    def _store_part(self, number, write, etag):
+        """ Store a part, write(path) creates the file at path """
+        name = str(number)
+        temp_path = os.path.join(self.path, "%s-tmp-%s" % (
+            INTERNAL_PREFIX, uuid.uuid4().hex))
+        write(temp_path)
+        os.rename(temp_path, os.path.join(self.path, name))
+        self.metadata_store.put(name, os.stat(os.path.join(self.path, name)),
+                                etag)
+        return etag
+
+    def parts(self, marker=0, max_parts=None):
+        """ The (number, etag, size, mtime) of the parts, by number """
+        numbers = sorted(int(name) for name in os.listdir(self.path)
+                         if name.isdigit() and int(name) > marker)
+        if max_parts is not None:
+            numbers = numbers[:max_parts]
+        results = []
+        for number in numbers:
+            part = self._part(number)
+            if part:
+                results.append(part)
+        return results
+
+    def _part(self, number):
+        path = os.path.join(self.path, str(number))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        record = self.metadata_store.get(str(number), stat)
+        if record is None:
+            record = self.metadata_store.put(str(number), stat,
+                                             file_md5(path))
+        return number, record["etag"], stat.st_size, stat.st_mtime
+
+    def complete(self, parts):
+        """ Assemble the listed (number, etag) parts into the object """
+        paths = [os.path.join(self.path, str(part[0]))
+                 for part in select_parts(parts, self._part)]
+        etag = multipart_etag([etag for number, etag in parts])
+
+        def write(path):
+            if len(paths) == 1:
+                copy_file(paths[0], path)
+                return
+            with open(path, "wb") as fp:
+                for part_path in paths:
+                    append_file(part_path, fp)
+
+        entry = self.bucket._place(self.key, write, etag, self.content_type)
+        self.abort()
+        return entry
+
+    def abort(self):
+        shutil.rmtree(self.path, True)
 
 
 class Response(AWSObject):
@@ -314,12 +1905,49 @@ class Response(AWSObject):
     def xml(self):
         return e(self.tag, xmlns=XMLNS)
 
+    def iter_xml(self, pretty_print=True, chunk_size=None):
+        """ The serialized response, as a sequence of chunks """
+        yield xml_string(self.xml(), pretty_print=pretty_print)
+
+
+class StreamedResponse(Response):
+    """
+        Response whose children are produced lazily by `children` and
+        serialized incrementally, so the whole tree is never built in memory
+    """
+    def children(self):
+        return []
+
+    def xml(self):
+        result = super(StreamedResponse, self).xml()
+        ea(result, *self.children())
+        return result
+
+    def iter_xml(self, pretty_print=True, chunk_size=64 * 1024):
+        output = ChunkBuffer()
+        with lxml.etree.xmlfile(output, encoding="utf-8") as xf:
+            xf.write_declaration()
+            with xf.element(self.tag, xmlns=XMLNS):
+                if pretty_print:
+                    xf.write("\n")
+                for child in self.children():
+                    xf.write(child, pretty_print=pretty_print)
+                    if output.size >= chunk_size:
+                        xf.flush()
+                        yield output.drain()
+        yield output.drain()
+
 
 class Owner(AWSObject):
+    _xml = None
+
     def xml(self):
-        return e("Owner",
-                 t("ID", "super-owner-id"),
-                 t("DisplayName", "S3 Owner"))
+        # the owner is the same in every listing entry, build it only once
+        if Owner._xml is None:
+            Owner._xml = e("Owner",
+                           t("ID", "super-owner-id"),
+                           t("DisplayName", "S3 Owner"))
+        return copy.copy(Owner._xml)
 
 
 class ListAllMyBucketsResponse(Response):
@@ -336,39 +1964,68 @@ class ListAllMyBucketsResponse(Response):
         return result
 
 
-class ListBucketResponse(Response):
+class ListingResponse(StreamedResponse):
+    """ Common parts of the object and version listings """
+    def __init__(self, bucket, listing):
+        self.bucket = bucket
+        self.listing = listing
+
+    def header(self):
+        return []
 
-    tag = "ListBucketResult"
+    def entry_xml(self, entry):
+        return entry.xml()
 
-    def __init__(self, bucket, entries):
-        self.bucket = bucket
-        self.entries = entries
+    def children(self):
+        listing = self.listing
+        for child in self.header():
+            yield child
+        if listing.max_keys is not None:
+            yield t("MaxKeys", listing.max_keys)
+        if listing.delimiter:
+            yield t("Delimiter", listing.delimiter)
+        yield t("IsTruncated", "true" if listing.is_truncated else "false")
+        for entry in listing.entries:
+            yield self.entry_xml(entry)
+        for prefix in listing.common_prefixes:
+            yield e("CommonPrefixes", t("Prefix", prefix))
 
-    def xml(self):
-        result = super(ListBucketResponse, self).xml()
-        ea(result,
-           t("Name", self.bucket.name),
-           t("IsTruncated", "false"))
-        ea(result, *[entry.xml() for entry in self.entries])
+
+class ListBucketResponse(ListingResponse):
+
+    tag = "ListBucketResult"
+
+    def header(self):
+        listing = self.listing
+        result = [t("Name", self.bucket.name),
+                  t("Prefix", listing.prefix or ""),
+                  t("Marker", listing.marker or "")]
+        if listing.is_truncated and listing.delimiter:
+            result.append(t("NextMarker", listing.next_marker))
         return result
 
 
-class ListBucketVersionsResponse(Response):
+class ListBucketVersionsResponse(ListingResponse):
 
     tag = "ListVersionsResult"
 
-    def __init__(self, bucket, entries):
-        self.bucket = bucket
-        self.entries = entries
-
-    def xml(self):
-        result = super(ListBucketVersionsResponse, self).xml()
-        ea(result,
-           t("KeyMarker", ""),
-           t("VersionIdMarker", ""))
-        ea(result, *[entry.xml(versions=True) for entry in self.entries])
+    def header(self):
+        listing = self.listing
+        result = [t("Name", self.bucket.name),
+                  t("Prefix", listing.prefix or ""),
+                  t("KeyMarker", listing.marker or ""),
+                  t("VersionIdMarker", listing.version_id_marker or "")]
+        if listing.is_truncated:
+            result.extend([
+                t("NextKeyMarker", listing.next_marker),
+                t("NextVersionIdMarker",
+                  listing.next_version_id_marker or "")])
         return result
 
+    def entry_xml(self, entry):
+        return entry.xml(versions=True, is_latest=(
+            entry.key, entry.version_id) in self.listing.latest)
+
 
 class VersioningConfigurationResponse(Response):
 
@@ -398,3 +2055,99 @@ class CopyObjectResponse(Response):
            t("LastModified", httpdate(self.entry.modified_at)),
            t("ETag", '"%s"' % self.entry.etag))
         return result
+
+
+class InitiateMultipartUploadResponse(Response):
+
+    tag = "InitiateMultipartUploadResult"
+
+    def __init__(self, upload):
+        self.upload = upload
+
+    def xml(self):
+        result = super(InitiateMultipartUploadResponse, self).xml()
+        ea(result,
+           t("Bucket", self.upload.bucket.name),
+           t("Key", self.upload.key),
+           t("UploadId", self.upload.upload_id))
+        return result
+
+
+class CompleteMultipartUploadResponse(Response):
+
+    tag = "CompleteMultipartUploadResult"
+
+    def __init__(self, location, bucket, entry):
+        self.location = location
+        self.bucket = bucket
+        self.entry = entry
+
+    def xml(self):
+        result = super(CompleteMultipartUploadResponse, self).xml()
+        ea(result,
+           t("Location", self.location),
+           t("Bucket", self.bucket.name),
+           t("Key", self.entry.key),
+           t("ETag", '"%s"' % self.entry.etag))
+        return result
+
+
+class DeleteResultResponse(StreamedResponse):
+
+    tag = "DeleteResult"
+
+    def __init__(self, results, quiet=False):
+        self.results = results
+        self.quiet = quiet
+
+    def children(self):
+        for key, version_id, marker_version_id, error in self.results:
+            if error is not None:
+                result = e("Error", t("Key", key))
+                if version_id:
+                    result.append(t("VersionId", version_id))
+                ea(result,
+                   t("Code", "InternalError"),
+                   t("Message", error))
+                yield result
+            elif not self.quiet:
+                result = e("Deleted", t("Key", key))
+                if version_id:
+                    result.append(t("VersionId", version_id))
+                if marker_version_id:
+                    ea(result,
+                       t("DeleteMarker", "true"),
+                       t("DeleteMarkerVersionId", marker_version_id))
+                yield result
+
+
+class ListPartsResponse(StreamedResponse):
+
+    tag = "ListPartsResult"
+
+    def __init__(self, upload, parts, marker, max_parts):
+        """ parts: upload.parts(marker, max_parts + 1), read beforehand """
+        self.upload = upload
+        self.parts = parts
+        self.marker = marker
+        self.max_parts = max_parts
+
+    def children(self):
+        # one more part than requested tells if the list is truncated
+        is_truncated = len(self.parts) > self.max_parts
+        parts = self.parts[:self.max_parts]
+        yield t("Bucket", self.upload.bucket.name)
+        yield t("Key", self.upload.key)
+        yield t("UploadId", self.upload.upload_id)
+        yield Owner().xml()
+        yield t("PartNumberMarker", str(self.marker))
+        if parts:
+            yield t("NextPartNumberMarker", str(parts[-1][0]))
+        yield t("MaxParts", str(self.max_parts))
+        yield t("IsTruncated", str(is_truncated).lower())
+        for number, etag, size, mtime in parts:
+            yield e("Part",
+                    t("PartNumber", str(number)),
+                    t("LastModified", as_date(mtime)),
+                    t("ETag", '"%s"' % etag),
+                    t("Size", str(size)))
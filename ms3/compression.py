@@ -0,0 +1,94 @@
+"""
+    Compression of the responses (gzip or deflate, as accepted by the client)
+
+    XML responses (listings...) are compressed, object bodies only if their
+    content type is listed in --compress_types. Responses are compressed
+    chunk by chunk as they are flushed, streamed responses stay streamed.
+"""
+import zlib
+import tornado.web
+from tornado.options import options, define
+
+define("compression_level", default=6, type=int, metavar="0-9",
+       help="zlib level of the compressed responses (0 disables compression)")
+define("compression_min_size", default=1024, type=int, metavar="BYTES",
+       help="Smaller responses are not compressed")
+define("compress_types", default="", type=str, metavar="TYPES",
+       help="Comma separated content types of the objects to compress "
+            "(text/* for all the text types), none by default")
+
+
+# zlib window bits of the encodings: gzip adds 16, deflate is the zlib
+# format (RFC 1950)
+ENCODINGS = [("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)]
+
+
+def negotiate_encoding(header):
+    """ The encoding of the response for an Accept-Encoding header """
+    accepted = {}
+    for item in (header or "").split(","):
+        parts = item.strip().split(";")
+        quality = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].strip().lower()] = quality
+    for encoding, _ in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compressible_type(content_type):
+    """ Whether objects of a content type are compressed (--compress_types) """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    for pattern in options.compress_types.lower().split(","):
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        if pattern == content_type or (pattern.endswith("/*") and
+                                       content_type.startswith(pattern[:-1])):
+            return True
+    return False
+
+
+class CompressionTransform(tornado.web.OutputTransform):
+    """
+        Compresses the responses allowed by their handler (see
+        ms3.app.BaseHandler.allow_compression). A response finished in a
+        single chunk is only compressed above --compression_min_size.
+    """
+    def __init__(self, request):
+        self.encoding = None
+        if options.compression_level > 0 and request.supports_http_1_1():
+            self.encoding = negotiate_encoding(
+                request.headers.get("Accept-Encoding"))
+        self.allowed = False
+        self.compressor = None
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if (self.allowed and status_code == 200 and
+                "Content-Encoding" not in headers and
+                not (finishing and len(chunk) < options.compression_min_size)):
+            headers["Content-Encoding"] = self.encoding
+            headers["Vary"] = "Accept-Encoding"
+            self.compressor = zlib.compressobj(
+                options.compression_level, zlib.DEFLATED,
+                dict(ENCODINGS)[self.encoding])
+            chunk = self.transform_chunk(chunk, finishing)
+            if finishing:
+                headers["Content-Length"] = str(len(chunk))
+            elif "Content-Length" in headers:
+                # sent with the chunked transfer encoding
+                del headers["Content-Length"]
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self.compressor is not None:
+            chunk = self.compressor.compress(chunk) + self.compressor.flush(
+                zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+        return chunk
@@ -0,0 +1,132 @@
+"""
+    Durability of the writes (--durability)
+
+    Objects, metadata records and bucket settings are always written to a
+    temporary file renamed into place, readers never see a partial file.
+    What survives a crash of the machine depends on the mode:
+
+    none: nothing is synced, recent writes may be lost or left empty
+    rename: the data is flushed before the rename, a key holds its old or
+        its new content after a crash, never a torn file (the write itself
+        may be lost)
+    fsync: the renames are also synced before the response is sent, an
+        acknowledged write is durable
+    group: as fsync, but the syncs of concurrent writes are batched: the
+        first writer waits --group_commit_delay for others, then syncs all
+        their files at once (each file and directory once per batch)
+"""
+import os
+import time
+import errno
+import threading
+
+from tornado.options import define
+
+from ms3 import metrics
+
+define("durability", default="none", type=str,
+       metavar="none|rename|fsync|group",
+       help="What is synced to disk before a write is acknowledged")
+define("group_commit_delay", default=0.002, type=float, metavar="SECONDS",
+       help="How long the group durability waits for concurrent writes")
+
+
+NONE, RENAME, FSYNC, GROUP = MODES = ("none", "rename", "fsync", "group")
+
+# set from the options when the application starts
+mode = NONE
+_committer = None
+
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def configure(new_mode, delay=0.002):
+    """ Select the durability mode, see the module documentation """
+    global mode, _committer
+    if new_mode not in MODES:
+        raise ValueError("Unknown durability %r, expected one of %s" % (
+            new_mode, "|".join(MODES)))
+    mode = new_mode
+    _committer = GroupCommitter(delay) if mode == GROUP else None
+
+
+def sync_path(path, data_only=False):
+    """ fsync a file or a directory, ignoring those removed meanwhile """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as exception:
+        if exception.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        with metrics.filesystem.time(metrics.FSYNC):
+            (_fdatasync if data_only else os.fsync)(fd)
+    finally:
+        os.close(fd)
+
+
+def flush(path, batched=True):
+    """
+        Before renaming a written file into place. Files written under a
+        lock are not batched: waiting for other writers there would
+        serialize them.
+    """
+    if mode in (RENAME, FSYNC) or (mode == GROUP and not batched):
+        sync_path(path, data_only=True)
+    elif mode == GROUP:
+        _committer.sync([path])
+
+
+def commit(paths):
+    """
+        After renaming files into place: sync paths (the directories of the
+        renamed files), so the write is durable
+    """
+    if mode == FSYNC:
+        for path in set(paths):
+            sync_path(path)
+    elif mode == GROUP:
+        _committer.sync(paths)
+
+
+class Batch(object):
+    def __init__(self):
+        self.paths = set()
+        self.errors = {}
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """
+        Batches the syncs of the I/O threads. The thread opening a batch
+        syncs it after the delay, the others joining it meanwhile wait for
+        it; an error is raised in the threads which asked for the path.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def sync(self, paths):
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = Batch()
+            batch.paths.update(paths)
+        if leader:
+            time.sleep(self.delay)
+            with self.lock:
+                self.batch = None
+            for path in sorted(batch.paths):
+                try:
+                    sync_path(path)
+                except (IOError, OSError) as exception:
+                    batch.errors[path] = exception
+            metrics.group_commit_paths.observe(len(batch.paths))
+            batch.done.set()
+        else:
+            batch.done.wait()
+        for path in paths:
+            if path in batch.errors:
+                raise batch.errors[path]
@@ -0,0 +1,114 @@
+"""
+    Thread pool for running blocking filesystem work off the IOLoop
+"""
+import sys
+import functools
+import threading
+import multiprocessing.pool
+import tornado.ioloop
+from tornado import gen, stack_context
+from tornado.options import options, define
+
+define("io_threads", default=8, type=int, metavar="THREADS",
+       help="Number of threads doing the disk I/O of the storage operations")
+
+
+_pool = None
+_local = threading.local()
+
+
+def get_pool():
+    """ The executor, created on first use (after the options are parsed) """
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.pool.ThreadPool(max(options.io_threads, 1))
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+def set_io_loop(io_loop):
+    """
+        Run the callbacks of the tasks started from this thread on io_loop
+        instead of the IOLoop instance, for servers running their own
+        IOLoop (see ms3.testing.InProcessServer)
+    """
+    _local.io_loop = io_loop
+
+
+def run_in_executor(func, callback, *args, **kwargs):
+    """
+        Run func(*args, **kwargs) on the thread pool. callback(result,
+        exc_info) is then run on the IOLoop of the caller, in its stack
+        context.
+    """
+    io_loop = (getattr(_local, "io_loop", None) or
+               tornado.ioloop.IOLoop.instance())
+    callback = stack_context.wrap(callback)
+
+    def work():
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            io_loop.add_callback(functools.partial(
+                callback, None, sys.exc_info()))
+        else:
+            io_loop.add_callback(functools.partial(callback, result, None))
+
+    get_pool().apply_async(work)
+
+
+class Blocking(gen.YieldPoint):
+    """
+        Yield point running a blocking function on the thread pool, for
+        use in `gen.engine` functions:
+
+            entry = yield Blocking(bucket.get_entry, key)
+
+        Exceptions raised by the function are raised at the yield.
+    """
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def start(self, runner):
+        self.runner = runner
+        self.key = object()
+        runner.register_callback(self.key)
+        run_in_executor(self.func, self._on_done, *self.args, **self.kwargs)
+
+    def _on_done(self, result, exc_info):
+        self.runner.set_result(self.key, (result, exc_info))
+
+    def is_ready(self):
+        return self.runner.is_ready(self.key)
+
+    def get_result(self):
+        result, exc_info = self.runner.pop_result(self.key)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return result
+
+
+class Inline(Blocking):
+    """
+        Yield point with the interface of `Blocking` running the function
+        right away on the IOLoop, for operations which don't block (see
+        ms3.memory)
+    """
+    def start(self, runner):
+        self.runner = runner
+        self.key = object()
+        runner.register_callback(self.key)
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self._on_done(None, sys.exc_info())
+        else:
+            self._on_done(result, None)
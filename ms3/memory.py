@@ -0,0 +1,421 @@
+"""
+    Storage engine keeping the buckets in memory (see ms3.storage)
+
+    Nothing is written to disk, which suits tests that don't need the data
+    to outlive the server. Object data are immutable strings, so copies and
+    versions share them, and ETags are computed once when data is received.
+"""
+import time
+import uuid
+import hashlib
+import logging
+import threading
+import cStringIO
+
+from ms3.commands import (
+    AWSObject, BucketEntry, BucketListing, KeyIndex, SnapshotStore,
+    DEFAULT_CONTENT_TYPE, new_version_id, select_parts, multipart_etag)
+from ms3.storage import Storage, StorageFull
+
+
+_logger = logging.getLogger(__name__)
+
+
+def sorted_index():
+    """ A KeyIndex that is only updated in memory, never scanned """
+    index = KeyIndex(None)
+    index.names = []
+    return index
+
+
+class MemoryUpload(object):
+    """ A streamed request body (see ms3.streaming) kept in memory """
+    def __init__(self):
+        self.chunks = []
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    @property
+    def etag(self):
+        return self.md5.hexdigest()
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.md5.update(data)
+        self.size += len(data)
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        data = "".join(self.chunks)
+        self.chunks = [data]
+        return data
+
+    def discard(self):
+        self.chunks = []
+
+
+class MemoryEntry(BucketEntry):
+    """ An object (or a version of it) kept in memory """
+    def __init__(self, key, data, etag, content_type=None, version_id=None,
+                 delete_marker=False):
+        self.name = self.key = key
+        self.base_path = None
+        self.versioned = False
+        self.data = data
+        self.size = len(data)
+        self.created_at = time.time()
+        self._version_id = version_id
+        self.delete_marker = delete_marker
+        self._metadata = {"etag": etag, "size": self.size,
+                          "mtime": self.created_at,
+                          "modified": self.created_at,
+                          "content_type": content_type or DEFAULT_CONTENT_TYPE,
+                          "version_id": version_id}
+
+    @property
+    def is_delete_marker(self):
+        return self.delete_marker
+
+    def open(self):
+        return cStringIO.StringIO(self.data)
+
+    def read(self):
+        return self.data
+
+
+class MemoryMultipartUpload(AWSObject):
+    """ A multipart upload whose parts are kept in memory """
+    def __init__(self, bucket, upload_id, key, content_type=None):
+        self.bucket = bucket
+        self.upload_id = upload_id
+        self.key = key
+        self.content_type = content_type
+        self.initiated = time.time()
+        # part number => (number, etag, size, mtime, data)
+        self._parts = {}
+
+    def copy(self, bucket):
+        """ A copy of the upload for a copy of its bucket """
+        upload = MemoryMultipartUpload(bucket, self.upload_id, self.key,
+                                       self.content_type)
+        upload.initiated = self.initiated
+        upload._parts = dict(self._parts)
+        return upload
+
+    def set_part(self, number, value, etag=None):
+        etag = etag or hashlib.md5(value).hexdigest()
+        storage = self.bucket.storage
+        with storage.lock:
+            previous = self._parts.get(number)
+            storage.reserve(len(value), previous[2] if previous else 0)
+            self._parts[number] = (number, etag, len(value), time.time(),
+                                   value)
+        if previous:
+            storage.release(previous[2])
+        return etag
+
+    def store_part(self, number, upload):
+        return self.set_part(number, upload.getvalue(), upload.etag)
+
+    def _part(self, number):
+        part = self._parts.get(number)
+        return part and part[:4]
+
+    def parts(self, marker=0, max_parts=None):
+        """ The (number, etag, size, mtime) of the parts, by number """
+        numbers = sorted(number for number in self._parts if number > marker)
+        if max_parts is not None:
+            numbers = numbers[:max_parts]
+        return [self._part(number) for number in numbers]
+
+    def complete(self, parts):
+        selected = [self._parts[part[0]] for part in
+                    select_parts(parts, self._part)]
+        data = "".join(part[4] for part in selected)
+        etag = multipart_etag([part[1] for part in selected])
+        entry = self.bucket._place(self.key, data, etag, self.content_type)
+        self.abort()
+        return entry
+
+    def abort(self):
+        with self.bucket.storage.lock:
+            self.bucket.uploads.pop(self.upload_id, None)
+            size = sum(part[2] for part in self._parts.values())
+            self._parts = {}
+        self.bucket.storage.release(size)
+
+
+class MemoryBucket(BucketListing, AWSObject):
+    """
+        A bucket kept in memory: the current entry of each key, and the
+        versions of the keys (newest first) if the bucket is versioned
+    """
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.created_at = time.time()
+        self.versioned = False
+        self.entries = {}
+        self.versions = {}
+        self.uploads = {}
+        self.index = sorted_index()
+        self.version_index = sorted_index()
+
+    def enable_versioning(self):
+        self.versioned = True
+
+    def disable_versioning(self):
+        self.versioned = False
+
+    def delete(self):
+        self.storage.delete_bucket(self.name)
+
+    def copy(self, storage):
+        """
+            A copy of the bucket, for snapshots: entries are never modified
+            once stored, so the copy shares them (and their data)
+        """
+        bucket = MemoryBucket(storage, self.name)
+        bucket.created_at = self.created_at
+        bucket.versioned = self.versioned
+        bucket.entries = dict(self.entries)
+        bucket.versions = dict((key, list(versions)) for key, versions in
+                               self.versions.iteritems())
+        bucket.uploads = dict((upload_id, upload.copy(bucket)) for
+                              upload_id, upload in self.uploads.iteritems())
+        bucket.index.names = list(self.index.names)
+        bucket.version_index.names = list(self.version_index.names)
+        return bucket
+
+    @property
+    def size(self):
+        """ The size of the data accounted to this bucket """
+        size = sum(entry.size for entry in self.entries.values()
+                   if entry.version_id is None)
+        size += sum(entry.size for versions in self.versions.values()
+                    for entry in versions)
+        size += sum(part[2] for upload in self.uploads.values()
+                    for part in upload._parts.values())
+        return size
+
+    def _version_ids(self, key):
+        return [entry.version_id for entry in self.versions.get(key, [])]
+
+    def _latest_version_id(self, key):
+        versions = self.versions.get(key)
+        if versions:
+            return versions[0].version_id
+        return None
+
+    def get_entry(self, key, version_id=None):
+        if version_id:
+            for entry in self.versions.get(key, []):
+                if entry.version_id == version_id:
+                    return entry
+            return None
+        return self.entries.get(key)
+
+    def _place(self, key, data, etag, content_type):
+        """ Store a new object (or a new version of it) """
+        with self.storage.lock:
+            replaced = 0
+            previous = self.entries.get(key)
+            if (not self.versioned and previous is not None and
+                    previous.version_id is None):
+                # overwritten, released below
+                replaced = previous.size
+            self.storage.reserve(len(data), replaced)
+            if self.versioned:
+                self._preserve_unversioned(key)
+                version_id = new_version_id(self._latest_version_id(key))
+                entry = MemoryEntry(key, data, etag, content_type, version_id)
+                self.versions.setdefault(key, []).insert(0, entry)
+                self.version_index.add(key)
+            else:
+                entry = MemoryEntry(key, data, etag, content_type)
+            self._set_current(key, entry)
+        return entry
+
+    def _set_current(self, key, entry):
+        previous = self.entries.get(key)
+        if entry is None:
+            self.entries.pop(key, None)
+            self.index.remove(key)
+        else:
+            self.entries[key] = entry
+            self.index.add(key)
+        # versions are accounted with the versions of the key
+        if previous is not None and previous.version_id is None:
+            self.storage.release(previous.size)
+
+    def _preserve_unversioned(self, key):
+        """
+            Keep an object written before versioning was enabled as a
+            version (with its modification time as id) before overwriting it
+        """
+        entry = self.entries.get(key)
+        if self.versions.get(key) or entry is None:
+            return
+        version = MemoryEntry(key, entry.data, entry.etag, entry.content_type,
+                              "%.6f" % entry.modified_at)
+        version._metadata["modified"] = entry.modified_at
+        self.versions[key] = [version]
+        self.version_index.add(key)
+        # the data is now accounted to the version
+        self.entries[key] = version
+
+    def _update_latest(self, key):
+        """ Point the key to its newest version, or remove it if deleted """
+        versions = self.versions.get(key)
+        if versions and not versions[0].is_delete_marker:
+            self._set_current(key, versions[0])
+        else:
+            self._set_current(key, None)
+
+    def set_entry(self, key, value, content_type=None):
+        return self._place(key, value, hashlib.md5(value).hexdigest(),
+                           content_type)
+
+    def store_upload(self, key, upload, content_type=None):
+        return self._place(key, upload.getvalue(), upload.etag, content_type)
+
+    def copy_entry(self, key, src_entry):
+        return self._place(key, src_entry.read(), src_entry.etag,
+                           src_entry.content_type)
+
+    def delete_entry(self, key, version_id=None):
+        with self.storage.lock:
+            return self._delete_entry(key, version_id)
+
+    def delete_entries(self, objects):
+        with self.storage.lock:
+            return [(key, version_id, self._delete_entry(key, version_id),
+                     None) for key, version_id in objects]
+
+    def _delete_entry(self, key, version_id=None):
+        """ Returns the version id of the added delete marker, if any """
+        if version_id:
+            versions = self.versions.get(key, [])
+            for entry in versions:
+                if entry.version_id == version_id:
+                    versions.remove(entry)
+                    self.storage.release(entry.size)
+                    break
+            if not versions:
+                self.versions.pop(key, None)
+                self.version_index.remove(key)
+            self._update_latest(key)
+            return None
+        marker = None
+        if self.versioned:
+            self._preserve_unversioned(key)
+            marker = MemoryEntry(
+                key, "", "",
+                version_id=new_version_id(self._latest_version_id(key)),
+                delete_marker=True)
+            self.versions.setdefault(key, []).insert(0, marker)
+            self.version_index.add(key)
+        self._set_current(key, None)
+        return marker and marker.version_id
+
+    def initiate_upload(self, key, content_type=None):
+        with self.storage.lock:
+            upload_id = uuid.uuid4().hex
+            upload = MemoryMultipartUpload(self, upload_id, key, content_type)
+            self.uploads[upload_id] = upload
+        return upload
+
+    def get_upload(self, upload_id):
+        return self.uploads.get(upload_id)
+
+
+class MemoryStorage(Storage):
+    """ Buckets kept in memory, up to limit bytes of data (0: no limit) """
+
+    blocking = False
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.size = 0
+        self.buckets = {}
+        # name => (creation time, copies of the buckets)
+        self.snapshots = {}
+        self.lock = threading.RLock()
+
+    def reserve(self, size, replaced=0):
+        """
+            Account for new data, raises StorageFull above the limit.
+            replaced is the size of data which is about to be released.
+        """
+        with self.lock:
+            if self.limit and self.size - replaced + size > self.limit:
+                _logger.warn("Memory storage full: %d bytes used, %d needed",
+                             self.size, size)
+                raise StorageFull(size)
+            self.size += size
+
+    def release(self, size):
+        with self.lock:
+            self.size -= size
+
+    def get_bucket(self, name):
+        return self.buckets.get(name)
+
+    def create_bucket(self, name):
+        with self.lock:
+            if name in self.buckets:
+                return None
+            bucket = self.buckets[name] = MemoryBucket(self, name)
+        return bucket
+
+    def delete_bucket(self, name):
+        with self.lock:
+            bucket = self.buckets.pop(name, None)
+            if bucket:
+                self.size -= bucket.size
+
+    def get_all_buckets(self):
+        return [self.buckets[name] for name in sorted(self.buckets)]
+
+    def delete_all(self):
+        with self.lock:
+            self.buckets = {}
+            self.size = 0
+
+    def snapshot(self, name):
+        if not SnapshotStore.NAME_RE.match(name or ""):
+            raise ValueError("Invalid snapshot name %r" % name)
+        with self.lock:
+            buckets = dict((bucket_name, bucket.copy(None)) for
+                           bucket_name, bucket in self.buckets.iteritems())
+            self.snapshots[name] = (time.time(), buckets)
+        return self._snapshot_info(name)
+
+    def restore_snapshot(self, name):
+        with self.lock:
+            snapshot = self.snapshots.get(name)
+            if snapshot is None:
+                return False
+            self.buckets = dict(
+                (bucket_name, bucket.copy(self)) for
+                bucket_name, bucket in snapshot[1].iteritems())
+            # the data of the snapshots is not accounted, only restored data
+            self.size = sum(bucket.size for bucket in self.buckets.values())
+        return True
+
+    def delete_snapshot(self, name):
+        with self.lock:
+            return self.snapshots.pop(name, None) is not None
+
+    def _snapshot_info(self, name):
+        return {"name": name, "created_at": self.snapshots[name][0]}
+
+    def get_snapshots(self):
+        with self.lock:
+            return [self._snapshot_info(name)
+                    for name in sorted(self.snapshots)]
+
+    def new_upload(self, bucket_name):
+        return MemoryUpload()
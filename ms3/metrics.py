@@ -0,0 +1,235 @@
+"""
+    Internal metrics, served in the Prometheus text format at /_ms3/metrics
+
+    Metrics are kept in memory by each server process (with --processes,
+    a scrape only sees the process which accepted it). Recording is a
+    lock, a dict lookup and a bisect, cheap enough to stay enabled under
+    load; it can be disabled with --metrics=False.
+"""
+import time
+import bisect
+import threading
+import functools
+from tornado.options import define
+
+define("metrics", default=True, type=bool, metavar="True|False",
+       help="Collect the metrics served at /_ms3/metrics")
+
+
+# seconds, from fast metadata operations to big transfers
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# set from the options when the application starts
+enabled = True
+
+_registry = []
+
+
+def format_labels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace(
+        "\\", "\\\\").replace('"', '\\"')) for name, value in pairs)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """ A metric with one value per combination of label values """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        _registry.append(self)
+
+    def samples(self):
+        """ The (suffix, label values, extra label, value) of the metric """
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield "", labels, None, value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append("%s%s%s %s" % (
+                self.name, suffix, format_labels(self.labels, labels, extra),
+                format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        if not enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """ Counts of observations below each bucket bound, with sum and count """
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        if not enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.values.get(labels)
+            if histogram is None:
+                # counts per bucket (the last one is +Inf), sum
+                histogram = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((labels, (list(counts), total)) for
+                           labels, (counts, total) in self.values.items())
+        for labels, (counts, total) in items:
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulated += count
+                yield "_bucket", labels, ("le", format_value(bound)), cumulated
+            yield "_sum", labels, None, total
+            yield "_count", labels, None, cumulated
+
+    def time(self, labels=()):
+        """ Context manager observing the duration of its block """
+        return Timer(self, labels)
+
+
+class Timer(object):
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, self.labels)
+
+
+requests = Counter(
+    "ms3_requests_total", "Requests served",
+    ("handler", "method", "status"))
+request_duration = Histogram(
+    "ms3_request_duration_seconds",
+    "Time from receiving the request headers to the end of the response",
+    ("handler", "method"))
+request_bytes = Counter(
+    "ms3_request_bytes_total", "Bytes of request bodies received",
+    ("handler", "method"))
+response_bytes = Counter(
+    "ms3_response_bytes_total", "Bytes of response bodies sent",
+    ("handler", "method"))
+in_flight = Gauge(
+    "ms3_requests_in_flight", "Requests being processed")
+ioloop_lag = Histogram(
+    "ms3_ioloop_lag_seconds",
+    "Delay of the IOLoop in running timeouts (time it spent busy)")
+storage_calls = Histogram(
+    "ms3_storage_call_seconds",
+    "Time spent in storage operations (on the I/O threads for blocking "
+    "storage engines)", ("operation",))
+filesystem = Histogram(
+    "ms3_filesystem_seconds",
+    "Time spent in file system work: directory walks, stats, hashing, "
+    "object data reads and writes and syncs", ("operation",))
+group_commit_paths = Histogram(
+    "ms3_group_commit_paths",
+    "Files and directories synced by each batch of the group durability",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+
+WALK = ("walk",)
+STAT = ("stat",)
+HASH = ("hash",)
+READ = ("read",)
+WRITE = ("write",)
+FSYNC = ("fsync",)
+
+
+def timed_call(func):
+    """ Wrap a storage operation so its duration is recorded """
+    labels = (getattr(func, "__name__", "call"),)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with Timer(storage_calls, labels):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class LagMonitor(object):
+    """ Measures how late the IOLoop runs a timeout every interval """
+    def __init__(self, io_loop, interval=0.5):
+        self.io_loop = io_loop
+        self.interval = interval
+        self.timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _schedule(self):
+        deadline = time.time() + self.interval
+        self.timeout = self.io_loop.add_timeout(
+            deadline, functools.partial(self._run, deadline))
+
+    def _run(self, deadline):
+        ioloop_lag.observe(max(time.time() - deadline, 0.0))
+        self._schedule()
+
+
+def reset():
+    """ Forget all the recorded values """
+    for metric in _registry:
+        with metric.lock:
+            metric.values.clear()
+
+
+def render():
+    """ All the metrics in the Prometheus text format """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
@@ -0,0 +1,260 @@
+"""
+    On-demand profiling of a running server
+
+    With --profiling, the /_ms3/profile endpoints capture the work of the
+    server for a time window:
+
+        POST /_ms3/profile?mode=cprofile&duration=30   start a window
+        DELETE /_ms3/profile                           stop it
+        GET /_ms3/profile                              list the captures
+        GET /_ms3/profile/<id>?format=text             download a capture
+
+    cprofile captures profile the IOLoop and the storage operations run on
+    the I/O threads (Bucket.list, BucketEntry.etag, xml_string...) and are
+    downloaded as pstats files (format=pstats, for pstats, snakeviz or
+    gprof2dot) or as text. sampling captures snapshot the stacks of all
+    the threads every --profile_interval seconds and are downloaded in the
+    collapsed format of flamegraph.pl (format=collapsed).
+
+    A request with the `x-ms3-profile` header is profiled on its own
+    (cprofile), the id of its capture is returned in the
+    `x-ms3-profile-id` response header.
+
+    Captures are kept in memory by each server process, the latest
+    MAX_CAPTURES only.
+"""
+import sys
+import time
+import uuid
+import marshal
+import pstats
+import cProfile
+import threading
+import collections
+import cStringIO
+from tornado.options import define
+
+define("profiling", default=False, type=bool, metavar="True|False",
+       help="Enable the /_ms3/profile endpoints and the x-ms3-profile "
+            "request header")
+define("profile_interval", default=0.005, type=float, metavar="SECONDS",
+       help="Interval between the stack samples of the sampling profiler")
+
+
+REQUEST_HEADER = "x-ms3-profile"
+RESPONSE_HEADER = "x-ms3-profile-id"
+MAX_CAPTURES = 20
+FORMATS = {"cprofile": ("pstats", "text"), "sampling": ("collapsed",)}
+
+
+class NotAvailable(Exception):
+    """ Raised when a capture can not be produced in the requested format """
+    pass
+
+
+class Capture(object):
+    """ Profiling data collected from started_at until stop is called """
+    mode = None
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self.stopped_at = None
+
+    def stop(self):
+        if self.stopped_at is None:
+            self.stopped_at = time.time()
+
+    @property
+    def running(self):
+        return self.stopped_at is None
+
+    def info(self):
+        return {"id": self.id, "name": self.name, "mode": self.mode,
+                "started_at": self.started_at, "stopped_at": self.stopped_at,
+                "formats": FORMATS[self.mode]}
+
+    def dump(self, format):
+        """ The capture in the provided format """
+        raise NotImplementedError()
+
+
+class CProfileCapture(Capture):
+    """
+        cProfile only profiles the thread enabling it: one profile is used
+        per thread, merged when the capture is downloaded
+    """
+    mode = "cprofile"
+
+    def __init__(self, name):
+        super(CProfileCapture, self).__init__(name)
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def new_profile(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def runcall(self, func, *args, **kwargs):
+        """ Run a function on the current (I/O) thread, profiled """
+        if not self.running:
+            return func(*args, **kwargs)
+        return self.new_profile().runcall(func, *args, **kwargs)
+
+    def stop(self):
+        super(CProfileCapture, self).stop()
+        with self.lock:
+            for profile in self.profiles:
+                profile.disable()
+
+    def stats(self):
+        with self.lock:
+            profiles = [profile for profile in self.profiles
+                        if profile.getstats()]
+        if not profiles:
+            raise NotAvailable("no profiling data")
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def dump(self, format):
+        stats = self.stats()
+        if format == "pstats":
+            # the format of pstats.Stats.dump_stats
+            return marshal.dumps(stats.stats)
+        if format == "text":
+            output = cStringIO.StringIO()
+            stats.stream = output
+            stats.sort_stats("cumulative").print_stats(100)
+            return output.getvalue()
+        raise NotAvailable("no %s format for cprofile captures" % format)
+
+
+class SamplingCapture(Capture):
+    """ Counts of the stacks of all the threads, sampled by a thread """
+    mode = "sampling"
+
+    def __init__(self, name, interval):
+        super(SamplingCapture, self).__init__(name)
+        self.interval = interval
+        self.stacks = collections.defaultdict(int)
+        self.thread = threading.Thread(target=self._sample,
+                                       name="ms3-profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _sample(self):
+        own_id = threading.current_thread().ident
+        while self.running:
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append("%s (%s:%d)" % (
+                        code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                # root first, as flamegraph.pl expects
+                frames.reverse()
+                self.stacks[";".join(frames)] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        super(SamplingCapture, self).stop()
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    def dump(self, format):
+        if format != "collapsed":
+            raise NotAvailable("no %s format for sampling captures" % format)
+        if self.running:
+            raise NotAvailable("the capture is running")
+        return "".join("%s %d\n" % (stack, count) for stack, count in
+                       sorted(self.stacks.items()))
+
+
+class RequestProfile(object):
+    """
+        Context manager of a `tornado.stack_context.StackContext`, so the
+        profile is enabled in all the callbacks of a request
+    """
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __enter__(self):
+        self.profile.enable()
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+
+
+class Profiler(object):
+    """ The captures of an application, and its current time window """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.captures = collections.OrderedDict()
+        self.window = None
+        self.window_profile = None
+        self.window_timeout = None
+
+    def _add(self, capture):
+        self.captures[capture.id] = capture
+        while len(self.captures) > MAX_CAPTURES:
+            _, oldest = self.captures.popitem(last=False)
+            oldest.stop()
+        return capture
+
+    def get(self, capture_id):
+        return self.captures.get(capture_id)
+
+    def start_window(self, mode="cprofile"):
+        """
+            Start capturing the work of the server (from the IOLoop).
+            Returns None if a window is already running.
+        """
+        if self.window is not None:
+            return None
+        name = "window %s" % time.strftime("%Y-%m-%dT%H:%M:%S")
+        if mode == "cprofile":
+            self.window = CProfileCapture(name)
+            self.window_profile = self.window.new_profile()
+            self.window_profile.enable()
+        elif mode == "sampling":
+            self.window = SamplingCapture(name, self.interval)
+        else:
+            raise ValueError("Unknown profiling mode %r" % mode)
+        return self._add(self.window)
+
+    def stop_window(self):
+        """ Stop the current window, returns its capture (if any) """
+        window, self.window = self.window, None
+        if window is not None:
+            window.stop()
+        self.window_profile = None
+        self.window_timeout = None
+        return window
+
+    def start_request(self, name):
+        """
+            A capture for a single request, None while a cprofile window
+            runs (a thread can only have one profiler enabled)
+        """
+        if isinstance(self.window, CProfileCapture):
+            return None
+        return self._add(CProfileCapture(name))
+
+    def task_capture(self, request_capture=None):
+        """ The capture profiling the storage operations of a request """
+        if request_capture is not None:
+            return request_capture
+        if isinstance(self.window, CProfileCapture):
+            return self.window
+        return None
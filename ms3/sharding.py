@@ -0,0 +1,60 @@
+"""
+    Offline conversion of the buckets of a data directory to the sharded
+    layout (see `ms3.commands.Bucket`), or back:
+
+        python -m ms3.sharding --datadir=data --buckets=logs,events
+        python -m ms3.sharding --datadir=data --unshard
+
+    The objects are renamed, no data is copied. Stop the servers using the
+    data directory first. Buckets created afterwards use the layout of the
+    --shard_buckets option of the server.
+"""
+import sys
+import logging
+
+from tornado.options import options, define
+
+from ms3.commands import Bucket
+from ms3.general_options import parse_options
+
+define("buckets", default="", type=str, metavar="NAMES",
+       help="Comma separated buckets to convert (default: all)")
+define("unshard", default=False, type=bool,
+       help="Move the objects back to the paths of their keys")
+
+
+_logger = logging.getLogger(__name__)
+
+
+def convert(datadir, names=None, sharded=True):
+    """
+        Convert the buckets of a data directory (those of names only if
+        provided), returns the names of the converted buckets
+    """
+    converted = []
+    buckets = dict((bucket.name, bucket)
+                   for bucket in Bucket.get_all_buckets(datadir))
+    for name in names or sorted(buckets):
+        if name not in buckets:
+            raise ValueError("No bucket %r in %s" % (name, datadir))
+        moved = buckets[name].set_sharded(sharded)
+        if moved is None:
+            _logger.info("%s already has this layout", name)
+            continue
+        _logger.info("%s: moved %d keys", name, moved)
+        converted.append(name)
+    return converted
+
+
+def main(args=None):
+    parse_options(args)
+    names = [name for name in options.buckets.split(",") if name]
+    try:
+        convert(options.datadir, names, not options.unshard)
+    except ValueError as exception:
+        _logger.error(exception)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+    Storage engines: where the buckets and objects are kept
+
+    The handlers only talk to a `Storage`. Buckets returned by a storage
+    provide the operations of `ms3.commands.Bucket` (listings, get_entry,
+    set_entry, store_upload, copy_entry, delete_entry, delete_entries,
+    versioning and multipart uploads).
+
+    Storages also keep named snapshots of all their buckets, restored in
+    one operation (to reset tests to a seeded state, for instance).
+"""
+import os
+import shutil
+import logging
+import tornado.web
+from tornado.options import options, define
+
+from ms3.commands import (
+    Bucket, BlobStore, BucketRegistry, KeyIndex, SnapshotStore, is_internal)
+from ms3.cache import ObjectCache
+from ms3.streaming import Upload
+
+define("storage", default="fs", type=str, metavar="fs|memory",
+       help="Storage engine: files in the data directory (fs) or in memory "
+            "only (memory, nothing is persisted)")
+define("memory_limit", default=0, type=int, metavar="BYTES",
+       help="Maximum size of the data kept by the memory storage "
+            "(0 for no limit)")
+define("dedup", default=False, type=bool,
+       help="Store identical object data once (fs storage only): objects "
+            "are hard links to content addressed blobs of the data directory")
+define("shard_buckets", default=False, type=bool,
+       help="Create the buckets with the sharded layout (fs storage only): "
+            "objects are spread over directories named after the hash of "
+            "their key, for buckets of many keys (see ms3.sharding)")
+
+
+_logger = logging.getLogger(__name__)
+
+
+class StorageFull(tornado.web.HTTPError):
+    """
+        Raised when storing data would exceed the storage limit, the request
+        fails with 413 (Request Entity Too Large)
+    """
+    def __init__(self, size):
+        super(StorageFull, self).__init__(
+            413, "storage full, can not store %d bytes", size)
+
+
+class Storage(object):
+    """ Interface of the storage engines """
+
+    # whether the operations block on I/O and should run on the I/O threads
+    # (see ms3.executor)
+    blocking = True
+
+    def get_bucket(self, name):
+        """ The bucket with the provided name, None if it does not exist """
+        raise NotImplementedError()
+
+    def create_bucket(self, name):
+        """ Create a bucket, returns None if it already exists """
+        raise NotImplementedError()
+
+    def get_all_buckets(self):
+        raise NotImplementedError()
+
+    def delete_all(self):
+        """ Remove all the buckets (the snapshots are kept) """
+        raise NotImplementedError()
+
+    def snapshot(self, name):
+        """
+            Snapshot all the buckets, replacing a snapshot with the same
+            name. Returns the info of the snapshot (a dict with its name and
+            creation time), raises ValueError for an invalid name.
+        """
+        raise NotImplementedError()
+
+    def restore_snapshot(self, name):
+        """
+            Replace all the buckets by those of a snapshot, returns False if
+            there is no snapshot with that name
+        """
+        raise NotImplementedError()
+
+    def delete_snapshot(self, name):
+        """ Returns False if there is no snapshot with that name """
+        raise NotImplementedError()
+
+    def get_snapshots(self):
+        """ The info of all the snapshots, by name """
+        raise NotImplementedError()
+
+    def new_upload(self, bucket_name):
+        """
+            Receiver for a streamed request body (see ms3.streaming), to be
+            stored in the provided bucket
+        """
+        raise NotImplementedError()
+
+
+class FileSystemStorage(Storage):
+    """
+        Buckets are directories of the data directory. With dedup, object
+        data is stored once in a `ms3.commands.BlobStore`. With sharded,
+        new buckets use the sharded layout (see `ms3.commands.Bucket`).
+        Small objects are kept in cache if provided (see
+        `ms3.cache.ObjectCache`). Snapshots are hard link trees (see
+        `ms3.commands.SnapshotStore`).
+    """
+    def __init__(self, datadir, dedup=False, sharded=False, cache=None):
+        self.datadir = datadir
+        self.sharded = sharded
+        self.cache = cache
+        self.snapshots = SnapshotStore(datadir)
+        self.blob_store = None
+        if dedup:
+            self.blob_store = BlobStore(datadir)
+            # blobs left unused by a server that was stopped
+            removed = self.blob_store.collect()
+            if removed:
+                _logger.info("Removed %d unused blobs", removed)
+        self.registry = BucketRegistry(datadir, self.blob_store, cache)
+
+    def get_bucket(self, name):
+        if is_internal(name):
+            return None
+        try:
+            return self.registry.get(name)
+        except OSError as exception:
+            _logger.warn(exception)
+            return None
+
+    def create_bucket(self, name):
+        if is_internal(name):
+            return None
+        # a bucket deleted and created again may get the same inode
+        self.registry.forget(name)
+        return Bucket.create(name, self.datadir, self.blob_store,
+                             self.sharded, self.cache)
+
+    def get_all_buckets(self):
+        return self.registry.get_all()
+
+    def delete_all(self):
+        try:
+            names = os.listdir(self.datadir)
+        except OSError:
+            names = []
+        for name in names:
+            if name == SnapshotStore.DIRNAME:
+                continue
+            path = os.path.join(self.datadir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        KeyIndex.drop(self.datadir)
+        self.registry.forget()
+        self._clear_cache()
+        try:
+            os.makedirs(self.datadir)
+        except (IOError, OSError):
+            pass
+
+    def snapshot(self, name):
+        return self.snapshots.take(name)
+
+    def restore_snapshot(self, name):
+        restored = self.snapshots.restore(name)
+        self.registry.forget()
+        self._clear_cache()
+        return restored
+
+    def _clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    def delete_snapshot(self, name):
+        return self.snapshots.delete(name)
+
+    def get_snapshots(self):
+        return self.snapshots.list()
+
+    def new_upload(self, bucket_name):
+        # bodies for unknown buckets go to the system temporary directory
+        # and are discarded once the request is rejected
+        directory = os.path.join(self.datadir, bucket_name)
+        if not os.path.isdir(directory):
+            directory = None
+        return Upload(directory)
+
+
+def create_storage(name=None, datadir=None, cache=True):
+    """
+        The storage engine selected by the --storage option, with the
+        object cache of the --cache_size option unless cache is False
+    """
+    name = name or options.storage
+    if name == "fs":
+        object_cache = None
+        if cache and options.cache_size > 0:
+            object_cache = ObjectCache(options.cache_size,
+                                       options.cache_max_object_size)
+        return FileSystemStorage(datadir or options.datadir, options.dedup,
+                                 options.shard_buckets, object_cache)
+    if name == "memory":
+        from ms3.memory import MemoryStorage
+        return MemoryStorage(options.memory_limit)
+    raise ValueError("Unknown storage engine %r" % name)
@@ -0,0 +1,338 @@
+"""
+    Helpers for streaming object bodies to and from the network
+"""
+import os
+import re
+import errno
+import socket
+import hashlib
+import logging
+import urllib
+import tempfile
+import tornado.httpserver
+from tornado import httputil
+from tornado.escape import native_str
+from tornado.iostream import SSLIOStream
+from tornado.options import options, define
+
+from ms3 import metrics
+from ms3.commands import INTERNAL_PREFIX, sendfile
+
+define("chunk_size", default=64 * 1024, type=int, metavar="BYTES",
+       help="Size of the chunks used when streaming object bodies")
+define("use_sendfile", default=True, type=bool, metavar="True|False",
+       help="Use sendfile (zero-copy) for non-SSL connections if available")
+define("max_body_size", default=100 * 1024 * 1024, type=int, metavar="BYTES",
+       help="Maximum size of request bodies that are kept in memory "
+            "(object uploads are streamed to disk and are not limited)")
+
+
+_logger = logging.getLogger(__name__)
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class InvalidRange(Exception):
+    """ Raised when a Range header cannot be satisfied """
+    pass
+
+
+def parse_range(header, size):
+    """
+        Parse a `Range: bytes=` header for an object of the provided size.
+
+        Returns None if the whole object should be sent, otherwise a
+        (start, length) tuple. Raises InvalidRange if the range can not be
+        satisfied. Multiple ranges are not supported and are ignored.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # suffix range: the last N bytes
+        length = min(int(end), size)
+        if length == 0:
+            raise InvalidRange(header)
+        return size - length, length
+    start = int(start)
+    if start >= size:
+        raise InvalidRange(header)
+    if end:
+        end = min(int(end), size - 1)
+        if end < start:
+            raise InvalidRange(header)
+    else:
+        end = size - 1
+    return start, end - start + 1
+
+
+class FileSender(object):
+    """
+        Stream a region of a file to a request handler.
+
+        The file is sent in fixed size chunks and the next chunk is only read
+        once the previous one was drained by the client. On non-SSL
+        connections sendfile is used (if available) so the data never goes
+        through the interpreter, unless the response is compressed.
+    """
+    def __init__(self, handler, fp, offset=0, length=None, chunk_size=None):
+        self.handler = handler
+        self.fp = fp
+        self.offset = offset
+        if length is None:
+            length = os.fstat(fp.fileno()).st_size - offset
+        self.remaining = length
+        self.chunk_size = chunk_size or options.chunk_size
+        self.stream = handler.request.connection.stream
+
+    @property
+    def use_sendfile(self):
+        return (sendfile is not None and options.use_sendfile and
+                hasattr(self.fp, "fileno") and
+                not getattr(self.handler, "compressing", False) and
+                not isinstance(self.stream, SSLIOStream))
+
+    def start(self):
+        """ Send the headers and start streaming the body """
+        if self.remaining <= 0:
+            self.close()
+            self.handler.finish()
+            return
+        if self.use_sendfile:
+            self.handler.flush(callback=self._send_file)
+        else:
+            self.fp.seek(self.offset)
+            self._send_chunk()
+
+    def close(self):
+        """ Release the file (also called if the client goes away) """
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def _done(self):
+        self.close()
+        self.handler.finish()
+
+    def _send_chunk(self, callback=None):
+        """ Send the next chunk, then the following ones or callback """
+        if self.fp is None:
+            return
+        if self.remaining <= 0:
+            return self._done()
+        with metrics.filesystem.time(metrics.READ):
+            data = self.fp.read(min(self.chunk_size, self.remaining))
+        if not data:
+            _logger.warn("File shorter than expected, %d bytes missing",
+                         self.remaining)
+            self.stream.close()
+            return self.close()
+        self.offset += len(data)
+        self.remaining -= len(data)
+        self.handler.write(data)
+        self.handler.flush(callback=callback or self._send_chunk)
+
+    def _send_file(self):
+        if self.fp is None or self.stream.closed():
+            return self.close()
+        socket_fd = self.stream.socket.fileno()
+        while self.remaining > 0:
+            try:
+                with metrics.filesystem.time(metrics.READ):
+                    sent = sendfile(socket_fd, self.fp.fileno(), self.offset,
+                                    min(self.chunk_size, self.remaining))
+            except (OSError, IOError) as exception:
+                if exception.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._wait_writable()
+                    return
+                _logger.warn("sendfile failed: %s", exception)
+                self.stream.close()
+                return self.close()
+            if sent == 0:
+                _logger.warn("File shorter than expected, %d bytes missing",
+                             self.remaining)
+                self.stream.close()
+                return self.close()
+            self.offset += sent
+            self.remaining -= sent
+            # sent without going through handler.write
+            self.handler.bytes_out += sent
+        self._done()
+
+    def _wait_writable(self):
+        """
+            The socket is full: send the next chunk through the IOStream
+            instead, which writes it once the socket is writable again and
+            then calls _send_file back.
+        """
+        self.fp.seek(self.offset)
+        self._send_chunk(callback=self._send_file)
+
+
+class Upload(object):
+    """
+        A request body that is streamed into a temporary file.
+
+        The file is created in the directory of the target bucket so it can
+        be renamed into place atomically. The MD5 of the body is computed
+        while it is received.
+    """
+    PREFIX = INTERNAL_PREFIX + "-upload-"
+
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix=self.PREFIX, dir=directory)
+        self.fp = os.fdopen(fd, "wb")
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    @property
+    def etag(self):
+        return self.md5.hexdigest()
+
+    def write(self, data):
+        with metrics.filesystem.time(metrics.WRITE):
+            self.fp.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+    def commit(self, destination):
+        """ Atomically move the received body to its final location """
+        self.close()
+        os.rename(self.path, destination)
+        self.path = None
+
+    def discard(self):
+        """ Remove the temporary file if it was not committed """
+        self.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+def object_path(uri):
+    """
+        Split the path of an object URI into bucket name and key. Returns
+        None if the URI does not target an object.
+    """
+    path = uri.split("?", 1)[0].lstrip("/")
+    if "/" not in path:
+        return None
+    bucket_name, key = path.split("/", 1)
+    if not bucket_name or not key:
+        return None
+    return urllib.unquote(bucket_name), urllib.unquote(key)
+
+
+class StreamingHTTPConnection(tornado.httpserver.HTTPConnection):
+    """
+        HTTP connection which writes object uploads straight to disk.
+
+        Bodies of PUT requests on objects are read in chunks and written to an
+        upload provided by the storage (see ms3.storage), which is then
+        available as `request.upload` (the request body is left empty). All
+        other bodies are buffered in memory as usual.
+    """
+    def __init__(self, *args, **kwargs):
+        self._upload = None
+        self._remaining = 0
+        super(StreamingHTTPConnection, self).__init__(*args, **kwargs)
+
+    def _on_headers(self, data):
+        try:
+            data = native_str(data.decode('latin1'))
+            eol = data.find("\r\n")
+            start_line = data[:eol]
+            try:
+                method, uri, version = start_line.split(" ")
+            except ValueError:
+                raise tornado.httpserver._BadRequestException(
+                    "Malformed HTTP request line")
+            if not version.startswith("HTTP/"):
+                raise tornado.httpserver._BadRequestException(
+                    "Malformed HTTP version in HTTP Request-Line")
+            headers = httputil.HTTPHeaders.parse(data[eol:])
+
+            if getattr(self.stream.socket, 'family', socket.AF_INET) in (
+                    socket.AF_INET, socket.AF_INET6):
+                remote_ip = self.address[0]
+            else:
+                remote_ip = '0.0.0.0'
+
+            self._request = tornado.httpserver.HTTPRequest(
+                connection=self, method=method, uri=uri, version=version,
+                headers=headers, remote_ip=remote_ip)
+            self._request.upload = None
+
+            content_length = headers.get("Content-Length")
+            if content_length:
+                content_length = int(content_length)
+                target = object_path(uri)
+                streamed = (method == "PUT" and content_length > 0 and
+                            target is not None)
+                if not streamed and content_length > options.max_body_size:
+                    raise tornado.httpserver._BadRequestException(
+                        "Content-Length too long")
+                if headers.get("Expect") == "100-continue":
+                    self.stream.write("HTTP/1.1 100 (Continue)\r\n\r\n")
+                if streamed:
+                    self._start_upload(target[0], content_length)
+                else:
+                    self.stream.read_bytes(content_length,
+                                           self._on_request_body)
+                return
+
+            self.request_callback(self._request)
+        except tornado.httpserver._BadRequestException, exception:
+            _logger.info("Malformed HTTP request from %s: %s",
+                         self.address[0], exception)
+            self.close()
+            return
+
+    def _start_upload(self, bucket_name, content_length):
+        self._upload = self.request_callback.storage.new_upload(bucket_name)
+        self._remaining = content_length
+        self.stream.set_close_callback(self._on_upload_aborted)
+        self._read_body_chunk()
+
+    def _read_body_chunk(self):
+        self.stream.read_bytes(min(self._remaining, options.chunk_size),
+                               self._on_body_chunk)
+
+    def _on_body_chunk(self, data):
+        self._upload.write(data)
+        self._remaining -= len(data)
+        if self._remaining > 0:
+            self._read_body_chunk()
+            return
+        self.stream.set_close_callback(None)
+        self._upload.close()
+        self._request.upload = self._upload
+        self._upload = None
+        self.request_callback(self._request)
+
+    def _on_upload_aborted(self):
+        if self._upload:
+            _logger.warn("Connection closed during upload of %s",
+                         self._request.uri)
+            self._upload.discard()
+            self._upload = None
+
+
+class MS3HTTPServer(tornado.httpserver.HTTPServer):
+    """ HTTP server that streams object uploads to disk """
+    def handle_stream(self, stream, address):
+        stream.read_chunk_size = options.chunk_size
+        StreamingHTTPConnection(stream, address, self.request_callback,
+                                self.no_keep_alive, self.xheaders)
@@ -1,16 +1,23 @@
 """ Helper module for using MS3 in tests """
 import os
+import sys
 import time
+import atexit
+import shutil
 import signal
 import urllib
+import httplib
+import weakref
+import tempfile
+import threading
 
 
 def wait_until(func, *args):
     t1 = time.time()
     while not func(*args):
-        time.sleep(0.1)
-        if time.time() - t1 > 3: # seconds
-            raise Exception("wait_until %s timeout raised", func)
+        time.sleep(0.02)
+        if time.time() - t1 > 10: # seconds
+            raise Exception("wait_until %s timeout raised" % func)
 
 
 def is_running(port):
@@ -21,15 +28,198 @@ def is_running(port):
     return True
 
 
+def admin_request(port, method, path):
+    """ Request an admin endpoint (/_ms3/...) of a server, returns the body """
+    connection = httplib.HTTPConnection("localhost", port)
+    try:
+        connection.request(method, path)
+        response = connection.getresponse()
+        body = response.read()
+    finally:
+        connection.close()
+    if response.status >= 400:
+        raise Exception("%s %s failed: %d %s" % (method, path,
+                                                 response.status,
+                                                 response.reason))
+    return body
+
+
+def _reset_after_fork():
+    """
+        Forget the IOLoop instance and the I/O threads of the parent process
+        (which has an InProcessServer running, for instance), the forked
+        server creates its own
+    """
+    import tornado.ioloop
+    import ms3.executor
+    if tornado.ioloop.IOLoop.initialized():
+        del tornado.ioloop.IOLoop._instance
+    ms3.executor._pool = None
+
+
+class InProcessServer(object):
+    """
+        A ms3 server running on a thread of this process, which avoids
+        starting a process (and importing ms3) for every test:
+
+            server = InProcessServer().start()
+            connection = S3Connection("X", "Y", is_secure=False,
+                                      host="localhost", port=server.port,
+                                      calling_format=OrdinaryCallingFormat())
+            ...
+            server.reset()  # between tests
+            ...
+            server.stop()
+
+        The server listens on 127.0.0.1, on an ephemeral port by default.
+        start returns once it accepts connections, without polling. Without
+        a data directory, a temporary one is used (and removed by stop).
+
+        The server runs its own IOLoop. It parses the options like
+        ms3.app.run, in the global tornado options of this process: use
+        MS3Server with with_exec=True in processes using tornado options.
+    """
+    def __init__(self, datadir=None, config=None, port=0, storage=None,
+                 args=None):
+        self.temporary = datadir is None
+        self.datadir = datadir or tempfile.mkdtemp(prefix="ms3-")
+        self.config = config
+        self.port = port
+        self.storage = storage
+        self.args = list(args or [])
+        self.app = None
+        self.thread = None
+        self.io_loop = None
+        self._error = None
+        self._ready = threading.Event()
+
+    def _arguments(self):
+        args = [None, "--datadir=%s" % self.datadir, "--debug=False",
+                "--processes=1"]
+        if self.config:
+            args.append("--config=%s" % self.config)
+        # the options are global, don't keep those of a previous server
+        args.append("--storage=%s" % (self.storage or "fs"))
+        return args + self.args
+
+    def start(self, timeout=10):
+        """ Start the server, returns it once it is ready """
+        assert self.thread is None, "already started"
+        self.thread = threading.Thread(target=self._run, name="ms3-server")
+        self.thread.daemon = True
+        self.thread.start()
+        if not self._ready.wait(timeout):
+            raise Exception("ms3 server not started after %s seconds" %
+                            timeout)
+        if self._error:
+            self.thread.join()
+            self.thread = None
+            raise self._error[0], self._error[1], self._error[2]
+        return self
+
+    def _run(self):
+        import tornado.ioloop
+        import tornado.netutil
+        import ms3.app
+        from ms3 import metrics, executor
+        try:
+            self.app = ms3.app.MS3App(args=self._arguments())
+            self.io_loop = tornado.ioloop.IOLoop()
+            executor.set_io_loop(self.io_loop)
+            self.http_server = ms3.app.create_server(self.app, self.io_loop)
+            # a single (IPv4) socket, so an ephemeral port is the same for
+            # all the sockets
+            sockets = tornado.netutil.bind_sockets(self.port, "127.0.0.1")
+            self.port = sockets[0].getsockname()[1]
+            self.http_server.add_sockets(sockets)
+            # the connections of the clients, closed by stop
+            self.streams = weakref.WeakSet()
+            handle_stream = self.http_server.handle_stream
+
+            def track_stream(stream, address):
+                self.streams.add(stream)
+                handle_stream(stream, address)
+            self.http_server.handle_stream = track_stream
+            self.monitor = metrics.LagMonitor(self.io_loop)
+            if metrics.enabled:
+                self.monitor.start()
+            # ready once the IOLoop runs
+            self.io_loop.add_callback(self._ready.set)
+        except Exception:
+            self._error = sys.exc_info()
+            self._ready.set()
+            return
+        self.io_loop.start()
+
+    def stop(self, timeout=10):
+        """ Stop the server, and close the connections of the clients """
+        if self.thread is None:
+            return
+
+        def shutdown():
+            self.http_server.stop()
+            self.monitor.stop()
+            for stream in list(self.streams):
+                stream.close()
+            self.io_loop.stop()
+
+        self.io_loop.add_callback(shutdown)
+        self.thread.join(timeout)
+        self.thread = None
+        # not all_fds: the sockets are closed by their objects, closing
+        # their file descriptors here would let them close reused ones
+        self.io_loop.close()
+        if self.temporary:
+            shutil.rmtree(self.datadir, True)
+
+    def reset(self):
+        """ Remove all the buckets and forget the recorded metrics """
+        from ms3 import metrics
+        self.app.storage.delete_all()
+        metrics.reset()
+
+    def snapshot(self, name):
+        """ Snapshot all the buckets (see MS3Server.snapshot) """
+        admin_request(self.port, "PUT", "/_ms3/snapshots/%s" % name)
+
+    def restore(self, name):
+        """ Restore the buckets of a snapshot """
+        admin_request(self.port, "POST", "/_ms3/snapshots/%s" % name)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.port
+
+
+_shared_server = None
+
+
+def shared_server():
+    """
+        An InProcessServer (on a temporary data directory) started on first
+        use and kept until the end of the process, to be shared by all the
+        tests of a session. Tests should call its reset method in setUp.
+    """
+    global _shared_server
+    if _shared_server is None:
+        _shared_server = InProcessServer().start()
+        atexit.register(_shared_server.stop)
+    return _shared_server
+
+
 class MS3Server(object):
-    """ Class for managing a ms3 server """
+    """
+        Class for managing a ms3 server in a child process (see also
+        InProcessServer)
+    """
     _pid = None
     _port = None
     datadir = None
 
 
     @classmethod
-    def start(cls, datadir=None, config=None, port=9010, with_exec=False):
+    def start(cls, datadir=None, config=None, port=9010, with_exec=False,
+              processes=None, storage=None):
         """
             Start the MS3 server with the provided data directory. This method
             will fork the process and start a server in the child process.
@@ -38,12 +228,21 @@ class MS3Server(object):
             process image (with it's own environment and runnable code). Use
             this when in the project you're testing you're also using tornado
             (maybe a different version of tornado).
+
+            processes is the number of server processes (see the --processes
+            option), by default a single one.
+
+            storage selects the storage engine ("fs" or "memory", see the
+            --storage option).
         """
         assert not cls._pid
         cls._port = port
         cls.datadir = datadir
         cls._pid = os.fork()
         if cls._pid == 0:
+            # own process group, so stop() also reaches the worker processes
+            os.setsid()
+            _reset_after_fork()
             args = []  # "--debug=True", "--logging=debug"]
             if datadir:
                 args.append("--datadir=%s" % datadir)
@@ -51,6 +250,10 @@ class MS3Server(object):
                 args.append("--config=%s" % config)
             if port:
                 args.append("--port=%s" % port)
+            if processes is not None:
+                args.append("--processes=%s" % processes)
+            if storage:
+                args.append("--storage=%s" % storage)
             if with_exec:
                 ms3_base_path = os.path.normpath(os.path.join(os.path.dirname(
                     os.path.abspath(__file__)), '..'))
@@ -64,17 +267,42 @@ class MS3Server(object):
                        'PWD': ms3_base_path}
                 os.execve(args[0], args, env)
             else:
-                import ms3.app
-                args.insert(0, None)  # pass tornado options
-                ms3.app.run(args)
+                # never return to the code of the parent (a test runner)
+                try:
+                    import ms3.app
+                    args.insert(0, None)  # pass tornado options
+                    ms3.app.run(args)
+                except BaseException:
+                    import traceback
+                    traceback.print_exc()
+                finally:
+                    os._exit(1)
         else:
-            wait_until(lambda: not is_running(cls._port))
+            wait_until(is_running, cls._port)
+
+    @classmethod
+    def snapshot(cls, name):
+        """
+            Snapshot all the buckets of the started server, for instance
+            once the fixtures of the tests are stored:
+
+                def setUp(self):
+                    MS3Server.restore("fixtures")
+
+            Taking and restoring a snapshot copies no object data.
+        """
+        admin_request(cls._port, "PUT", "/_ms3/snapshots/%s" % name)
+
+    @classmethod
+    def restore(cls, name):
+        """ Replace all the buckets by those of a snapshot """
+        admin_request(cls._port, "POST", "/_ms3/snapshots/%s" % name)
 
     @classmethod
     def stop(cls):
         """ Stop a started MS3 Server """
         if cls._pid:
-            os.kill(cls._pid, signal.SIGTERM)
+            os.killpg(cls._pid, signal.SIGTERM)
             cls._pid = None
             cls.datadir = None
             wait_until(lambda: not is_running(cls._port))
@@ -1,15 +1,28 @@
 import os
+import json
+import time
+import zlib
 import shutil
+import urllib
+import urllib2
+import httplib
+import marshal
+import hashlib
 import os.path
 import helpers
 import unittest2
 import tempfile
+import threading
 
-from ms3.testing import MS3Server
+from ms3 import commands, durability, metrics, sharding
+from ms3.testing import (
+    MS3Server, InProcessServer, admin_request, is_running, shared_server)
 
 from itertools import izip
+from StringIO import StringIO
 from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 from boto.s3.key import Key
+from boto.s3.prefix import Prefix
 from boto.exception import S3ResponseError, S3CreateError
 
 
@@ -28,16 +41,15 @@ def create_bucket_dir(datadir, dirname):
 class BucketOperationsTestCase(unittest2.TestCase):
 
     def setUp(self):
-        self.datadir = get_data_dir('buckets')
-        MS3Server.start(datadir=self.datadir)
+        self.server = shared_server()
+        self.server.reset()
+        self.datadir = self.server.datadir
         self.s3 = S3Connection('X', 'Y', is_secure=False,
-                               host='localhost', port=9010,
+                               host='localhost', port=self.server.port,
                                calling_format=OrdinaryCallingFormat())
 
     def tearDown(self):
         self.s3.close()
-        MS3Server.stop()
-        cleanup(self.datadir)
 
     def test_empty_buckets_list(self):
         self.assertEquals([], self.s3.get_all_buckets())
@@ -104,6 +116,553 @@ class BucketOperationsTestCase(unittest2.TestCase):
         self.assertEquals(chunks * chunk, keys[0].size)
         os.unlink("large-file")
 
+    def test_list_prefix(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        bucket = self.s3.get_bucket("my-bucket")
+        names = ["a/b/c", "a/b/d", "a/bc", "a/c/d", "b", "ab"]
+        for name in names:
+            key = Key(bucket)
+            key.name = name
+            key.set_contents_from_string(name)
+        self.assertEquals(sorted(names),
+                          sorted(k.name for k in bucket.get_all_keys()))
+        self.assertEquals(["a/b/c", "a/b/d"], sorted(
+            k.name for k in bucket.get_all_keys(prefix="a/b/")))
+        self.assertEquals(["a/b/c", "a/b/d", "a/bc"], sorted(
+            k.name for k in bucket.get_all_keys(prefix="a/b")))
+        bucket.delete_key("a/b/c")
+        self.assertEquals(["a/b/d"], sorted(
+            k.name for k in bucket.get_all_keys(prefix="a/b/")))
+
+    def test_list_pagination(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        bucket = self.s3.get_bucket("my-bucket")
+        names = ["key-%02d" % i for i in xrange(7)]
+        for name in names:
+            key = Key(bucket)
+            key.name = name
+            key.set_contents_from_string(name)
+        page = bucket.get_all_keys(max_keys=3)
+        self.assertTrue(page.is_truncated)
+        self.assertEquals(names[:3], [k.name for k in page])
+        page = bucket.get_all_keys(max_keys=3, marker="key-02")
+        self.assertEquals(names[3:6], [k.name for k in page])
+        page = bucket.get_all_keys(max_keys=3, marker="key-05")
+        self.assertFalse(page.is_truncated)
+        self.assertEquals(names[6:], [k.name for k in page])
+        # boto follows the markers itself
+        self.assertEquals(names, [k.name for k in bucket.list()])
+        page = bucket.get_all_keys(max_keys=0)
+        self.assertFalse(page.is_truncated)
+        self.assertEquals([], list(page))
+        with self.assertRaises(S3ResponseError) as context:
+            bucket.get_all_keys(max_keys=-1)
+        self.assertEquals(400, context.exception.status)
+
+    def test_list_streamed_response(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        names = ["%04d-%s" % (i, "x" * 100) for i in xrange(1000)]
+        for name in names:
+            path = os.path.join(self.datadir, "my-bucket", name)
+            with open(path, "w") as fp:
+                fp.write(name)
+        bucket = self.s3.get_bucket("my-bucket")
+        keys = bucket.get_all_keys()
+        self.assertEquals(names, [k.name for k in keys])
+        self.assertEquals(len(names[0]), keys[0].size)
+
+    def test_list_delimiter(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        bucket = self.s3.get_bucket("my-bucket")
+        for name in ["a/1", "a/2", "b", "c/d/1", "c/e", "d"]:
+            key = Key(bucket)
+            key.name = name
+            key.set_contents_from_string(name)
+        results = bucket.get_all_keys(delimiter="/")
+        self.assertEquals(["b", "d"],
+                          [k.name for k in results if isinstance(k, Key)])
+        self.assertEquals(["a/", "c/"],
+                          [p.name for p in results if isinstance(p, Prefix)])
+        results = bucket.get_all_keys(prefix="c/", delimiter="/")
+        self.assertEquals(["c/e"],
+                          [k.name for k in results if isinstance(k, Key)])
+        self.assertEquals(["c/d/"],
+                          [p.name for p in results if isinstance(p, Prefix)])
+        page = bucket.get_all_keys(delimiter="/", max_keys=2)
+        self.assertTrue(page.is_truncated)
+        self.assertEquals("b", page.next_marker)
+        self.assertEquals(["a/", "b", "c/", "d"],
+                          sorted(k.name for k in bucket.list(delimiter="/")))
+
+    def test_list_versions_pagination(self):
+        bucket = self.s3.create_bucket("versioned")
+        bucket.configure_versioning(True)
+        for name in ["a", "b"]:
+            key = Key(bucket)
+            key.name = name
+            for i in xrange(3):
+                key.set_contents_from_string("%s-%d" % (name, i))
+        versions = bucket.get_all_versions()
+        self.assertEquals(6, len(versions))
+        page = bucket.get_all_versions(max_keys=4)
+        self.assertTrue(page.is_truncated)
+        self.assertEquals(["a", "a", "a", "b"], [v.name for v in page])
+        self.assertTrue(page[0].is_latest)
+        self.assertFalse(page[1].is_latest)
+        rest = bucket.get_all_versions(
+            key_marker=page.next_key_marker,
+            version_id_marker=page.next_version_id_marker)
+        self.assertFalse(rest.is_truncated)
+        self.assertEquals([v.version_id for v in versions[4:]],
+                          [v.version_id for v in rest])
+        self.assertEquals(6, len(list(bucket.list_versions())))
+
+    def test_versioned_delete_marker(self):
+        bucket = self.s3.create_bucket("versioned")
+        bucket.configure_versioning(True)
+        key = Key(bucket)
+        key.name = "an/object"
+        key.set_contents_from_string("first")
+        key.set_contents_from_string("second")
+        self.assertEquals("second", key.get_contents_as_string())
+        bucket.delete_key("an/object")
+        self.assertIsNone(bucket.get_key("an/object"))
+        self.assertEquals([], list(bucket.list()))
+        versions = bucket.get_all_versions()
+        self.assertEquals(3, len(versions))
+        self.assertTrue(versions[0].is_latest)
+        # removing the delete marker restores the previous version
+        bucket.delete_key("an/object", version_id=versions[0].version_id)
+        self.assertEquals("second", key.get_contents_as_string())
+        self.assertEquals("first", bucket.get_key(
+            "an/object", version_id=versions[2].version_id
+        ).get_contents_as_string())
+
+    def test_migrate_legacy_versions(self):
+        create_bucket_dir(self.datadir, "versioned")
+        path = os.path.join(self.datadir, "versioned")
+        with open(os.path.join(path, "metadata"), "w") as fp:
+            fp.write("versioned=True\n")
+        for version_id, data in [("1.000000", "old"), ("2.000000", "new")]:
+            with open(os.path.join(path, "key." + version_id), "w") as fp:
+                fp.write(data)
+        bucket = self.s3.get_bucket("versioned")
+        self.assertEquals("new",
+                          bucket.get_key("key").get_contents_as_string())
+        self.assertEquals(["2.000000", "1.000000"],
+                          [v.version_id for v in bucket.get_all_versions()])
+        self.assertEquals(["key"], [k.name for k in bucket.list()])
+        # the settings replace the legacy file, which is never evaluated
+        self.assertFalse(os.path.exists(os.path.join(path, "metadata")))
+        with open(os.path.join(path, ".ms3bucket")) as fp:
+            self.assertEquals({"versioned": True, "layout": 2,
+                               "sharded": False}, json.load(fp))
+
+    def test_sharded_bucket(self):
+        create_bucket_dir(self.datadir, "sharded")
+        path = os.path.join(self.datadir, "sharded")
+        with open(os.path.join(path, ".ms3bucket"), "w") as fp:
+            json.dump({"sharded": True, "layout": 2}, fp)
+        bucket = self.s3.get_bucket("sharded")
+        names = ["b", "a/c", "a", "c/d/e", "ab"]
+        for name in names:
+            bucket.new_key(name).set_contents_from_string(name)
+        self.assertEquals(sorted(names), [k.name for k in bucket.list()])
+        self.assertEquals(["a", "a/", "ab", "b", "c/"],
+                          sorted(k.name for k in bucket.list(delimiter="/")))
+        self.assertEquals("a/c",
+                          bucket.get_key("a/c").get_contents_as_string())
+        # no object file at the path of its key
+        self.assertFalse(os.path.exists(os.path.join(path, "b")))
+        self.assertTrue(os.path.exists(os.path.join(
+            path, ".ms3shards", commands.shard_path("b"), "b")))
+        bucket.delete_key("b")
+        self.assertEquals(["a", "a/c", "ab", "c/d/e"],
+                          [k.name for k in bucket.list()])
+        self.assertFalse(os.path.exists(os.path.join(
+            path, ".ms3shards", commands.shard_path("b"))))
+        bucket.configure_versioning(True)
+        bucket.new_key("a").set_contents_from_string("new")
+        self.assertEquals("new", bucket.get_key("a").get_contents_as_string())
+        self.assertEquals(2, len([v for v in bucket.list_versions()
+                                  if v.name == "a"]))
+        self.assertTrue(os.path.isdir(os.path.join(
+            path, ".ms3versions", commands.shard_path("a"), "a")))
+
+    def test_convert_sharded(self):
+        bucket = self.s3.create_bucket("bucket")
+        names = ["a/b", "b", "c"]
+        for name in names:
+            bucket.new_key(name).set_contents_from_string(name)
+        bucket.configure_versioning(True)
+        bucket.new_key("a/b").set_contents_from_string("new")
+        path = os.path.join(self.datadir, "bucket")
+        time.sleep(0.01)
+        self.assertEquals(["bucket"], sharding.convert(self.datadir))
+        self.assertEquals([], sharding.convert(self.datadir, ["bucket"]))
+        self.assertEquals([".ms3bucket", ".ms3lock", ".ms3meta",
+                           ".ms3shards", ".ms3versions"],
+                          sorted(os.listdir(path)))
+        self.assertEquals(names, [k.name for k in bucket.list()])
+        self.assertEquals("new",
+                          bucket.get_key("a/b").get_contents_as_string())
+        self.assertEquals(2, len([v for v in bucket.list_versions()
+                                  if v.name == "a/b"]))
+        time.sleep(0.01)
+        sharding.convert(self.datadir, sharded=False)
+        self.assertEquals([".ms3bucket", ".ms3lock", ".ms3meta",
+                           ".ms3versions", "a", "b", "c"],
+                          sorted(os.listdir(path)))
+        self.assertEquals(names, [k.name for k in bucket.list()])
+        self.assertEquals("new",
+                          bucket.get_key("a/b").get_contents_as_string())
+        self.assertEquals(2, len([v for v in bucket.list_versions()
+                                  if v.name == "a/b"]))
+        # "b" and "b/c" can't both be files at the paths of their keys,
+        # even with "b-a" sorting between them
+        time.sleep(0.01)
+        sharding.convert(self.datadir)
+        bucket.new_key("b/c").set_contents_from_string("b/c")
+        bucket.new_key("b-a").set_contents_from_string("b-a")
+        names = ["a/b", "b", "b-a", "b/c", "c"]
+        with self.assertRaises(ValueError):
+            sharding.convert(self.datadir, sharded=False)
+        self.assertEquals(names, [k.name for k in bucket.list()])
+        # a failed rename moves the files back
+        bucket.delete_key("b/c")
+        names.remove("b/c")
+        os.makedirs(os.path.join(path, "c", "stray"))
+        with self.assertRaises(OSError):
+            sharding.convert(self.datadir, sharded=False)
+        self.assertEquals([".ms3bucket", ".ms3lock", ".ms3meta",
+                           ".ms3shards", ".ms3versions", "c"],
+                          sorted(os.listdir(path)))
+        with open(os.path.join(path, ".ms3bucket")) as fp:
+            self.assertTrue(json.load(fp)["sharded"])
+        self.assertEquals(names, [k.name for k in bucket.list()])
+        self.assertEquals("b-a",
+                          bucket.get_key("b-a").get_contents_as_string())
+
+    def test_versions_of_nested_keys(self):
+        bucket = self.s3.create_bucket("versioned")
+        bucket.configure_versioning(True)
+        bucket.new_key("x").set_contents_from_string("x")
+        bucket.delete_key("x")
+        bucket.new_key("x/1.5").set_contents_from_string("x/1.5")
+        # the versions of "x/1.5" are not versions of "x"
+        self.assertEquals(["x", "x", "x/1.5"],
+                          [v.name for v in bucket.list_versions()])
+        self.assertIsNone(bucket.get_key("x", version_id="1.5"))
+
+    def test_invalid_version_ids(self):
+        bucket = self.s3.create_bucket("versioned")
+        bucket.configure_versioning(True)
+        bucket.new_key("key").set_contents_from_string("content")
+        other = self.s3.create_bucket("other")
+        other.new_key("secret").set_contents_from_string("secret")
+        # not joined into the paths of the versions
+        version_id = "../../../other/secret"
+        self.assertIsNone(bucket.get_key("key", version_id=version_id))
+        with self.assertRaises(S3ResponseError) as context:
+            bucket.delete_key("key", version_id=version_id)
+        self.assertEquals(404, context.exception.status)
+        self.assertEquals("secret",
+                          other.get_key("secret").get_contents_as_string())
+
+    def test_invalid_keys(self):
+        bucket = self.s3.create_bucket("versioned")
+        bucket.configure_versioning(True)
+        other = self.s3.create_bucket("other")
+        other.new_key("secret").set_contents_from_string("secret")
+        for name in [".ms3bucket", ".ms3lock", ".ms3meta/key",
+                     "../other/secret", "a/../../other/secret"]:
+            with self.assertRaises(S3ResponseError) as context:
+                bucket.new_key(name).set_contents_from_string("{}")
+            self.assertEquals(400, context.exception.status)
+            with self.assertRaises(S3ResponseError) as context:
+                bucket.delete_key(name)
+            self.assertEquals(400, context.exception.status)
+            with self.assertRaises(S3ResponseError) as context:
+                bucket.copy_key("copied", "versioned", name)
+            self.assertEquals(400, context.exception.status)
+            with self.assertRaises(S3ResponseError) as context:
+                bucket.delete_keys([name])
+            self.assertEquals(400, context.exception.status)
+        self.assertEquals({"Versioning": "Enabled"},
+                          bucket.get_versioning_status())
+        self.assertEquals("secret",
+                          other.get_key("secret").get_contents_as_string())
+        self.assertEquals([], list(bucket.list()))
+
+    def test_index_kept_by_writes(self):
+        bucket = commands.Bucket.create("bucket", self.datadir)
+        for i in xrange(20):
+            with open(os.path.join(bucket.complete_path, "%02d" % i),
+                      "w") as fp:
+                fp.write("x")
+
+        def walks():
+            counts, total = metrics.filesystem.values.get(metrics.WALK,
+                                                          [[0], 0.0])
+            return sum(counts)
+        start = walks()
+        # no listing: the names are loaded once, then kept by the writes
+        for i in xrange(5):
+            bucket.set_entry("key-%d" % i, "data")
+            bucket.delete_entry("%02d" % i)
+        self.assertEquals(start + 1, walks())
+        # updated by another process meanwhile: loaded again
+        with open(os.path.join(bucket.complete_path, "by-hand"), "w"):
+            pass
+        with bucket.lock:
+            bucket.lock.bump()
+        bucket.set_entry("key-5", "data")
+        self.assertEquals(["by-hand"] + ["key-%d" % i for i in xrange(6)],
+                          bucket.index.names_after("all"))
+        self.assertEquals(start + 2, walks())
+
+    def test_bucket_registry(self):
+        registry = commands.BucketRegistry(self.datadir)
+        bucket = self.s3.create_bucket("bucket")
+        cached = registry.get("bucket")
+        # writing objects doesn't read the settings again
+        bucket.new_key("key").set_contents_from_string("content")
+        self.assertIs(cached, registry.get("bucket"))
+        bucket.configure_versioning(True)
+        self.assertTrue(registry.get("bucket").versioned)
+        cached = registry.get("bucket")
+        shutil.rmtree(os.path.join(self.datadir, "bucket"))
+        self.assertIsNone(registry.get("bucket"))
+        self.s3.create_bucket("bucket")
+        self.assertIsNot(cached, registry.get("bucket"))
+        self.assertFalse(registry.get("bucket").versioned)
+
+    def test_legacy_unversioned_bucket(self):
+        # as written by disable_versioning in older versions
+        create_bucket_dir(self.datadir, "bucket")
+        path = os.path.join(self.datadir, "bucket")
+        with open(os.path.join(path, "metadata"), "w") as fp:
+            fp.write("versioned=False\n")
+        for name in ["app", "app.1.0", "backup.2014.01"]:
+            with open(os.path.join(path, name), "w") as fp:
+                fp.write(name)
+        bucket = self.s3.get_bucket("bucket")
+        self.assertEquals(["app", "app.1.0", "backup.2014.01"],
+                          [k.name for k in bucket.list()])
+        self.assertEquals(
+            "app.1.0", bucket.get_key("app.1.0").get_contents_as_string())
+        self.assertFalse(os.path.exists(os.path.join(path, ".ms3versions")))
+
+    def test_versioning_changed_on_disk(self):
+        bucket = self.s3.create_bucket("bucket")
+        key = bucket.new_key("key")
+        key.set_contents_from_string("data")
+        self.assertEquals({}, bucket.get_versioning_status())
+        # as written by another server process
+        time.sleep(0.01)
+        with open(os.path.join(self.datadir, "bucket", ".ms3bucket"),
+                  "w") as fp:
+            json.dump({"versioned": True, "layout": 2}, fp)
+        self.assertEquals("Enabled",
+                          bucket.get_versioning_status()["Versioning"])
+
+    def test_get_large_object(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        bucket = self.s3.get_bucket("my-bucket")
+        data = "".join(chr(i % 256) for i in xrange(300 * 1024 + 7))
+        key = Key(bucket)
+        key.name = "large-object"
+        key.set_contents_from_string(data)
+        self.assertEquals(data, key.get_contents_as_string())
+
+    def test_conditional_get_head(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        bucket.new_key("key").set_contents_from_string("0123456789")
+        key = bucket.get_key("key")
+        self.assertEquals(10, key.size)
+        etag, last_modified = key.etag, key.last_modified
+
+        def status(method, **headers):
+            response = self.s3.make_request(method, "my-bucket", "key",
+                                            headers=headers)
+            body = response.read()
+            if response.status == 200 and method == "GET":
+                self.assertEquals("0123456789", body)
+            return response.status
+
+        for method in ["GET", "HEAD"]:
+            self.assertEquals(304, status(method, **{"If-None-Match": etag}))
+            self.assertEquals(200, status(method, **{"If-None-Match": '"x"'}))
+            self.assertEquals(200, status(method, **{"If-Match": etag}))
+            self.assertEquals(412, status(method, **{"If-Match": '"x"'}))
+            self.assertEquals(304, status(
+                method, **{"If-Modified-Since": last_modified}))
+            self.assertEquals(200, status(
+                method, **{"If-Modified-Since": "Mon, 01 Jan 2001 "
+                                                "00:00:00 GMT"}))
+            self.assertEquals(412, status(
+                method, **{"If-Unmodified-Since": "Mon, 01 Jan 2001 "
+                                                  "00:00:00 GMT"}))
+            self.assertEquals(200, status(
+                method, **{"If-Unmodified-Since": last_modified}))
+
+    def test_copy_key_conditions(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        bucket.new_key("source").set_contents_from_string("data")
+        etag = bucket.get_key("source").etag
+        for headers in [{"x-amz-copy-source-if-match": '"x"'},
+                        {"x-amz-copy-source-if-none-match": etag},
+                        {"x-amz-copy-source-if-unmodified-since":
+                         "Mon, 01 Jan 2001 00:00:00 GMT"}]:
+            with self.assertRaises(S3ResponseError) as context:
+                bucket.copy_key("copy", "my-bucket", "source",
+                                headers=headers)
+            self.assertEquals(412, context.exception.status)
+        self.assertIsNone(bucket.get_key("copy"))
+        bucket.copy_key("copy", "my-bucket", "source",
+                        headers={"x-amz-copy-source-if-match": etag})
+        self.assertEquals("data",
+                          bucket.get_key("copy").get_contents_as_string())
+
+    def test_get_object_range(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        bucket = self.s3.get_bucket("my-bucket")
+        key = Key(bucket)
+        key.name = "ranged-object"
+        key.set_contents_from_string("0123456789")
+        self.assertEquals("2345", key.get_contents_as_string(
+            headers={"Range": "bytes=2-5"}))
+        self.assertEquals("789", key.get_contents_as_string(
+            headers={"Range": "bytes=-3"}))
+        self.assertEquals("89", key.get_contents_as_string(
+            headers={"Range": "bytes=8-"}))
+        self.assertRaises(S3ResponseError, key.get_contents_as_string,
+                          headers={"Range": "bytes=20-"})
+
+    def test_put_bad_content_md5(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        bucket = self.s3.get_bucket("my-bucket")
+        key = Key(bucket)
+        key.name = "bad-md5"
+        bad_md5 = key.compute_md5(StringIO("something else"))
+        self.assertRaises(S3ResponseError, key.set_contents_from_string,
+                          "Simple test", md5=bad_md5)
+        self.assertEquals(0, len(bucket.get_all_keys()))
+        self.assertEquals([], os.listdir(
+            os.path.join(self.datadir, "my-bucket")))
+
+    def test_etag_of_object_added_by_hand(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        path = os.path.join(self.datadir, "my-bucket", "manual")
+        with open(path, "w") as fp:
+            fp.write("Added by hand")
+        bucket = self.s3.get_bucket("my-bucket")
+        keys = bucket.get_all_keys()
+        self.assertEquals(1, len(keys))
+        self.assertEquals(hashlib.md5("Added by hand").hexdigest(),
+                          keys[0].etag.strip('"'))
+        with open(path, "w") as fp:
+            fp.write("Changed by hand")
+        self.assertEquals('"%s"' % hashlib.md5("Changed by hand").hexdigest(),
+                          bucket.get_key("manual").etag)
+
+    def test_content_type(self):
+        create_bucket_dir(self.datadir, "my-bucket")
+        bucket = self.s3.get_bucket("my-bucket")
+        key = Key(bucket)
+        key.name = "typed"
+        key.set_contents_from_string("{}", headers={
+            "Content-Type": "application/json"})
+        key = bucket.get_key("typed")
+        key.get_contents_as_string()
+        self.assertEquals("application/json", key.content_type)
+
+    def test_multipart_upload(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        upload = bucket.initiate_multipart_upload("multi/part")
+        parts = ["a" * (5 * 1024 * 1024), "b" * 1024]
+        for number, data in reversed(list(enumerate(parts, 1))):
+            upload.upload_part_from_file(StringIO(data), number)
+        self.assertEquals([1, 2], [p.part_number for p in
+                                   upload.get_all_parts()])
+        self.assertEquals([1024], [p.size for p in
+                                   upload.get_all_parts(part_number_marker=1)])
+        upload.complete_upload()
+        key = bucket.get_key("multi/part")
+        self.assertEquals("".join(parts), key.get_contents_as_string())
+        digests = "".join(hashlib.md5(p).digest() for p in parts)
+        self.assertEquals('"%s-2"' % hashlib.md5(digests).hexdigest(),
+                          key.etag)
+        self.assertEquals([], os.listdir(
+            os.path.join(self.datadir, "my-bucket", ".ms3uploads")))
+
+    def test_multipart_upload_abort(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        upload = bucket.initiate_multipart_upload("multi/part")
+        upload.upload_part_from_file(StringIO("data"), 1)
+        upload.cancel_upload()
+        self.assertRaises(S3ResponseError, upload.upload_part_from_file,
+                          StringIO("more data"), 2)
+        self.assertIsNone(bucket.get_key("multi/part"))
+
+    def test_delete_keys(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        names = ["a/b/one", "a/b/two", "a/three", "four"]
+        for name in names:
+            key = Key(bucket)
+            key.name = name
+            key.set_contents_from_string(name)
+        result = bucket.delete_keys(names[:3] + ["missing"])
+        self.assertEquals(sorted(names[:3] + ["missing"]),
+                          sorted(d.key for d in result.deleted))
+        self.assertEquals([], result.errors)
+        self.assertEquals(["four"], [k.name for k in bucket.list()])
+        # the empty directories are pruned
+        self.assertFalse(os.path.exists(
+            os.path.join(self.datadir, "my-bucket", "a")))
+        result = bucket.delete_keys(["four"], quiet=True)
+        self.assertEquals([], result.deleted)
+        self.assertEquals([], list(bucket.list()))
+
+    def test_delete_keys_versioned(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        bucket.configure_versioning(True)
+        key = Key(bucket)
+        key.name = "key"
+        key.set_contents_from_string("first")
+        key.set_contents_from_string("second")
+        result = bucket.delete_keys(["key"])
+        self.assertTrue(result.deleted[0].delete_marker)
+        self.assertIsNone(bucket.get_key("key"))
+        versions = bucket.get_all_versions()
+        self.assertEquals(result.deleted[0].delete_marker_version_id,
+                          versions[0].version_id)
+        bucket.delete_keys([("key", versions[0].version_id),
+                            ("key", versions[1].version_id)])
+        self.assertEquals("first", bucket.get_key("key").
+                          get_contents_as_string())
+
+    def test_metrics(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        key = Key(bucket)
+        key.name = "object"
+        key.set_contents_from_string("0123456789")
+        key.get_contents_as_string()
+        text = urllib.urlopen(self.server.url + "/_ms3/metrics").read()
+        self.assertIn('ms3_requests_total{handler="ObjectHandler",'
+                      'method="PUT",status="200"} 1', text)
+        self.assertIn('ms3_request_bytes_total{handler="ObjectHandler",'
+                      'method="PUT"} 10', text)
+        self.assertIn('ms3_response_bytes_total{handler="ObjectHandler",'
+                      'method="GET"} 10', text)
+        self.assertIn('ms3_request_duration_seconds_count{'
+                      'handler="ObjectHandler",method="GET"} 1', text)
+        self.assertIn('ms3_storage_call_seconds_count{'
+                      'operation="store_upload"} 1', text)
+        self.assertIn('ms3_filesystem_seconds_bucket{operation="write",'
+                      'le="+Inf"} 1', text)
+        self.assertIn("# TYPE ms3_ioloop_lag_seconds histogram", text)
+
     def test_get_unknown_bucket(self):
         self.assertRaises(S3ResponseError, self.s3.get_bucket, "test-bucket")
 
@@ -162,6 +721,21 @@ class BucketOperationsTestCase(unittest2.TestCase):
         self.assertEquals(src_keys[0].size, dest_keys[0].size)
         self.assertEquals(src_keys[0].etag, dest_keys[0].etag)
 
+    def test_copy_key_is_not_changed_by_overwrite(self):
+        bucket = self.s3.create_bucket("bucket")
+        key = Key(bucket)
+        key.name = "source"
+        key.set_contents_from_string("original content")
+        bucket.copy_key("copy", "bucket", "source")
+        path = os.path.join(self.datadir, "bucket")
+        self.assertEquals(os.stat(os.path.join(path, "source")).st_ino,
+                          os.stat(os.path.join(path, "copy")).st_ino)
+        key.set_contents_from_string("new content")
+        self.assertEquals("original content",
+                          bucket.get_key("copy").get_contents_as_string())
+        self.assertEquals('"%s"' % hashlib.md5("original content").hexdigest(),
+                          bucket.get_key("copy").etag)
+
     def test_copy_key_src_versioning(self):
         source = self.s3.create_bucket("source")
         source.configure_versioning(True)
@@ -224,6 +798,502 @@ class BucketOperationsTestCase(unittest2.TestCase):
             self.assertEquals(s_version.size, d_version.size)
             self.assertEquals(s_version.etag, d_version.etag)
 
+    def test_snapshot_restore(self):
+        bucket = self.s3.create_bucket("fixtures")
+        bucket.new_key("kept").set_contents_from_string("kept")
+        versioned = self.s3.create_bucket("versioned")
+        versioned.configure_versioning(True)
+        versioned.new_key("key").set_contents_from_string("first")
+        self.server.snapshot("seed")
+        try:
+            bucket.new_key("kept").set_contents_from_string("changed")
+            bucket.new_key("added").set_contents_from_string("added")
+            versioned.new_key("key").set_contents_from_string("second")
+            self.s3.create_bucket("added")
+            self.server.restore("seed")
+            self.assertEquals(["fixtures", "versioned"], sorted(
+                b.name for b in self.s3.get_all_buckets()))
+            self.assertEquals(["kept"], [k.name for k in bucket.list()])
+            self.assertEquals("kept",
+                              bucket.get_key("kept").get_contents_as_string())
+            self.assertEquals(1, len(versioned.get_all_versions()))
+            self.assertEquals(
+                "first", versioned.get_key("key").get_contents_as_string())
+            # the snapshot is not changed by the restored buckets
+            bucket.delete_key("kept")
+            self.server.restore("seed")
+            self.assertEquals(["kept"], [k.name for k in bucket.list()])
+        finally:
+            admin_request(self.server.port, "DELETE", "/_ms3/snapshots/seed")
+        with self.assertRaises(Exception):
+            self.server.restore("seed")
+
+
+class MemoryStorageTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.datadir = get_data_dir('buckets')
+        MS3Server.start(datadir=self.datadir, storage="memory")
+        self.s3 = S3Connection('X', 'Y', is_secure=False,
+                               host='localhost', port=9010,
+                               calling_format=OrdinaryCallingFormat())
+
+    def tearDown(self):
+        self.s3.close()
+        MS3Server.stop()
+        cleanup(self.datadir)
+
+    def test_put_get_list_object(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        for name in ["b/two", "a/one", "b/three"]:
+            key = Key(bucket)
+            key.name = name
+            key.set_contents_from_string("content of %s" % name,
+                                         headers={"Content-Type": "text/x"})
+        self.assertEquals([], os.listdir(self.datadir))
+        self.assertEquals(["a/one", "b/three", "b/two"],
+                          [k.name for k in bucket.list()])
+        key = bucket.get_key("b/two")
+        self.assertEquals("content of b/two", key.get_contents_as_string())
+        self.assertEquals("text/x", key.content_type)
+        self.assertEquals('"%s"' % hashlib.md5("content of b/two").hexdigest(),
+                          key.etag)
+        page = bucket.get_all_keys(max_keys=1, delimiter="/")
+        self.assertTrue(page.is_truncated)
+        self.assertEquals(["a/"], [p.name for p in page])
+        self.assertEquals(["my-bucket"],
+                          [b.name for b in self.s3.get_all_buckets()])
+        self.s3.delete_bucket("my-bucket")
+        self.assertEquals([], self.s3.get_all_buckets())
+
+    def test_versioning(self):
+        bucket = self.s3.create_bucket("versioned")
+        key = Key(bucket)
+        key.name = "an/object"
+        key.set_contents_from_string("unversioned")
+        bucket.configure_versioning(True)
+        key.set_contents_from_string("versioned")
+        bucket.delete_key("an/object")
+        self.assertIsNone(bucket.get_key("an/object"))
+        versions = bucket.get_all_versions()
+        self.assertEquals(3, len(versions))
+        bucket.delete_key("an/object", version_id=versions[0].version_id)
+        self.assertEquals("versioned", key.get_contents_as_string())
+        bucket.copy_key("copy", "versioned", "an/object",
+                        src_version_id=versions[2].version_id)
+        self.assertEquals("unversioned",
+                          bucket.get_key("copy").get_contents_as_string())
+
+    def test_multipart_upload(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        upload = bucket.initiate_multipart_upload("multi/part")
+        # another upload of the key, started right away
+        other = bucket.initiate_multipart_upload("multi/part")
+        self.assertNotEquals(upload.id, other.id)
+        other.cancel_upload()
+        parts = ["a" * (5 * 1024 * 1024), "b" * 1024]
+        for number, data in enumerate(parts, 1):
+            upload.upload_part_from_file(StringIO(data), number)
+        upload.complete_upload()
+        key = bucket.get_key("multi/part")
+        self.assertEquals("".join(parts), key.get_contents_as_string())
+        self.assertTrue(key.etag.endswith('-2"'))
+
+    def test_memory_limit(self):
+        MS3Server.stop()
+        config = os.path.join(self.datadir, "ms3.conf")
+        with open(config, "w") as fp:
+            fp.write("memory_limit = 1500\n")
+        MS3Server.start(datadir=self.datadir, config=config, storage="memory")
+        bucket = self.s3.create_bucket("my-bucket")
+        key = Key(bucket)
+        key.name = "object"
+        key.set_contents_from_string("x" * 1000)
+        key.set_contents_from_string("y" * 1000)
+        key.name = "another"
+        with self.assertRaises(S3ResponseError) as context:
+            key.set_contents_from_string("z" * 1000)
+        self.assertEquals(413, context.exception.status)
+        bucket.delete_key("object")
+        key.set_contents_from_string("z" * 1000)
+
+    def test_snapshot_restore(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        bucket.new_key("kept").set_contents_from_string("kept")
+        MS3Server.snapshot("seed")
+        bucket.new_key("kept").set_contents_from_string("changed")
+        bucket.new_key("added").set_contents_from_string("added")
+        MS3Server.restore("seed")
+        self.assertEquals(["kept"], [k.name for k in bucket.list()])
+        self.assertEquals("kept",
+                          bucket.get_key("kept").get_contents_as_string())
+
+
+class DurabilityTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.datadir = get_data_dir("durability")
+        metrics.reset()
+
+    def tearDown(self):
+        durability.configure(durability.NONE)
+        cleanup(self.datadir)
+
+    def fsyncs(self):
+        counts, total = metrics.filesystem.values.get(metrics.FSYNC,
+                                                      [[0], 0.0])
+        return sum(counts)
+
+    def test_modes(self):
+        with self.assertRaises(ValueError):
+            durability.configure("always")
+        synced = {}
+        for mode in durability.MODES:
+            durability.configure(mode, 0.001)
+            bucket = commands.Bucket.create(mode, self.datadir)
+            bucket.enable_versioning()
+            metrics.reset()
+            bucket.set_entry("a/b", "data")
+            self.assertEquals("data", bucket.get_entry("a/b").read())
+            synced[mode] = self.fsyncs()
+        self.assertEquals(0, synced["none"])
+        # the data and the metadata records of the version and of the key
+        self.assertEquals(3, synced["rename"])
+        # then the directories
+        self.assertTrue(synced["fsync"] > 1)
+        self.assertEquals(synced["fsync"], synced["group"])
+
+    def test_group_commit(self):
+        durability.configure(durability.GROUP, 0.05)
+        bucket = commands.Bucket.create("bucket", self.datadir)
+        threads = [threading.Thread(target=bucket.set_entry,
+                                    args=("key-%d" % i, "data"))
+                   for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(["key-%d" % i for i in xrange(8)],
+                          bucket.index.names_after())
+        counts, total = metrics.group_commit_paths.values[()]
+        # 2 syncs (data, then renames) per write, batched
+        self.assertTrue(sum(counts) < 8)
+
+
+class ServerWithOptionsTestCase(unittest2.TestCase):
+    """
+        Starts a server configured with the options of the class, forked
+        (the options are global) with a configuration file
+    """
+    options = {}
+
+    def setUp(self):
+        self.datadir = get_data_dir('buckets')
+        self.config = os.path.join(get_data_dir('config'), "ms3.conf")
+        with open(self.config, "w") as fp:
+            for name, value in sorted(self.options.items()):
+                fp.write("%s = %r\n" % (name, value))
+        MS3Server.start(datadir=self.datadir, config=self.config)
+        self.s3 = S3Connection('X', 'Y', is_secure=False,
+                               host='localhost', port=9010,
+                               calling_format=OrdinaryCallingFormat())
+
+    def tearDown(self):
+        self.s3.close()
+        MS3Server.stop()
+        cleanup(self.datadir)
+        cleanup(os.path.dirname(self.config))
+
+
+class DedupTestCase(ServerWithOptionsTestCase):
+    options = {"dedup": True}
+
+    def blobs(self):
+        return [name for _, _, files in os.walk(
+                os.path.join(self.datadir, ".ms3blobs")) for name in files]
+
+    def test_identical_objects_share_data(self):
+        digest = hashlib.md5("same content").hexdigest()
+        first = self.s3.create_bucket("first")
+        second = self.s3.create_bucket("second")
+        second.configure_versioning(True)
+        for bucket, name in [(first, "a"), (first, "b"), (second, "c"),
+                             (second, "c")]:
+            key = Key(bucket)
+            key.name = name
+            key.set_contents_from_string("same content")
+        inodes = set(os.stat(os.path.join(self.datadir, path)).st_ino
+                     for path in ["first/a", "first/b", "second/c"])
+        self.assertEquals(1, len(inodes))
+        self.assertEquals([digest], self.blobs())
+        self.assertEquals(["first", "second"],
+                          [b.name for b in self.s3.get_all_buckets()])
+        self.assertEquals("same content",
+                          second.get_key("c").get_contents_as_string())
+        first.delete_key("a")
+        first.delete_key("b")
+        self.assertEquals([digest], self.blobs())
+        for version in second.get_all_versions():
+            second.delete_key("c", version_id=version.version_id)
+        self.assertEquals([], self.blobs())
+
+    def test_overwrite_releases_data(self):
+        bucket = self.s3.create_bucket("bucket")
+        key = Key(bucket)
+        key.name = "key"
+        key.set_contents_from_string("old")
+        key.set_contents_from_string("new")
+        key.set_contents_from_string("new")
+        self.assertEquals([hashlib.md5("new").hexdigest()], self.blobs())
+        self.assertEquals(["key"], [name for name in os.listdir(
+            os.path.join(self.datadir, "bucket"))
+            if not name.startswith(".ms3")])
+        self.assertEquals("new", key.get_contents_as_string())
+
+
+class CompressionTestCase(ServerWithOptionsTestCase):
+    options = {"compress_types": "text/*"}
+
+    def get(self, path, encoding):
+        connection = httplib.HTTPConnection("localhost", 9010)
+        try:
+            connection.request("GET", path,
+                               headers={"Accept-Encoding": encoding})
+            response = connection.getresponse()
+            return response.getheader("Content-Encoding"), response.read()
+        finally:
+            connection.close()
+
+    def test_listing(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        for i in xrange(100):
+            bucket.new_key("key-%03d" % i).set_contents_from_string("x")
+        encoding, body = self.get("/my-bucket/", "gzip")
+        self.assertEquals("gzip", encoding)
+        listing = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.assertEquals(100, listing.count("<Key>"))
+        encoding, body = self.get("/my-bucket/", "deflate, gzip;q=0")
+        self.assertEquals("deflate", encoding)
+        self.assertEquals(listing, zlib.decompress(body))
+        self.assertEquals((None, listing), self.get("/my-bucket/", ""))
+        # below the size threshold
+        self.s3.create_bucket("empty")
+        encoding, body = self.get("/empty/", "gzip")
+        self.assertIsNone(encoding)
+        self.assertIn("ListBucketResult", body)
+
+    def test_objects(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        text = "compressible " * 10000
+        bucket.new_key("text").set_contents_from_string(
+            text, headers={"Content-Type": "text/plain"})
+        bucket.new_key("binary").set_contents_from_string(text)
+        encoding, body = self.get("/my-bucket/text", "gzip")
+        self.assertEquals("gzip", encoding)
+        self.assertLess(len(body), len(text) / 10)
+        self.assertEquals(text, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        self.assertEquals((None, text), self.get("/my-bucket/binary", "gzip"))
+        self.assertEquals(text,
+                          bucket.get_key("text").get_contents_as_string())
+
+
+class CacheTestCase(ServerWithOptionsTestCase):
+    options = {"cache_size": 100, "cache_max_object_size": 40}
+
+    def metric(self, name):
+        for line in admin_request(9010, "GET", "/_ms3/metrics").splitlines():
+            if line.startswith(name + " "):
+                return float(line.split()[1])
+        return 0
+
+    def test_get_head(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        bucket.new_key("key").set_contents_from_string("0123456789")
+        self.assertEquals("0123456789",
+                          bucket.get_key("key").get_contents_as_string())
+        # changed by hand, the cached object is served
+        with open(os.path.join(self.datadir, "my-bucket", "key"), "w") as fp:
+            fp.write("changed")
+        key = bucket.get_key("key")
+        self.assertEquals(10, key.size)
+        self.assertEquals('"%s"' % hashlib.md5("0123456789").hexdigest(),
+                          key.etag)
+        self.assertEquals("0123456789", key.get_contents_as_string())
+        self.assertEquals("234", key.get_contents_as_string(
+            headers={"Range": "bytes=2-4"}))
+        # only the first HEAD (of get_key) read the disk
+        self.assertEquals(
+            1, self.metric('ms3_cache_requests_total{result="miss"}'))
+        self.assertEquals(
+            4, self.metric('ms3_cache_requests_total{result="hit"}'))
+        # invalidated by writes and deletions
+        bucket.new_key("key").set_contents_from_string("new")
+        self.assertEquals("new",
+                          bucket.get_key("key").get_contents_as_string())
+        bucket.copy_key("copied", "my-bucket", "key")
+        self.assertEquals("new",
+                          bucket.get_key("copied").get_contents_as_string())
+        bucket.new_key("key").set_contents_from_string("newer")
+        bucket.copy_key("copied", "my-bucket", "key")
+        self.assertEquals("newer",
+                          bucket.get_key("copied").get_contents_as_string())
+        bucket.delete_key("key")
+        self.assertIsNone(bucket.get_key("key"))
+
+    def test_eviction(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        for name in ["a", "b", "c", "large"]:
+            bucket.new_key(name).set_contents_from_string(
+                name * (60 if name == "large" else 40))
+        for name in ["a", "b", "a", "c", "large"]:
+            bucket.get_key(name).get_contents_as_string()
+        # the least recently used (b) made room for c, large is too large
+        self.assertEquals(1, self.metric("ms3_cache_evictions_total"))
+        self.assertEquals(80, self.metric("ms3_cache_bytes"))
+        self.assertEquals(2, self.metric("ms3_cache_objects"))
+
+    def test_snapshot_restore(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        bucket.new_key("key").set_contents_from_string("seeded")
+        MS3Server.snapshot("seed")
+        bucket.new_key("key").set_contents_from_string("changed")
+        self.assertEquals("changed",
+                          bucket.get_key("key").get_contents_as_string())
+        MS3Server.restore("seed")
+        self.assertEquals("seeded",
+                          bucket.get_key("key").get_contents_as_string())
+
+
+class BenchmarkTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.workdir = get_data_dir('benchmark')
+
+    def tearDown(self):
+        cleanup(self.workdir)
+
+    def test_report(self):
+        from ms3 import benchmark
+        output = os.path.join(self.workdir, "report.json")
+        benchmark.main([None, "--sizes=1K", "--bucket_keys=3",
+                        "--versioned=both", "--samples=2",
+                        "--concurrency=2", "--output=%s" % output])
+        with open(output) as fp:
+            report = json.load(fp)
+        self.assertEquals([False, True], [scenario["versioned"] for
+                                          scenario in report["scenarios"]])
+        for scenario in report["scenarios"]:
+            self.assertEquals(1024, scenario["size"])
+            self.assertEquals(["fill"] + benchmark.OPERATIONS,
+                              [r["operation"] for r in scenario["results"]])
+            for result in scenario["results"]:
+                self.assertEquals(0, result["errors"])
+                self.assertTrue(result["latency"]["p50"] <=
+                                result["latency"]["p99"])
+
+
+class ProfilingTestCase(ServerWithOptionsTestCase):
+    options = {"profiling": True}
+
+    def request(self, path, method="GET", headers=None):
+        request = urllib2.Request("http://localhost:9010" + path,
+                                  headers=headers or {})
+        request.get_method = lambda: method
+        return urllib2.urlopen(request)
+
+    def test_profile_request(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        key = Key(bucket)
+        key.name = "object"
+        key.set_contents_from_string("content")
+        response = self.request("/my-bucket/", headers={"x-ms3-profile": "1"})
+        capture_id = response.info()["x-ms3-profile-id"]
+        text = self.request("/_ms3/profile/%s?format=text" % capture_id).read()
+        self.assertIn("list_page", text)
+        self.assertIn("iter_xml", text)
+        stats = marshal.loads(self.request(
+            "/_ms3/profile/%s" % capture_id).read())
+        self.assertIn("list_page", [name for _, _, name in stats])
+
+    def test_profile_window(self):
+        bucket = self.s3.create_bucket("my-bucket")
+        capture = json.load(self.request("/_ms3/profile?mode=sampling",
+                                         method="POST"))
+        for i in xrange(20):
+            key = Key(bucket)
+            key.name = "object-%d" % i
+            key.set_contents_from_string("content")
+        self.assertEquals(capture["id"], json.load(self.request(
+            "/_ms3/profile", method="DELETE"))["id"])
+        stacks = self.request("/_ms3/profile/%s" % capture["id"]).read()
+        self.assertIn("MainThread;", stacks)
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit()
+                            for line in stacks.splitlines()))
+        listing = json.load(self.request("/_ms3/profile"))
+        self.assertIsNone(listing["window"])
+        self.assertEquals([capture["id"]],
+                          [c["id"] for c in listing["captures"]])
+
+
+class InProcessServerTestCase(unittest2.TestCase):
+
+    def test_start_stop(self):
+        server = InProcessServer(storage="memory").start()
+        try:
+            self.assertNotEquals(shared_server().port, server.port)
+            s3 = S3Connection('X', 'Y', is_secure=False,
+                              host='localhost', port=server.port,
+                              calling_format=OrdinaryCallingFormat())
+            key = Key(s3.create_bucket("my-bucket"))
+            key.name = "object"
+            key.set_contents_from_string("content")
+            self.assertEquals("content", key.get_contents_as_string())
+            s3.close()
+            server.reset()
+            self.assertEquals([], server.app.storage.get_all_buckets())
+        finally:
+            server.stop()
+        self.assertFalse(is_running(server.port))
+        self.assertFalse(os.path.exists(server.datadir))
+
+
+class MultiProcessTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.datadir = get_data_dir('buckets')
+        MS3Server.start(datadir=self.datadir, processes=3)
+
+    def tearDown(self):
+        MS3Server.stop()
+        cleanup(self.datadir)
+
+    def connect(self):
+        return S3Connection('X', 'Y', is_secure=False,
+                            host='localhost', port=9010,
+                            calling_format=OrdinaryCallingFormat())
+
+    def test_shared_datadir(self):
+        bucket = self.connect().create_bucket("versioned")
+        bucket.configure_versioning(True)
+        names = []
+        for i in xrange(12):
+            # a new connection each time, served by any of the processes
+            s3 = self.connect()
+            key = Key(s3.get_bucket("versioned"))
+            key.name = "key-%d" % (i % 3)
+            key.set_contents_from_string("content %d" % i)
+            names.append(key.name)
+            self.assertEquals(sorted(set(names)), [k.name for k in
+                              s3.get_bucket("versioned").list()])
+            s3.close()
+        s3 = self.connect()
+        bucket = s3.get_bucket("versioned")
+        self.assertEquals("content 11",
+                          bucket.get_key("key-2").get_contents_as_string())
+        versions = [v for v in bucket.get_all_versions() if v.name == "key-2"]
+        self.assertEquals(["content %d" % i for i in (11, 8, 5, 2)],
+                          [v.get_contents_as_string() for v in versions])
+
 
 if __name__ == "__main__":
     helpers.run()